@@ -14,7 +14,7 @@ import datetime
 from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Sequence, Tuple
+from typing import Any, Dict, List, Optional, Sequence, Tuple, cast
 
 import numpy as np
 import cv2
@@ -39,11 +39,24 @@ if __package__ in (None, ""):
         sys.path.insert(0, str(project_root))
 
     from backend.features import DinoV2Features  # type: ignore[no-redef]
-    from backend.patchcore import PatchCoreMemory  # type: ignore[no-redef]
+    from backend.extractor_pool import ExtractorPool, parse_devices  # type: ignore[no-redef]
+    from backend.microbatch import MicroBatcher  # type: ignore[no-redef]
+    from backend.patchcore import (  # type: ignore[no-redef]
+        INDEX_TYPES,
+        KNN_AGGREGATIONS,
+        MEMORY_PRECISIONS,
+        PatchCoreMemory,
+        apply_search_params,
+        build_faiss_index,
+        held_out_sample,
+        index_recall,
+        storage_dtype,
+    )
     from backend.storage import ModelStore  # type: ignore[no-redef]
-    from backend.infer import InferenceEngine  # type: ignore[no-redef]
+    from backend.infer import POST_MODES, InferenceEngine  # type: ignore[no-redef]
     from backend.calib import choose_threshold  # type: ignore[no-redef]
-    from backend.utils import ensure_dir, base64_from_bytes  # type: ignore[no-redef]
+    from backend.roi_mask import set_mask_cache_limit  # type: ignore[no-redef]
+    from backend.utils import ensure_dir, base64_from_bytes, embedding_drift  # type: ignore[no-redef]
     from backend.diagnostics import (
         bind_request_id,
         reset_request_id,
@@ -53,11 +66,24 @@ if __package__ in (None, ""):
     )  # type: ignore[no-redef]
 else:
     from .features import DinoV2Features
-    from .patchcore import PatchCoreMemory
+    from .extractor_pool import ExtractorPool, parse_devices
+    from .microbatch import MicroBatcher
+    from .patchcore import (
+        INDEX_TYPES,
+        KNN_AGGREGATIONS,
+        MEMORY_PRECISIONS,
+        PatchCoreMemory,
+        apply_search_params,
+        build_faiss_index,
+        held_out_sample,
+        index_recall,
+        storage_dtype,
+    )
     from .storage import ModelStore
-    from .infer import InferenceEngine
+    from .infer import POST_MODES, InferenceEngine
     from .calib import choose_threshold
-    from .utils import ensure_dir, base64_from_bytes
+    from .roi_mask import set_mask_cache_limit
+    from .utils import ensure_dir, base64_from_bytes, embedding_drift
     from .diagnostics import (
         bind_request_id,
         reset_request_id,
@@ -256,7 +282,13 @@ def _artifact_fallback_reason(
     model_key_effective: str,
     artifact: str,
 ) -> tuple[str | None, str | None]:
-    if resolved_path == expected_path:
+    def _matches(path: Path) -> bool:
+        # La memoria puede estar en formato nuevo (.mem.json) o legacy (.npz) en la misma ubicación
+        if artifact == "memory":
+            return resolved_path in store.memory_file_variants(path)
+        return resolved_path == path
+
+    if _matches(expected_path):
         return None, None
 
     if recipe_id_effective != "default":
@@ -272,7 +304,7 @@ def _artifact_fallback_reason(
             model_key=model_key_effective,
             create=False,
         )
-        if resolved_path == default_path:
+        if _matches(default_path):
             return artifact, "default_recipe_fallback"
 
     alt_recipe_dir = store._find_recipe_dir_case_insensitive(recipe_id_effective)
@@ -284,7 +316,7 @@ def _artifact_fallback_reason(
             "calib": f"{store._base_name(role_id, roi_id)}_calib.json",
         }
         alt_path = alt_base / filename_lookup[artifact]
-        if resolved_path == alt_path:
+        if _matches(alt_path):
             return artifact, "case_insensitive_recipe_dir"
 
     legacy_lookup = {
@@ -292,7 +324,7 @@ def _artifact_fallback_reason(
         "index": (store.root / f"{store._legacy_flat_base_name(role_id, roi_id)}_index.faiss"),
         "calib": (store.root / f"{store._legacy_flat_base_name(role_id, roi_id)}_calib.json"),
     }
-    if resolved_path == legacy_lookup[artifact]:
+    if _matches(legacy_lookup[artifact]):
         return artifact, "legacy_flat"
 
     legacy_dir_lookup = {
@@ -300,7 +332,7 @@ def _artifact_fallback_reason(
         "index": store._legacy_dir(role_id, roi_id) / "index.faiss",
         "calib": store._legacy_dir(role_id, roi_id) / "calib.json",
     }
-    if resolved_path == legacy_dir_lookup[artifact]:
+    if _matches(legacy_dir_lookup[artifact]):
         return artifact, "legacy_dir"
 
     return artifact, "other"
@@ -590,19 +622,53 @@ if REQUIRE_CUDA and not torch.cuda.is_available():
 if torch.cuda.is_available():
     torch.backends.cudnn.benchmark = True
 
-# Carga única del extractor (congelado)
-_extractor = DinoV2Features(
-    model_name="vit_small_patch14_dinov2.lvd142m",
-    device="cuda" if torch.cuda.is_available() else "cpu",
-    half=torch.cuda.is_available(),
-    input_size=448,   # múltiplo de 14; si envías 384, el extractor reescala internamente
-    patch_size=14
+# Carga única del extractor (congelado): una réplica por dispositivo + slots por dispositivo
+_features_cfg = SETTINGS.get("features", {}) or {}
+
+
+def _feature_layers() -> tuple[int, ...]:
+    raw = _features_cfg.get("layers") or "9,10,11"
+    if isinstance(raw, (list, tuple)):
+        return tuple(int(v) for v in raw)
+    return tuple(int(v) for v in str(raw).split(",") if v.strip())
+
+
+def _make_extractor(device: str) -> DinoV2Features:
+    return DinoV2Features(
+        model_name="vit_small_patch14_dinov2.lvd142m",
+        out_indices=_feature_layers(),  # el forward se corta en max(out_indices)
+        device=device,
+        half=device.startswith("cuda"),
+        input_size=448,   # múltiplo de 14; si envías 384, el extractor reescala internamente
+        patch_size=14,
+        preprocess=str(_features_cfg.get("preprocess", "pil") or "pil"),
+        backend=str(_features_cfg.get("backend", "eager") or "eager"),
+        backend_path=(_features_cfg.get("backend_path") or None),
+        backend_threads=int(_features_cfg.get("backend_threads", 0) or 0),
+        quantize=str(_features_cfg.get("quantize", "none") or "none"),
+    )
+
+
+_extractor = ExtractorPool(
+    _make_extractor,
+    parse_devices(_features_cfg.get("devices"), "cuda" if torch.cuda.is_available() else "cpu"),
+    concurrency=int(_features_cfg.get("concurrency", 1) or 1),
 )
 
+# Micro-batching opt-in de /infer: agrupa peticiones concurrentes en un único extract_batch()
+_microbatcher: MicroBatcher | None = None
+if float(_features_cfg.get("microbatch_max_wait_ms", 0) or 0) > 0:
+    _microbatcher = MicroBatcher(
+        _extractor,
+        max_batch=int(_features_cfg.get("microbatch_max_size", 8) or 8),
+        max_wait_ms=float(_features_cfg.get("microbatch_max_wait_ms", 0)),
+        workers=len(getattr(_extractor, "_replicas", [])) or 1,
+    )
+
 
 # --- In-process caches (per uvicorn worker) ---------------------------------
 # NOTE: With `uvicorn --workers > 1` each worker has its own process+GPU context.
-# These caches reduce disk I/O and avoid rebuilding sklearn/FAISS indices on every request.
+# These caches reduce disk I/O and avoid rebuilding FAISS/fallback indices on every request.
 
 @dataclass
 class _MemCacheEntry:
@@ -646,6 +712,179 @@ def _env_int(name: str, default: int) -> int:
 
 
 _CACHE_MAX_ENTRIES = _env_int("BDI_CACHE_MAX_ENTRIES", 32)
+# Máscaras ROI rasterizadas (+ grids de tokens) compartidas por /infer, /infer_dataset y /calibrate_dataset
+set_mask_cache_limit(_env_int("BDI_MASK_CACHE_MB", 64) * 1024 * 1024)
+
+
+def _extract_batch_size() -> int:
+    features_cfg = SETTINGS.get("features", {}) or {}
+    try:
+        return max(1, int(features_cfg.get("batch_size", 8)))
+    except Exception:
+        return 8
+
+
+def _index_settings(index_type: Optional[str] = None, index_params: Optional[str] = None) -> tuple[str, Dict[str, Any]]:
+    """Tipo/parámetros del índice kNN: los del fit si se dan, si no los de la configuración."""
+    inference_cfg = SETTINGS.get("inference", {}) or {}
+    itype = (index_type or str(inference_cfg.get("index_type", "flat") or "flat")).strip().lower()
+    raw = index_params if index_params not in (None, "") else inference_cfg.get("index_params")
+    if isinstance(raw, dict):
+        params = dict(raw)
+    elif raw in (None, ""):
+        params = {}
+    else:
+        params = json.loads(str(raw))
+        if not isinstance(params, dict):
+            raise ValueError("index_params debe ser un objeto JSON")
+    if itype not in INDEX_TYPES:
+        raise ValueError(f"index_type debe ser uno de {INDEX_TYPES}")
+    return itype, params
+
+
+def _memory_precision(value: Optional[str] = None) -> str:
+    """Precisión de la memoria pedida en el fit o, si no, la de la configuración."""
+    precision = (value or str((SETTINGS.get("inference", {}) or {}).get("memory_precision", "float32")) or "float32")
+    precision = precision.strip().lower()
+    if precision not in MEMORY_PRECISIONS:
+        raise ValueError(f"memory_precision debe ser uno de {MEMORY_PRECISIONS}")
+    return precision
+
+
+def _knn_settings(source: Optional[Dict[str, Any]] = None) -> tuple[int, str]:
+    """(k, agregación) del score kNN: los de `source` (calibración de la ROI o payload) o los de la configuración."""
+    inference_cfg = SETTINGS.get("inference", {}) or {}
+    src = source or {}
+    k = int(src.get("knn_k") or inference_cfg.get("knn_k", 1) or 1)
+    aggregation = str(src.get("knn_aggregation") or inference_cfg.get("knn_aggregation", "min") or "min").strip().lower()
+    if k < 1:
+        raise ValueError("knn_k debe ser >= 1")
+    if aggregation not in KNN_AGGREGATIONS:
+        raise ValueError(f"knn_aggregation debe ser uno de {KNN_AGGREGATIONS}")
+    return k, aggregation
+
+
+def _post_settings() -> Dict[str, Any]:
+    """Modo de posproceso del heatmap (full | grid) y lado de la rejilla reducida, de la configuración."""
+    inference_cfg = SETTINGS.get("inference", {}) or {}
+    post_mode = str(inference_cfg.get("post_mode", "full") or "full").strip().lower()
+    if post_mode not in POST_MODES:
+        raise ValueError(f"post_mode debe ser uno de {POST_MODES}")
+    return {"post_mode": post_mode, "post_grid": int(inference_cfg.get("post_grid", 256) or 0)}
+
+
+def _run_output(include_heatmap: Optional[bool]) -> str:
+    """Salida de InferenceEngine.run según include_heatmap (None = heatmap solo para decisiones NG)."""
+    if include_heatmap is None:
+        return "auto"
+    return "full" if include_heatmap else "regions"
+
+
+def _load_incremental_base(
+    role_id: str, roi_id: str, recipe_id: str, model_key: str
+) -> tuple[Optional[Tuple[np.ndarray, Tuple[int, int], Dict[str, Any]]], Optional[str]]:
+    """Memoria existente (misma recipe/model_key) sobre la que ampliar, o (None, motivo)."""
+    path = store.existing_memory_file(
+        store.expected_memory_path(role_id, roi_id, recipe_id=recipe_id, model_key=model_key, create=False)
+    )
+    if path is None:
+        return None, "no_previous_memory"
+    loaded = store.load_memory_file(path)
+    meta = loaded[2] or {}
+    if not meta.get("fitted_digests"):
+        return None, "previous_memory_without_sample_hashes"
+    if _extractor_mismatch(meta):
+        return None, "extractor_changed"
+    # Memoria float16/sq8: se amplía desde los centros float32 exactos si se guardó la referencia
+    reference = store.load_memory_reference(path, expected_shape=tuple(loaded[0].shape))
+    if reference is not None:
+        loaded = (reference, loaded[1], loaded[2])
+    return loaded, None
+
+
+def _embedding_cache_key() -> Optional[str]:
+    """Clave de la caché de embeddings para el extractor actual (None = caché desactivada)."""
+    if not _is_truthy((SETTINGS.get("features", {}) or {}).get("embedding_cache", "1")):
+        return None
+    meta = _extractor_metadata()
+    return store.embedding_cache_key(meta) if meta else None
+
+
+def _extract_dataset_cached(
+    role_id: str,
+    roi_id: str,
+    recipe_id: str,
+    entries: Sequence[tuple[bytes, str, Optional[np.ndarray]]],
+    batch_size: int,
+    use_cache: bool = True,
+) -> tuple[list[tuple[np.ndarray, tuple[int, int]]], int]:
+    """
+    Embeddings de imágenes del dataset usando la caché por contenido de ModelStore.
+
+    entries: (bytes del fichero, nombre, imagen decodificada o None). Solo se decodifican y
+    extraen (en lotes) las imágenes sin entrada en caché. Devuelve (features alineadas, aciertos).
+    use_cache=False extrae todo sin leer ni escribir la caché (p.ej. imágenes subidas).
+    """
+    cache_key = _embedding_cache_key() if use_cache else None
+    results: list[Optional[tuple[np.ndarray, tuple[int, int]]]] = [None] * len(entries)
+    digests: list[Optional[str]] = [None] * len(entries)
+    misses: list[int] = []
+    for i, (data, _name, _img) in enumerate(entries):
+        if cache_key is not None:
+            digests[i] = store.image_digest(data)
+            cached = store.load_cached_embedding(role_id, roi_id, digests[i], cache_key, recipe_id=recipe_id)
+            if cached is not None:
+                results[i] = cached
+                continue
+        misses.append(i)
+
+    for start in range(0, len(misses), batch_size):
+        chunk = misses[start:start + batch_size]
+        imgs = [entries[i][2] if entries[i][2] is not None else _decode_image_bytes(entries[i][0], entries[i][1]) for i in chunk]
+        for i, features in zip(chunk, _extractor.extract_batch(imgs, batch_size=batch_size)):
+            if cache_key is not None:
+                # Mismo redondeo float16 que la caché: el fit no depende de si hubo acierto o no
+                features = (np.asarray(features[0], dtype=np.float16).astype(np.float32), features[1])
+            results[i] = features
+            digest = digests[i]
+            if cache_key is not None and digest is not None:
+                try:
+                    store.save_cached_embedding(
+                        role_id, roi_id, digest, cache_key, features[0], features[1], recipe_id=recipe_id
+                    )
+                except OSError as exc:
+                    log.warning("[emb_cache] no se pudo guardar %s: %s", entries[i][1], exc)
+    return cast(list[tuple[np.ndarray, tuple[int, int]]], results), len(entries) - len(misses)
+
+
+def _extractor_metadata() -> Dict[str, Any]:
+    get_metadata = getattr(_extractor, "get_metadata", None)
+    if not callable(get_metadata):
+        return {}
+    try:
+        return dict(get_metadata() or {})
+    except Exception:
+        return {}
+
+
+# Campos del extractor que deben coincidir entre fit_ok e inferencia (cambian los embeddings)
+_EXTRACTOR_COMPAT_KEYS = ("model_name", "input_size", "patch_size", "out_indices", "pool", "preprocess", "quantize")
+
+
+def _extractor_mismatch(metadata: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Mensaje de error si la memoria se entrenó con otro extractor; None si es compatible o legacy."""
+    fitted = (metadata or {}).get("extractor")
+    if not isinstance(fitted, dict):
+        return None  # memorias anteriores sin metadatos del extractor
+    current = _extractor_metadata()
+    diffs = [
+        f"{k}: memoria={fitted.get(k)!r} actual={current.get(k)!r}"
+        for k in _EXTRACTOR_COMPAT_KEYS
+        if k in fitted and k in current and fitted.get(k) != current.get(k)
+    ]
+    if not diffs:
+        return None
+    return "extractor_mismatch: " + "; ".join(diffs) + ". Reentrena con /fit_ok."
 
 
 def _cache_key(recipe_id: str, model_key: str, role_id: str, roi_id: str) -> str:
@@ -696,11 +935,17 @@ def _get_patchcore_memory_cached(role_id: str, roi_id: str, *, recipe_id: str, m
         return None
     emb_mem, token_hw_mem, metadata = loaded
 
+    index_meta = (metadata or {}).get("index") or {}
+    index_type = str(index_meta.get("type") or "flat")
+    index_params = dict(index_meta.get("params") or {})
+    precision = str(index_meta.get("precision") or "float32")
+
     faiss_cfg = SETTINGS.get("faiss", {}) or {}
     prefer_gpu = _is_truthy(faiss_cfg.get("prefer_gpu", 1))
     gpu_device = int(faiss_cfg.get("gpu_device", 0))
     require_faiss = _is_truthy(faiss_cfg.get("require_faiss", 0))
     allow_sklearn_fallback = _is_truthy(faiss_cfg.get("allow_sklearn_fallback", 1))
+    knn_fallback = str(faiss_cfg.get("knn_fallback", "numpy") or "numpy")
 
     try:
         import faiss  # type: ignore
@@ -709,20 +954,27 @@ def _get_patchcore_memory_cached(role_id: str, roi_id: str, *, recipe_id: str, m
             raise RuntimeError(
                 "FAISS is required but not installed; install faiss-gpu/faiss-cpu or enable sklearn fallback."
             ) from exc
-        mem_obj = PatchCoreMemory(embeddings=emb_mem, index=None, coreset_rate=(metadata or {}).get("coreset_rate"))
+        mem_obj = PatchCoreMemory(
+            embeddings=emb_mem,
+            index=None,
+            coreset_rate=(metadata or {}).get("coreset_rate"),
+            knn_backend=knn_fallback,
+            precision=precision,
+        )
     else:
         blob = store.load_index_blob(role_id, roi_id, recipe_id=recipe_id, model_key=model_key)
         if blob is not None:
             idx_cpu = faiss.deserialize_index(np.frombuffer(blob, dtype=np.uint8))
+            apply_search_params(idx_cpu, index_type, index_params)
         else:
-            idx_cpu = faiss.IndexFlatL2(int(emb_mem.shape[1]))
-            idx_cpu.add(emb_mem.astype(np.float32, copy=False))
+            idx_cpu, index_type, index_params = build_faiss_index(emb_mem, index_type, index_params, precision=precision)
 
         idx = idx_cpu
         gpu_res = None
 
         ngpu = 0
-        if prefer_gpu and hasattr(faiss, "StandardGpuResources"):
+        # HNSW no tiene versión GPU en FAISS: se queda en CPU
+        if prefer_gpu and index_type != "hnsw" and hasattr(faiss, "StandardGpuResources"):
             get_num_gpus = getattr(faiss, "get_num_gpus", None)
             result: Any = get_num_gpus() if callable(get_num_gpus) else None
 
@@ -776,7 +1028,14 @@ def _get_patchcore_memory_cached(role_id: str, roi_id: str, *, recipe_id: str, m
                             device_id=gpu_device,
                             error=str(exc),
                         )
-        mem_obj = PatchCoreMemory(embeddings=emb_mem, index=idx, coreset_rate=(metadata or {}).get("coreset_rate"))
+        mem_obj = PatchCoreMemory(
+            embeddings=emb_mem,
+            index=idx,
+            coreset_rate=(metadata or {}).get("coreset_rate"),
+            index_type=index_type,
+            index_params=index_params,
+            precision=precision,
+        )
         if gpu_res is not None:
             mem_obj._faiss_gpu_res = gpu_res
 
@@ -859,14 +1118,54 @@ def _read_image_file_with_len(file: UploadFile) -> tuple[np.ndarray, int]:
 
 
 def _read_image_path(path: Path) -> np.ndarray:
-    data = path.read_bytes()
+    return _decode_image_bytes(path.read_bytes(), path.name)
+
+
+def _decode_image_bytes(data: bytes, name: str) -> np.ndarray:
     img_array = np.frombuffer(data, dtype=np.uint8)
     img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
     if img is None:
-        raise ValueError(f"No se pudo decodificar la imagen: {path.name}")
+        raise ValueError(f"No se pudo decodificar la imagen: {name}")
     return img
 
 
+def _heatmap_png_b64(heat_u8: Any) -> str | None:
+    heat_u8 = np.asarray(heat_u8, dtype=np.uint8)
+    try:
+        ok, buf = cv2.imencode(".png", heat_u8)
+        if ok:
+            return base64_from_bytes(buf.tobytes())
+        return None
+    except Exception:
+        # PIL fallback (evita dependencias GL en algunos entornos)
+        from PIL import Image
+        import io
+        im = Image.fromarray(heat_u8)
+        bio = io.BytesIO()
+        im.save(bio, format="PNG")
+        return base64_from_bytes(bio.getvalue())
+
+
+def _normalize_regions(regions: List[Any]) -> List[Any]:
+    """Añade x/y/w/h a partir de bbox (o bbox a partir de x/y/w/h) para la GUI."""
+    normalized_regions = []
+    for r in regions:
+        if isinstance(r, dict):
+            region = dict(r)
+            bbox = region.get("bbox")
+            if bbox and isinstance(bbox, (list, tuple)) and len(bbox) == 4:
+                region.setdefault("x", float(bbox[0]))
+                region.setdefault("y", float(bbox[1]))
+                region.setdefault("w", float(bbox[2]))
+                region.setdefault("h", float(bbox[3]))
+            elif {"x", "y", "w", "h"}.issubset(region.keys()):
+                region["bbox"] = [region.get("x"), region.get("y"), region.get("w"), region.get("h")]
+            normalized_regions.append(region)
+        else:
+            normalized_regions.append(r)
+    return normalized_regions
+
+
 def _validate_mm_per_px(value: float) -> float:
     mm = float(value)
     if not np.isfinite(mm) or mm <= 0:
@@ -1056,6 +1355,14 @@ def health(request: Request):
     }
     if not cuda_available:
         resp["reason"] = "cuda_not_available"
+    pool_stats = getattr(_extractor, "stats", None)
+    if callable(pool_stats):
+        resp["extractor_pool"] = pool_stats()
+    if _microbatcher is not None:
+        resp["microbatch"] = _microbatcher.stats()
+    backend_name = getattr(_extractor, "backend", None)
+    if isinstance(backend_name, str):
+        resp["extractor_backend"] = {"backend": backend_name, "parity": getattr(_extractor, "backend_parity", None)}
     return resp
 
 @app.post("/fit_ok")
@@ -1069,10 +1376,21 @@ def fit_ok(
     use_dataset: bool = Form(False),
     recipe_id: Optional[str] = Form(None),
     model_key: Optional[str] = Form(None),
+    incremental: bool = Form(False),
+    index_type: Optional[str] = Form(None),
+    index_params: Optional[str] = Form(None),
+    memory_precision: Optional[str] = Form(None),
 ):
     """
     Acumula OKs para construir la memoria PatchCore (coreset + kNN).
     Guarda (role_id, roi_id): memoria (embeddings), token grid y, si hay FAISS, el índice.
+
+    incremental=true: si la memoria actual es compatible, solo se codifican las imágenes OK
+    no usadas en fits anteriores y el k-center greedy continúa desde el coreset existente.
+
+    index_type / index_params (JSON): índice kNN de la memoria (flat | ivf_flat | ivf_pq | hnsw);
+    por defecto los de la configuración. Para índices aproximados se informa el recall@1.
+    memory_precision: float32 | float16 | sq8 (coreset en 16 bits; búsqueda en 16 u 8 bits).
     """
     t0: Optional[float] = None
     try:
@@ -1123,6 +1441,7 @@ def fit_ok(
             n_files=len(images or []),
             memory_fit=bool(memory_fit),
             use_dataset=bool(use_dataset),
+            incremental=bool(incremental),
             mm_per_px=float(mm_per_px),
             recipe_id_raw=raw_recipe_id,
             model_key_raw=model_key,
@@ -1152,6 +1471,11 @@ def fit_ok(
                 status_code=status_code,
                 content={"error": message, "request_id": request_id, "recipe_id": recipe_resolved},
             )
+        try:
+            index_type_req, index_params_req = _index_settings(index_type, index_params)
+            precision_req = _memory_precision(memory_precision)
+        except ValueError as exc:
+            return _fit_ok_error(str(exc))
         if train_dataset_only and not use_dataset:
             return _fit_ok_error("Training only supported from dataset (use_dataset=true) in this deployment.")
         if not use_dataset and not images:
@@ -1159,6 +1483,10 @@ def fit_ok(
 
         all_emb: List[np.ndarray] = []
         token_hw: tuple[int, int] | None = None
+        batch_size = _extract_batch_size()
+        n_cache_hits = 0
+        # Muestras OK como (bytes, nombre, sha256)
+        samples: list[tuple[bytes, str, str]] = []
         _ensure_recipe_mm_per_px(request_id, recipe_resolved, mm_per_px)
 
         if use_dataset:
@@ -1185,28 +1513,75 @@ def fit_ok(
                     f"Insufficient OK samples: need at least {min_ok_samples}, found {len(ok_files)}"
                 )
 
-            for fn in ok_files:
-                p = store.resolve_dataset_file_existing(role_id, roi_id, "ok", fn, recipe_id=recipe_resolved)
-                if p is None:
-                    continue
-                img = _read_image_path(p)
-                emb, token_hw_local = _extractor.extract(img)
-                if token_hw is None:
-                    token_hw = token_hw_local
-                elif (int(token_hw_local[0]), int(token_hw_local[1])) != (int(token_hw[0]), int(token_hw[1])):
-                    return _fit_ok_error(f"Token grid mismatch: got {token_hw_local}, expected {token_hw}")
-                token_hw = token_hw_local
-                all_emb.append(emb)
+            ok_paths = [
+                p
+                for p in (
+                    store.resolve_dataset_file_existing(role_id, roi_id, "ok", fn, recipe_id=recipe_resolved)
+                    for fn in ok_files
+                )
+                if p is not None
+            ]
+            for p in ok_paths:
+                data = p.read_bytes()
+                samples.append((data, p.name, store.image_digest(data)))
         else:
             for uf in images or []:
-                img = _read_image_file(uf)
-                emb, token_hw_local = _extractor.extract(img)
-                if token_hw is None:
-                    token_hw = token_hw_local
-                elif (int(token_hw_local[0]), int(token_hw_local[1])) != (int(token_hw[0]), int(token_hw[1])):
-                    return _fit_ok_error(f"Token grid mismatch: got {token_hw_local}, expected {token_hw}")
+                data = uf.file.read()
+                samples.append((data, uf.filename or "upload", store.image_digest(data)))
+
+        # Modo incremental: partir de la memoria existente y codificar solo las muestras nuevas
+        prev_memory: Optional[Tuple[np.ndarray, Tuple[int, int], Dict[str, Any]]] = None
+        incremental_fallback: str | None = None
+        if incremental:
+            prev_memory, incremental_fallback = _load_incremental_base(
+                role_id, roi_id, recipe_resolved, model_key_effective
+            )
+        fitted_digests: list[str] = list((prev_memory[2] if prev_memory else {}).get("fitted_digests") or [])
+        known = set(fitted_digests)
+        # Duplicados dentro del mismo fit se mantienen (mismo comportamiento que el fit completo)
+        new_samples = [sample for sample in samples if sample[2] not in known]
+        for *_, digest in new_samples:
+            if digest not in known:
+                known.add(digest)
+                fitted_digests.append(digest)
+        current_digests = {digest for *_, digest in samples}
+        n_removed = 0
+        if prev_memory is not None:
+            # Muestras del fit anterior que ya no están: el coreset no las olvida (requiere fit completo)
+            n_removed = sum(1 for digest in prev_memory[2].get("fitted_digests") or [] if digest not in current_digests)
+
+        if prev_memory is not None and not new_samples:
+            emb_prev, hw_prev, meta_prev = prev_memory
+            return {
+                "n_embeddings": int(meta_prev.get("n_embeddings", emb_prev.shape[0])),
+                "coreset_size": int(emb_prev.shape[0]),
+                "token_shape": [int(hw_prev[0]), int(hw_prev[1])],
+                "coreset_rate_requested": float(meta_prev.get("coreset_rate", 0.0)),
+                "coreset_rate_applied": float(meta_prev.get("applied_rate", 0.0)),
+                "embedding_cache_hits": 0,
+                "incremental": True,
+                "n_new_images": 0,
+                "n_removed_images": int(n_removed),
+                "request_id": request_id,
+                "recipe_id": recipe_resolved,
+            }
+
+        # Solo se decodifican/extraen las imágenes que no están en la caché de embeddings
+        features_new, n_cache_hits = _extract_dataset_cached(
+            role_id,
+            roi_id,
+            recipe_resolved,
+            [(data, name, None) for data, name, _ in new_samples],
+            batch_size,
+            use_cache=bool(use_dataset),
+        )
+        for emb, token_hw_local in features_new:
+            if token_hw is None:
                 token_hw = token_hw_local
-                all_emb.append(emb)
+            elif (int(token_hw_local[0]), int(token_hw_local[1])) != (int(token_hw[0]), int(token_hw[1])):
+                return _fit_ok_error(f"Token grid mismatch: got {token_hw_local}, expected {token_hw}")
+            token_hw = token_hw_local
+            all_emb.append(emb)
 
         if not all_emb:
             return _fit_ok_error("No valid images")
@@ -1215,12 +1590,51 @@ def fit_ok(
 
         # Coreset (puedes ajustar coreset_rate)
         coreset_rate = float(SETTINGS.get("inference", {}).get("coreset_rate", 0.02))
-        if memory_fit:
-            coreset_rate = 1.0
-        mem = PatchCoreMemory.build(E, coreset_rate=coreset_rate, seed=0)
+        projection_dim = int(SETTINGS.get("inference", {}).get("coreset_projection_dim", 0) or 0)
+        # Selección del coreset en el dispositivo del extractor (CUDA) con fallback a CPU
+        coreset_device = getattr(_extractor, "device", None)
+        if prev_memory is not None:
+            emb_prev, hw_prev, meta_prev = prev_memory
+            if token_hw is not None and tuple(int(v) for v in token_hw) != tuple(int(v) for v in hw_prev):
+                return _fit_ok_error(f"Token grid mismatch: got {token_hw}, memory has {hw_prev}")
+            # Misma tasa que el fit original, aplicada solo a los embeddings nuevos
+            coreset_rate = 1.0 if memory_fit else float(meta_prev.get("coreset_rate", coreset_rate))
+            mem = PatchCoreMemory.extend(
+                emb_prev,
+                E,
+                coreset_rate=coreset_rate,
+                seed=0,
+                projection_dim=projection_dim,
+                device=coreset_device,
+                index_type=index_type_req,
+                index_params=index_params_req,
+                precision=precision_req,
+            )
+            n_embeddings_total = int(meta_prev.get("n_embeddings", emb_prev.shape[0])) + int(E.shape[0])
+        else:
+            if memory_fit:
+                coreset_rate = 1.0
+            mem = PatchCoreMemory.build(
+                E,
+                coreset_rate=coreset_rate,
+                seed=0,
+                projection_dim=projection_dim,
+                device=coreset_device,
+                index_type=index_type_req,
+                index_params=index_params_req,
+                precision=precision_req,
+            )
+            n_embeddings_total = int(E.shape[0])
+
+        # Recall del índice aproximado frente a búsqueda exacta, con embeddings que no entraron en el coreset
+        index_info = mem.index_info()
+        if mem.index is not None and (mem.index_type != "flat" or mem.precision != "float32"):
+            recall = index_recall(mem.index, mem.emb, held_out_sample(E, mem.coreset_indices))
+            if recall is not None:
+                index_info["recall_at_1"] = recall
 
         # Persistir memoria + token grid
-        applied_rate = float(mem.emb.shape[0]) / float(E.shape[0]) if E.shape[0] > 0 else 0.0
+        applied_rate = float(mem.emb.shape[0]) / float(n_embeddings_total) if n_embeddings_total > 0 else 0.0
         if token_hw is None:
             raise ValueError("No valid OK images received; token grid (token_hw) is undefined.")
 
@@ -1232,9 +1646,22 @@ def fit_ok(
             metadata={
                 "coreset_rate": float(coreset_rate),
                 "applied_rate": float(applied_rate),
+                "coreset_projection_dim": int(projection_dim),
+                # Tipo/parámetros del índice kNN (el blob _index.faiss se reconstruye con ellos si falta)
+                "index": index_info,
+                # El modo de preprocesado cambia ligeramente los embeddings: reentrenar si cambia
+                "preprocess": str(getattr(_extractor, "preprocess", "pil")),
+                "quantize": str(getattr(_extractor, "quantize", "none")),
+                # Configuración del extractor (capas, input_size...) para validar en inferencia
+                "extractor": _extractor_metadata(),
+                # Para fit incremental: embeddings totales vistos y sha256 de las imágenes usadas
+                "n_embeddings": int(n_embeddings_total),
+                "fitted_digests": fitted_digests,
             },
             recipe_id=recipe_resolved,
             model_key=model_key_effective,
+            dtype=storage_dtype(mem.precision),
+            reference=mem.reference,
         )
 
         # Persistir índice FAISS si está disponible
@@ -1260,14 +1687,21 @@ def fit_ok(
         _invalidate_calib_cache(recipe_resolved, model_key_effective, role_id, roi_id)
 
         response = {
-            "n_embeddings": int(E.shape[0]),
+            "n_embeddings": int(n_embeddings_total),
             "coreset_size": int(mem.emb.shape[0]),
             "token_shape": [int(token_hw[0]), int(token_hw[1])],
             "coreset_rate_requested": float(coreset_rate),
             "coreset_rate_applied": float(applied_rate),
+            "embedding_cache_hits": int(n_cache_hits),
+            "index": index_info,
+            "incremental": prev_memory is not None,
+            "n_new_images": len(new_samples),
+            "n_removed_images": int(n_removed),
             "request_id": request_id,
             "recipe_id": recipe_resolved,
         }
+        if incremental and prev_memory is None:
+            response["incremental_fallback"] = incremental_fallback
         memory_probe = _file_probe(Path(memory_path_written) if memory_path_written is not None else None)
         index_probe = _file_probe(Path(index_path_written) if index_path_written is not None else None)
         diag_event(
@@ -1278,8 +1712,12 @@ def fit_ok(
             roi_id=roi_id,
             model_key=model_key_effective,
             elapsed_ms=int(1000 * (time.time() - t0)),
-            n_embeddings=int(E.shape[0]),
+            n_embeddings=int(n_embeddings_total),
+            n_new_images=len(new_samples),
+            incremental=prev_memory is not None,
             coreset_size=int(mem.emb.shape[0]),
+            embedding_cache_hits=int(n_cache_hits),
+            index=index_info,
             fitted_after=True,
             memory_path_written=str(memory_path_written) if memory_path_written is not None else None,
             index_path_written=index_path_written,
@@ -1338,6 +1776,7 @@ async def calibrate_ng(payload: Dict[str, Any], request: Request):
         ng_scores = _scores_1d_finite(payload.get("ng_scores")) if "ng_scores" in payload else None
         area_mm2_thr = float(payload.get("area_mm2_thr", SETTINGS.get("inference", {}).get("area_mm2_thr", 1.0)))
         p_score = int(payload.get("score_percentile", SETTINGS.get("inference", {}).get("score_percentile", 99)))
+        knn_k, knn_aggregation = _knn_settings(payload)
 
         diag_event(
             "calibrate_ng.request",
@@ -1378,6 +1817,8 @@ async def calibrate_ng(payload: Dict[str, Any], request: Request):
             "mm_per_px": float(mm_per_px),
             "area_mm2_thr": float(area_mm2_thr),
             "score_percentile": int(p_score),
+            "knn_k": int(knn_k),
+            "knn_aggregation": knn_aggregation,
             "request_id": request_id,
             "recipe_id": recipe_resolved,
         }
@@ -1459,8 +1900,6 @@ def infer(
         _ensure_recipe_mm_per_px(request_id, recipe_resolved, mm_per_px)
         t0 = time.time()
 
-        import base64, json
-
         # 1) Imagen ROI canónica
         img, image_len = _read_image_file_with_len(image)
         probe = probe_artifacts(role_id, roi_id, recipe_resolved, model_key_effective)
@@ -1541,6 +1980,21 @@ def infer(
                 },
             )
         mem, token_hw_mem, metadata = cached
+        mismatch = _extractor_mismatch(metadata)
+        if mismatch:
+            diag_event(
+                "infer.extractor_mismatch",
+                request_id=request_id,
+                role_id=role_id,
+                roi_id=roi_id,
+                recipe_id=recipe_resolved,
+                model_key=model_key_effective,
+                error=mismatch,
+            )
+            return JSONResponse(
+                status_code=400,
+                content={"error": mismatch, "request_id": request_id, "recipe_id": recipe_resolved},
+            )
 
         # 3) Calibración (obligatoria, también cacheada)
         calib = calib or _get_calib_cached(role_id, roi_id, recipe_id=recipe_resolved, model_key=model_key_effective)
@@ -1569,12 +2023,16 @@ def infer(
         shape_obj = json.loads(shape) if shape else None
 
         # 5) Inferencia (1 sola extracción DINO por request)
+        knn_k, knn_aggregation = _knn_settings(calib)
         engine = InferenceEngine(
             _extractor,
             mem,
             token_hw_mem,
             mm_per_px=float(mm_per_px),
+            k=knn_k,
             memory_metadata=metadata,
+            aggregation=knn_aggregation,
+            **_post_settings(),
         )
 
         token_shape_expected: tuple[int, int] | None = None
@@ -1583,6 +2041,12 @@ def infer(
             token_shape_expected = (int(token_hw_source[0]), int(token_hw_source[1]))
 
         try:
+            features = None
+            encode_ms: int | None = None
+            if _microbatcher is not None:
+                t_enc = time.perf_counter()
+                features = _microbatcher.extract(img)
+                encode_ms = int((time.perf_counter() - t_enc) * 1000)
             res = engine.run(
                 img,
                 token_shape_expected=token_shape_expected,
@@ -1590,7 +2054,11 @@ def infer(
                 threshold=thr,
                 area_mm2_thr=float(area_mm2_thr),
                 score_percentile=int(p_score),
+                features=features,
+                output=_run_output(include_heatmap),
             )
+            if encode_ms is not None and isinstance(res.get("timings_ms"), dict):
+                res["timings_ms"]["encode"] = encode_ms  # incluye la espera del micro-batch
         except ValueError as ve:
             # Token grid mismatch u otras validaciones de entrada
             return JSONResponse(
@@ -1609,36 +2077,10 @@ def infer(
         # 6) Heatmap -> PNG base64 (solo si se va a devolver)
         heatmap_png_b64 = None
         if should_include_heatmap and heat_u8 is not None:
-            heat_u8 = np.asarray(heat_u8, dtype=np.uint8)
-            try:
-                ok, buf = cv2.imencode(".png", heat_u8)
-                if ok:
-                    heatmap_png_b64 = base64.b64encode(buf.tobytes()).decode("ascii")
-            except Exception:
-                # PIL fallback (evita dependencias GL en algunos entornos)
-                from PIL import Image
-                import io
-                im = Image.fromarray(heat_u8)
-                bio = io.BytesIO()
-                im.save(bio, format="PNG")
-                heatmap_png_b64 = base64.b64encode(bio.getvalue()).decode("ascii")
+            heatmap_png_b64 = _heatmap_png_b64(heat_u8)
 
         # 7) Normalizar regiones (solo para visualización)
-        normalized_regions = []
-        for r in regions:
-            if isinstance(r, dict):
-                region = dict(r)
-                bbox = region.get("bbox")
-                if bbox and isinstance(bbox, (list, tuple)) and len(bbox) == 4:
-                    region.setdefault("x", float(bbox[0]))
-                    region.setdefault("y", float(bbox[1]))
-                    region.setdefault("w", float(bbox[2]))
-                    region.setdefault("h", float(bbox[3]))
-                elif {"x", "y", "w", "h"}.issubset(region.keys()):
-                    region["bbox"] = [region.get("x"), region.get("y"), region.get("w"), region.get("h")]
-                normalized_regions.append(region)
-            else:
-                normalized_regions.append(r)
+        normalized_regions = _normalize_regions(regions)
 
         response = {
             "score": float(score),
@@ -1680,6 +2122,194 @@ def infer(
         return JSONResponse(status_code=500, content={"error": str(e), "request_id": request_id2, "recipe_id": recipe_id2})
 
 
+@app.post("/infer_multi")
+def infer_multi(
+    request: Request,
+    mm_per_px: float = Form(...),
+    images: List[UploadFile] = File(...),
+    rois: str = Form(...),
+    include_heatmap: Optional[bool] = Form(None),
+    recipe_id: Optional[str] = Form(None),
+):
+    """
+    Inferencia de varias ROIs de una misma pieza en una sola petición.
+
+    `rois` es un array JSON alineado con `images` (mismo orden); cada entrada lleva
+    role_id, roi_id y opcionalmente model_key y shape. Las imágenes se extraen en lote
+    (un forward DINO) y cada ROI se busca contra su propia memoria/calibración cacheada.
+    Los errores de una ROI (sin fit_ok, sin calibración, grid distinto) se informan en su
+    item sin abortar el resto.
+    """
+    t0: Optional[float] = None
+    try:
+        request_id, recipe_resolved = _resolve_request_context(request, recipe_id)
+        _attach_request_context(request, request_id=request_id, recipe_id=recipe_resolved)
+        mm_per_px = _validate_mm_per_px(mm_per_px)
+        _ensure_recipe_mm_per_px(request_id, recipe_resolved, mm_per_px)
+        t0 = time.time()
+
+        specs = json.loads(rois) if rois else None
+        if not isinstance(specs, list) or not specs:
+            raise ValueError("rois debe ser un array JSON no vacío")
+        if len(specs) != len(images):
+            raise ValueError(f"rois ({len(specs)}) y images ({len(images)}) deben tener la misma longitud")
+
+        inference_cfg = SETTINGS.get("inference", {})
+        results: list[dict[str, Any]] = []
+        # (item, img, mem, token_hw_mem, metadata, calib, shape_obj)
+        pending: list[tuple[dict[str, Any], np.ndarray, Any, Any, Any, Dict[str, Any], Optional[Dict[str, Any]]]] = []
+
+        # 1) Decodificar + resolver artefactos por ROI
+        t_prep = time.perf_counter()
+        for idx, (spec, upload) in enumerate(zip(specs, images)):
+            if not isinstance(spec, dict) or not spec.get("role_id") or not spec.get("roi_id"):
+                raise ValueError(f"rois[{idx}] requiere role_id y roi_id")
+            role_id = str(spec["role_id"])
+            roi_id = str(spec["roi_id"])
+            model_key_effective = str(spec.get("model_key") or roi_id)
+            item: dict[str, Any] = {
+                "role_id": role_id,
+                "roi_id": roi_id,
+                "model_key": model_key_effective,
+                "score": None,
+                "threshold": None,
+                "decision": None,
+                "token_shape": None,
+                "heatmap_png_base64": None,
+                "regions": [],
+                "timings_ms": {},
+                "error": None,
+            }
+            results.append(item)
+            try:
+                img, _ = _read_image_file_with_len(upload)
+                cached = _get_patchcore_memory_cached(role_id, roi_id, recipe_id=recipe_resolved, model_key=model_key_effective)
+                if cached is None:
+                    raise LookupError("Memoria no encontrada. Ejecuta /fit_ok antes de /infer_multi.")
+                mem, token_hw_mem, metadata = cached
+                mismatch = _extractor_mismatch(metadata)
+                if mismatch:
+                    raise LookupError(mismatch)
+                calib = _get_calib_cached(role_id, roi_id, recipe_id=recipe_resolved, model_key=model_key_effective) or {}
+                thr = calib.get("threshold")
+                if thr is None or float(thr) <= 0:
+                    raise LookupError("calibration_missing")
+                item["threshold"] = float(thr)
+                pending.append((item, img, mem, token_hw_mem, metadata, calib, _parse_shape_value(spec.get("shape"))))
+            except Exception as exc:
+                item["error"] = str(exc)
+        prep_ms = int((time.perf_counter() - t_prep) * 1000)
+
+        # 2) Forward del extractor por lotes (BDI_EXTRACT_BATCH_SIZE) para todas las ROIs válidas
+        encode_ms = 0
+        batch_features: list[Any] = []
+        if pending:
+            t_enc = time.perf_counter()
+            try:
+                batch_features = _extractor.extract_batch([p[1] for p in pending], batch_size=_extract_batch_size())
+            except Exception as exc:
+                # Fallo del extractor: se informa en cada ROI pendiente en lugar de un 500 global
+                for p in pending:
+                    p[0]["error"] = str(exc)
+                pending = []
+            encode_ms = int((time.perf_counter() - t_enc) * 1000)
+
+        # 3) kNN + posproceso por ROI contra su propia memoria
+        for (item, img, mem, token_hw_mem, metadata, calib, shape_obj), features in zip(pending, batch_features):
+            try:
+                thr = float(item["threshold"])
+                token_hw_source = getattr(mem, "token_hw", None) or token_hw_mem
+                knn_k, knn_aggregation = _knn_settings(calib)
+                engine = InferenceEngine(
+                    _extractor,
+                    mem,
+                    token_hw_mem,
+                    mm_per_px=float(mm_per_px),
+                    k=knn_k,
+                    memory_metadata=metadata,
+                    aggregation=knn_aggregation,
+                    **_post_settings(),
+                )
+                res = engine.run(
+                    img,
+                    token_shape_expected=(int(token_hw_source[0]), int(token_hw_source[1])),
+                    shape=shape_obj,
+                    threshold=thr,
+                    area_mm2_thr=float(calib.get("area_mm2_thr", inference_cfg.get("area_mm2_thr", 1.0))),
+                    score_percentile=int(calib.get("score_percentile", inference_cfg.get("score_percentile", 99))),
+                    features=features,
+                    output=_run_output(include_heatmap),
+                )
+                score = float(res.get("score", 0.0))
+                decision = "ng" if score >= thr else "ok"
+                token_shape_out = res.get("token_shape", [int(token_hw_mem[0]), int(token_hw_mem[1])])
+                should_include_heatmap = include_heatmap if include_heatmap is not None else decision == "ng"
+                heat_u8 = res.get("heatmap_u8")
+                timings = dict(res.get("timings_ms") or {})
+                timings["encode"] = encode_ms  # forward compartido por todo el lote
+                item.update(
+                    {
+                        "score": score,
+                        "decision": decision,
+                        "token_shape": [int(token_shape_out[0]), int(token_shape_out[1])],
+                        "heatmap_png_base64": (
+                            _heatmap_png_b64(heat_u8) if should_include_heatmap and heat_u8 is not None else None
+                        ),
+                        "regions": _normalize_regions(res.get("regions", []) or []),
+                        "timings_ms": timings,
+                    }
+                )
+            except Exception as exc:
+                item["error"] = str(exc)
+
+        decisions = [r["decision"] for r in results]
+        n_errors = sum(1 for r in results if r["error"] is not None)
+        if "ng" in decisions:
+            decision = "ng"
+        elif n_errors == 0:
+            decision = "ok"
+        else:
+            decision = None  # sin NG pero con ROIs no evaluadas: no se puede dar la pieza por buena
+
+        elapsed_ms = int(1000 * (time.time() - t0))
+        diag_event(
+            "infer_multi.response",
+            request_id=request_id,
+            recipe_id=recipe_resolved,
+            n_rois=len(results),
+            n_errors=n_errors,
+            decision=decision,
+            elapsed_ms=elapsed_ms,
+            encode_ms=encode_ms,
+        )
+        return {
+            "decision": decision,
+            "n_rois": len(results),
+            "n_errors": n_errors,
+            "results": results,
+            "timings_ms": {"prepare": prep_ms, "encode": encode_ms, "total": elapsed_ms},
+            "request_id": request_id,
+            "recipe_id": recipe_resolved,
+        }
+
+    except HTTPException:
+        raise
+    except ValueError as e:
+        request_id2, recipe_id2 = _resolve_request_context_safe(request, recipe_id)
+        return JSONResponse(status_code=400, content={"error": str(e), "request_id": request_id2, "recipe_id": recipe_id2})
+    except Exception as e:
+        request_id2, recipe_id2 = _resolve_request_context_safe(request, recipe_id)
+        diag_event(
+            "infer_multi.error",
+            request_id=request_id2,
+            recipe_id=recipe_id2,
+            error_type=type(e).__name__,
+            error_message=str(e),
+            elapsed_ms=int(1000 * (time.time() - t0)) if t0 is not None else None,
+        )
+        return JSONResponse(status_code=500, content={"error": str(e), "request_id": request_id2, "recipe_id": recipe_id2})
+
+
 @app.post("/infer_dataset")
 def infer_dataset(payload: Dict[str, Any], request: Request):
     try:
@@ -1706,6 +2336,9 @@ def infer_dataset(payload: Dict[str, Any], request: Request):
         if cached is None:
             raise HTTPException(status_code=400, detail="Memoria no encontrada. Ejecuta /fit_ok antes de /infer_dataset.")
         mem, token_hw_mem, metadata = cached
+        mismatch = _extractor_mismatch(metadata)
+        if mismatch:
+            raise HTTPException(status_code=400, detail=mismatch)
 
         calib = _get_calib_cached(role_id, roi_id, recipe_id=recipe_resolved, model_key=model_key)
         thr = calib.get("threshold") if calib else None
@@ -1713,87 +2346,114 @@ def infer_dataset(payload: Dict[str, Any], request: Request):
         p_score = calib.get("score_percentile", SETTINGS.get("inference", {}).get("score_percentile", 99)) if calib else SETTINGS.get("inference", {}).get("score_percentile", 99)
         if thr is None or float(thr) <= 0:
             raise HTTPException(status_code=400, detail="calibration_missing")
+        knn_k, knn_aggregation = _knn_settings(calib)
 
         listing = store.list_dataset(role_id, roi_id, recipe_id=recipe_resolved)
         items: list[dict[str, Any]] = []
         n_errors = 0
+        n_cache_hits = 0
+
+        batch_size = _extract_batch_size()
+        token_shape_expected = (int(token_hw_mem[0]), int(token_hw_mem[1]))
 
         for label in labels:
             files = listing.get("classes", {}).get(label, {}).get("files", []) or []
-            for fn in files:
-                item: dict[str, Any] = {
-                    "label": label,
-                    "filename": fn,
-                    "mm_per_px": None,
-                    "score": None,
-                    "threshold": float(thr) if thr is not None else None,
-                    "regions": [],
-                    "n_regions": 0,
-                    "error": None,
-                }
-                try:
-                    p = store.resolve_dataset_file_existing(role_id, roi_id, label, fn, recipe_id=recipe_resolved)
-                    if p is None:
-                        raise FileNotFoundError("file not found")
-
-                    meta = store.load_dataset_meta(role_id, roi_id, label, fn, recipe_id=recipe_resolved, default={}) or {}
-                    mm_value = meta.get("mm_per_px", default_mm_per_px)
-                    if mm_value is None:
-                        raise ValueError("mm_per_px missing and default_mm_per_px not provided")
-                    mm = _validate_mm_per_px(mm_value)
-
-                    shape_obj = _parse_shape_value(meta.get("shape_json"))
-                    img = _read_image_path(p)
-
-                    engine = InferenceEngine(
-                        _extractor,
-                        mem,
-                        token_hw_mem,
-                        mm_per_px=float(mm),
-                        memory_metadata=metadata,
-                    )
+            for start in range(0, len(files), batch_size):
+                # 1) Cargar imágenes + meta del lote (errores por item)
+                pending: list[tuple[dict[str, Any], float, Optional[Dict[str, Any]], bytes, np.ndarray]] = []
+                for fn in files[start:start + batch_size]:
+                    item: dict[str, Any] = {
+                        "label": label,
+                        "filename": fn,
+                        "mm_per_px": None,
+                        "score": None,
+                        "threshold": float(thr) if thr is not None else None,
+                        "regions": [],
+                        "n_regions": 0,
+                        "error": None,
+                    }
+                    items.append(item)
+                    try:
+                        p = store.resolve_dataset_file_existing(role_id, roi_id, label, fn, recipe_id=recipe_resolved)
+                        if p is None:
+                            raise FileNotFoundError("file not found")
+
+                        meta = store.load_dataset_meta(role_id, roi_id, label, fn, recipe_id=recipe_resolved, default={}) or {}
+                        mm_value = meta.get("mm_per_px", default_mm_per_px)
+                        if mm_value is None:
+                            raise ValueError("mm_per_px missing and default_mm_per_px not provided")
+                        mm = _validate_mm_per_px(mm_value)
+
+                        shape_obj = _parse_shape_value(meta.get("shape_json"))
+                        data = p.read_bytes()
+                        pending.append((item, float(mm), shape_obj, data, _decode_image_bytes(data, p.name)))
+                    except Exception as exc:
+                        item["error"] = str(exc)
+                        n_errors += 1
 
-                    token_shape_expected = (int(token_hw_mem[0]), int(token_hw_mem[1]))
-                    res = engine.run(
-                        img,
-                        token_shape_expected=token_shape_expected,
-                        shape=shape_obj,
-                        threshold=thr,
-                        area_mm2_thr=float(area_mm2_thr),
-                        score_percentile=int(p_score),
-                    )
+                if not pending:
+                    continue
 
-                    heat_u8 = res.get("heatmap_u8")
-                    heatmap_png_b64 = None
-                    if include_heatmap and heat_u8 is not None:
-                        heat_u8 = np.asarray(heat_u8, dtype=np.uint8)
-                        try:
-                            ok, buf = cv2.imencode(".png", heat_u8)
-                            if ok:
-                                heatmap_png_b64 = base64_from_bytes(buf.tobytes())
-                        except Exception:
-                            from PIL import Image
-                            import io
-                            im = Image.fromarray(heat_u8)
-                            bio = io.BytesIO()
-                            im.save(bio, format="PNG")
-                            heatmap_png_b64 = base64_from_bytes(bio.getvalue())
-
-                    regions = res.get("regions", []) or []
-                    item.update(
-                        {
-                            "mm_per_px": float(mm),
-                            "score": float(res.get("score", 0.0)),
-                            "regions": regions,
-                            "n_regions": len(regions),
-                        }
+                # 2) Un forward del extractor por lote (solo para las imágenes sin caché)
+                try:
+                    batch_features, hits = _extract_dataset_cached(
+                        role_id,
+                        roi_id,
+                        recipe_resolved,
+                        [(data, item["filename"], img) for item, _, _, data, img in pending],
+                        batch_size,
                     )
-                    if include_heatmap:
-                        item["heatmap_png_base64"] = heatmap_png_b64
+                    n_cache_hits += hits
                 except Exception as exc:
-                    item["error"] = str(exc)
-                    n_errors += 1
-                items.append(item)
+                    for item, *_ in pending:
+                        item["error"] = str(exc)
+                        n_errors += 1
+                    continue
+
+                # 3) kNN + posproceso por imagen
+                for (item, mm, shape_obj, _, img), features in zip(pending, batch_features):
+                    try:
+                        engine = InferenceEngine(
+                            _extractor,
+                            mem,
+                            token_hw_mem,
+                            mm_per_px=float(mm),
+                            k=knn_k,
+                            memory_metadata=metadata,
+                            aggregation=knn_aggregation,
+                            **_post_settings(),
+                        )
+
+                        res = engine.run(
+                            img,
+                            token_shape_expected=token_shape_expected,
+                            shape=shape_obj,
+                            threshold=thr,
+                            area_mm2_thr=float(area_mm2_thr),
+                            score_percentile=int(p_score),
+                            features=features,
+                            output="full" if include_heatmap else "regions",
+                        )
+
+                        heat_u8 = res.get("heatmap_u8")
+                        heatmap_png_b64 = None
+                        if include_heatmap and heat_u8 is not None:
+                            heatmap_png_b64 = _heatmap_png_b64(heat_u8)
+
+                        regions = res.get("regions", []) or []
+                        item.update(
+                            {
+                                "mm_per_px": float(mm),
+                                "score": float(res.get("score", 0.0)),
+                                "regions": regions,
+                                "n_regions": len(regions),
+                            }
+                        )
+                        if include_heatmap:
+                            item["heatmap_png_base64"] = heatmap_png_b64
+                    except Exception as exc:
+                        item["error"] = str(exc)
+                        n_errors += 1
 
         return {
             "status": "ok",
@@ -1804,6 +2464,7 @@ def infer_dataset(payload: Dict[str, Any], request: Request):
             "request_id": request_id,
             "n_total": len(items),
             "n_errors": n_errors,
+            "embedding_cache_hits": n_cache_hits,
             "items": items,
         }
     except HTTPException:
@@ -1844,60 +2505,109 @@ def calibrate_dataset(payload: Dict[str, Any], request: Request):
         area_mm2_thr = float(payload.get("area_mm2_thr", SETTINGS.get("inference", {}).get("area_mm2_thr", 1.0)))
         default_mm_per_px = payload.get("default_mm_per_px")
         require_ng = bool(payload.get("require_ng", True))
+        # k / agregación del score: se guardan en la calibración y /infer los reutiliza
+        knn_k, knn_aggregation = _knn_settings(payload)
 
         cached = _get_patchcore_memory_cached(role_id, roi_id, recipe_id=recipe_resolved, model_key=model_key)
         if cached is None:
             raise HTTPException(status_code=400, detail="Memoria no encontrada. Ejecuta /fit_ok antes de /calibrate_dataset.")
         mem, token_hw_mem, metadata = cached
+        mismatch = _extractor_mismatch(metadata)
+        if mismatch:
+            raise HTTPException(status_code=400, detail=mismatch)
 
         listing = store.list_dataset(role_id, roi_id, recipe_id=recipe_resolved)
         ok_files = listing.get("classes", {}).get("ok", {}).get("files", []) or []
         ng_files = listing.get("classes", {}).get("ng", {}).get("files", []) or []
 
-        ok_scores: list[float] = []
-        ng_scores: list[float] = []
-
-        def _score_for(label: str, filename: str) -> Optional[float]:
-            try:
-                p = store.resolve_dataset_file_existing(role_id, roi_id, label, filename, recipe_id=recipe_resolved)
-                if p is None:
-                    return None
-                meta = store.load_dataset_meta(role_id, roi_id, label, filename, recipe_id=recipe_resolved, default={}) or {}
-                mm_value = meta.get("mm_per_px", default_mm_per_px)
-                if mm_value is None:
-                    return None
-                mm = _validate_mm_per_px(mm_value)
-                shape_obj = _parse_shape_value(meta.get("shape_json"))
-                img = _read_image_path(p)
-                engine = InferenceEngine(
-                    _extractor,
-                    mem,
-                    token_hw_mem,
-                    mm_per_px=float(mm),
-                    memory_metadata=metadata,
-                )
-                token_shape_expected = (int(token_hw_mem[0]), int(token_hw_mem[1]))
-                res = engine.run(
-                    img,
-                    token_shape_expected=token_shape_expected,
-                    shape=shape_obj,
-                    threshold=None,
-                    area_mm2_thr=float(area_mm2_thr),
-                    score_percentile=int(score_percentile),
-                )
-                return float(res.get("score", 0.0))
-            except Exception:
-                return None
-
-        for fn in ok_files:
-            score = _score_for("ok", fn)
-            if score is not None:
-                ok_scores.append(score)
+        batch_size = _extract_batch_size()
+        token_shape_expected = (int(token_hw_mem[0]), int(token_hw_mem[1]))
 
-        for fn in ng_files:
-            score = _score_for("ng", fn)
-            if score is not None:
-                ng_scores.append(score)
+        # Memoria float16/sq8: se puntúa también contra búsqueda exacta sobre el coreset float32 sin
+        # redondear (referencia guardada en el fit; memorias sin ella no informan la desviación)
+        ref_mem: Optional[PatchCoreMemory] = None
+        if getattr(mem, "precision", "float32") != "float32":
+            mem_path = store.resolve_memory_path_existing(role_id, roi_id, recipe_id=recipe_resolved, model_key=model_key)
+            reference = (
+                store.load_memory_reference(mem_path, expected_shape=tuple(mem.emb.shape)) if mem_path is not None else None
+            )
+            if reference is not None:
+                ref_mem = PatchCoreMemory(np.asarray(reference, dtype=np.float32), coreset_rate=mem.coreset_rate)
+        score_diffs: list[float] = []
+
+        def _scores_for(label: str, filenames: list[str]) -> list[float]:
+            scores: list[float] = []
+            for start in range(0, len(filenames), batch_size):
+                pending: list[tuple[float, Optional[Dict[str, Any]], bytes, str, np.ndarray]] = []
+                for filename in filenames[start:start + batch_size]:
+                    try:
+                        p = store.resolve_dataset_file_existing(role_id, roi_id, label, filename, recipe_id=recipe_resolved)
+                        if p is None:
+                            continue
+                        meta = store.load_dataset_meta(role_id, roi_id, label, filename, recipe_id=recipe_resolved, default={}) or {}
+                        mm_value = meta.get("mm_per_px", default_mm_per_px)
+                        if mm_value is None:
+                            continue
+                        mm = _validate_mm_per_px(mm_value)
+                        shape_obj = _parse_shape_value(meta.get("shape_json"))
+                        data = p.read_bytes()
+                        pending.append((float(mm), shape_obj, data, p.name, _decode_image_bytes(data, p.name)))
+                    except Exception:
+                        continue
+                if not pending:
+                    continue
+                try:
+                    batch_features, _ = _extract_dataset_cached(
+                        role_id,
+                        roi_id,
+                        recipe_resolved,
+                        [(data, name, img) for _, _, data, name, img in pending],
+                        batch_size,
+                    )
+                except Exception:
+                    continue
+                for (mm, shape_obj, _, _, img), features in zip(pending, batch_features):
+                    try:
+                        engine = InferenceEngine(
+                            _extractor,
+                            mem,
+                            token_hw_mem,
+                            mm_per_px=float(mm),
+                            k=knn_k,
+                            memory_metadata=metadata,
+                            aggregation=knn_aggregation,
+                            **_post_settings(),
+                        )
+                        res = engine.run(
+                            img,
+                            token_shape_expected=token_shape_expected,
+                            shape=shape_obj,
+                            threshold=None,
+                            area_mm2_thr=float(area_mm2_thr),
+                            score_percentile=int(score_percentile),
+                            features=features,
+                            output="score",
+                        )
+                        scores.append(float(res.get("score", 0.0)))
+                        if ref_mem is not None:
+                            engine.memory = ref_mem
+                            res_ref = engine.run(
+                                img,
+                                token_shape_expected=token_shape_expected,
+                                shape=shape_obj,
+                                threshold=None,
+                                area_mm2_thr=float(area_mm2_thr),
+                                score_percentile=int(score_percentile),
+                                features=features,
+                                output="score",
+                            )
+                            score_diffs.append(scores[-1] - float(res_ref.get("score", 0.0)))
+                    except Exception:
+                        continue
+            return scores
+
+        ok_scores = _scores_for("ok", ok_files)
+        ng_scores = _scores_for("ng", ng_files)
 
         if not ok_scores:
             raise HTTPException(status_code=400, detail="No valid OK samples for calibration.")
@@ -1909,11 +2619,25 @@ def calibrate_dataset(payload: Dict[str, Any], request: Request):
             np.asarray(ng_scores, dtype=float) if ng_scores else None,
             percentile=score_percentile,
         )
+        precision_deviation: Optional[Dict[str, Any]] = None
+        if ref_mem is not None and score_diffs:
+            diffs = np.abs(np.asarray(score_diffs, dtype=np.float64))
+            precision_deviation = {
+                "precision": mem.precision,
+                "n_images": int(diffs.size),
+                "max_abs": float(diffs.max()),
+                "mean_abs": float(diffs.mean()),
+                # Desviación relativa al umbral calibrado (lo que puede cambiar una decisión)
+                "max_rel_threshold": float(diffs.max() / t) if t > 0 else None,
+            }
 
         calib = {
             "threshold": float(t),
             "score_percentile": int(score_percentile),
             "area_mm2_thr": float(area_mm2_thr),
+            "knn_k": int(knn_k),
+            "knn_aggregation": knn_aggregation,
+            "precision_deviation": precision_deviation,
             "recipe_id": recipe_resolved,
             "role_id": role_id,
             "roi_id": roi_id,
@@ -1928,6 +2652,9 @@ def calibrate_dataset(payload: Dict[str, Any], request: Request):
             "threshold": float(t),
             "score_percentile": int(score_percentile),
             "area_mm2_thr": float(area_mm2_thr),
+            "knn_k": int(knn_k),
+            "knn_aggregation": knn_aggregation,
+            "precision_deviation": precision_deviation,
             "n_ok": len(ok_scores),
             "n_ng": len(ng_scores),
             "request_id": request_id,
@@ -1951,6 +2678,166 @@ def calibrate_dataset(payload: Dict[str, Any], request: Request):
         )
         return JSONResponse(status_code=500, content={"error": str(e), "request_id": request_id2, "recipe_id": recipe_id2})
 
+@app.post("/extractor/drift")
+def extractor_drift(payload: Dict[str, Any], request: Request):
+    """
+    Mide la deriva del extractor optimizado (p.ej. quantize=int8) frente a la referencia fp32
+    sobre las imágenes del dataset de una ROI: estadísticas de embedding por token y, si la ROI
+    tiene memoria, desplazamiento del score y decisiones que cambian con el umbral calibrado.
+    """
+    try:
+        _raw_recipe = payload.get("recipe_id")
+        recipe_from_payload = _raw_recipe if isinstance(_raw_recipe, str) else None
+        request_id, recipe_resolved = _resolve_request_context(request, recipe_from_payload)
+
+        role_id = payload["role_id"]
+        roi_id = payload["roi_id"]
+        model_key = payload.get("model_key") or roi_id
+        _attach_request_context(
+            request,
+            request_id=request_id,
+            recipe_id=recipe_resolved,
+            role_id=role_id,
+            roi_id=roi_id,
+            model_key=model_key,
+        )
+        labels = payload.get("labels") or ["ok", "ng"]
+        max_images = int(payload.get("max_images", 32))
+        default_mm_per_px = payload.get("default_mm_per_px")
+
+        quantize = getattr(_extractor, "quantize", "none")
+        backend_name = getattr(_extractor, "backend", "eager")
+        if quantize == "none" and backend_name == "eager":
+            raise HTTPException(
+                status_code=400,
+                detail="El extractor es fp32 eager: no hay deriva que medir (BDI_EXTRACTOR_QUANTIZE / BDI_EXTRACTOR_BACKEND).",
+            )
+
+        # 1) Conjunto de referencia: imágenes del dataset de la ROI
+        listing = store.list_dataset(role_id, roi_id, recipe_id=recipe_resolved)
+        refs: list[tuple[str, str, float | None, Optional[Dict[str, Any]], np.ndarray]] = []
+        for label in labels:
+            for fn in listing.get("classes", {}).get(label, {}).get("files", []) or []:
+                if len(refs) >= max_images:
+                    break
+                p = store.resolve_dataset_file_existing(role_id, roi_id, label, fn, recipe_id=recipe_resolved)
+                if p is None:
+                    continue
+                meta = store.load_dataset_meta(role_id, roi_id, label, fn, recipe_id=recipe_resolved, default={}) or {}
+                mm_value = meta.get("mm_per_px", default_mm_per_px)
+                mm = _validate_mm_per_px(mm_value) if mm_value is not None else None
+                refs.append((label, fn, mm, _parse_shape_value(meta.get("shape_json")), _read_image_path(p)))
+        if not refs:
+            raise HTTPException(status_code=400, detail="No hay imágenes en el dataset para medir la deriva.")
+
+        # 2) Embeddings optimizados vs referencia fp32
+        batch_size = _extract_batch_size()
+        images = [img for *_, img in refs]
+        t_enc = time.perf_counter()
+        candidate = _extractor.extract_batch(images, batch_size=batch_size)
+        encode_ms = int((time.perf_counter() - t_enc) * 1000)
+        t_ref = time.perf_counter()
+        reference = _extractor.extract_reference_batch(images, batch_size=batch_size)
+        reference_ms = int((time.perf_counter() - t_ref) * 1000)
+        response: Dict[str, Any] = {
+            "status": "ok",
+            "quantize": quantize,
+            "backend": backend_name,
+            "n_images": len(refs),
+            "embedding": embedding_drift(reference, candidate),
+            "timings_ms": {"encode": encode_ms, "encode_reference": reference_ms},
+            "scores": None,
+            "request_id": request_id,
+            "recipe_id": recipe_resolved,
+            "role_id": role_id,
+            "roi_id": roi_id,
+            "model_key": model_key,
+        }
+
+        # 3) Desplazamiento del score contra la memoria de la ROI (si existe)
+        cached = _get_patchcore_memory_cached(role_id, roi_id, recipe_id=recipe_resolved, model_key=model_key)
+        if cached is not None:
+            mem, token_hw_mem, metadata = cached
+            calib = _get_calib_cached(role_id, roi_id, recipe_id=recipe_resolved, model_key=model_key) or {}
+            thr = calib.get("threshold")
+            thr = float(thr) if thr is not None and float(thr) > 0 else None
+            inference_cfg = SETTINGS.get("inference", {})
+            area_mm2_thr = float(calib.get("area_mm2_thr", inference_cfg.get("area_mm2_thr", 1.0)))
+            p_score = int(calib.get("score_percentile", inference_cfg.get("score_percentile", 99)))
+            knn_k, knn_aggregation = _knn_settings(calib)
+            items: list[dict[str, Any]] = []
+            for (label, fn, mm, shape_obj, img), feat_ref, feat_cand in zip(refs, reference, candidate):
+                if mm is None:
+                    continue
+                engine = InferenceEngine(
+                    _extractor,
+                    mem,
+                    token_hw_mem,
+                    mm_per_px=float(mm),
+                    k=knn_k,
+                    memory_metadata=metadata,
+                    aggregation=knn_aggregation,
+                    **_post_settings(),
+                )
+                pair = []
+                for features in (feat_ref, feat_cand):
+                    res = engine.run(
+                        img,
+                        token_shape_expected=(int(token_hw_mem[0]), int(token_hw_mem[1])),
+                        shape=shape_obj,
+                        threshold=None,
+                        area_mm2_thr=area_mm2_thr,
+                        score_percentile=p_score,
+                        features=features,
+                        output="score",
+                    )
+                    pair.append(float(res.get("score", 0.0)))
+                items.append({"label": label, "filename": fn, "score_reference": pair[0], "score": pair[1]})
+            if items:
+                delta = np.asarray([it["score"] - it["score_reference"] for it in items], dtype=np.float64)
+                response["scores"] = {
+                    "n": len(items),
+                    "threshold": thr,
+                    "mean_delta": float(delta.mean()),
+                    "mean_abs_delta": float(np.abs(delta).mean()),
+                    "max_abs_delta": float(np.abs(delta).max()),
+                    "max_abs_delta_rel_threshold": (float(np.abs(delta).max() / thr) if thr else None),
+                    "decision_flips": (
+                        int(sum((it["score"] >= thr) != (it["score_reference"] >= thr) for it in items)) if thr else None
+                    ),
+                    "items": items,
+                }
+
+        diag_event(
+            "extractor.drift",
+            request_id=request_id,
+            recipe_id=recipe_resolved,
+            role_id=role_id,
+            roi_id=roi_id,
+            model_key=model_key,
+            quantize=quantize,
+            backend=backend_name,
+            n_images=len(refs),
+            embedding=response["embedding"],
+            max_abs_delta=(response["scores"] or {}).get("max_abs_delta"),
+        )
+        return response
+    except HTTPException:
+        raise
+    except (KeyError, ValueError) as e:
+        request_id2, recipe_id2 = _resolve_request_context_safe(
+            request,
+            payload.get("recipe_id") if isinstance(payload, dict) else None,
+        )
+        return JSONResponse(status_code=400, content={"error": str(e), "request_id": request_id2, "recipe_id": recipe_id2})
+    except Exception as e:
+        request_id2, recipe_id2 = _resolve_request_context_safe(
+            request,
+            payload.get("recipe_id") if isinstance(payload, dict) else None,
+        )
+        return JSONResponse(status_code=500, content={"error": str(e), "request_id": request_id2, "recipe_id": recipe_id2})
+
+
 @app.post("/datasets/ok/upload")
 async def datasets_ok_upload(
     request: Request,
@@ -2305,6 +3192,35 @@ def datasets_clear_class(request: Request, role_id: str, roi_id: str, label: str
     return {"cleared": n, "label": label, "request_id": request_id, "recipe_id": recipe_resolved}
 
 
+@app.delete("/datasets/embedding_cache")
+def datasets_clear_embedding_cache(
+    request: Request, role_id: str, roi_id: str, stale_only: bool = True, recipe_id: Optional[str] = None
+):
+    request_id, recipe_resolved = _resolve_request_context(request, recipe_id)
+    _attach_request_context(
+        request,
+        request_id=request_id,
+        recipe_id=recipe_resolved,
+        role_id=role_id,
+        roi_id=roi_id,
+    )
+    # stale_only: conserva las entradas de la configuración actual del extractor
+    keep_key = _embedding_cache_key() if stale_only else None
+    if stale_only and keep_key is None:
+        return {"cleared": 0, "request_id": request_id, "recipe_id": recipe_resolved}
+    n = store.clear_embedding_cache(role_id, roi_id, recipe_id=recipe_resolved, keep_key=keep_key)
+    slog(
+        "datasets.clear_embedding_cache",
+        role_id=role_id,
+        roi_id=roi_id,
+        recipe_id=recipe_resolved,
+        request_id=request_id,
+        stale_only=bool(stale_only),
+        cleared=int(n),
+    )
+    return {"cleared": n, "request_id": request_id, "recipe_id": recipe_resolved}
+
+
 if __name__ == "__main__":
     if not logging.getLogger().handlers:
         logging.basicConfig(level=logging.INFO)
@@ -4,6 +4,8 @@ from typing import Optional
 
 import numpy as np
 
+from .utils import masked_percentiles
+
 
 def _as_1d_finite(arr) -> np.ndarray:
     """Coerce scores input into a 1D float array and drop NaN/Inf."""
@@ -29,13 +31,13 @@ def choose_threshold(ok_scores: np.ndarray, ng_scores: Optional[np.ndarray] = No
     if ok.size == 0:
         raise ValueError("Se requiere al menos 1 score OK para calibrar")
 
-    p_ok = float(np.percentile(ok, percentile))
+    p_ok = float(masked_percentiles(ok, [percentile])[0])
 
     ng = _as_1d_finite(ng_scores)
     if ng.size == 0:
         return p_ok
 
-    p_ng = float(np.percentile(ng, 5))
+    p_ng = float(masked_percentiles(ng, [5])[0])
 
     if p_ng <= p_ok:
         return p_ok * 1.02  # pequeño margen
@@ -24,9 +24,45 @@ DEFAULTS: Dict[str, Any] = {
     "models_dir": _env("BDI_MODELS_DIR", "BRAKEDISC_MODELS_DIR", "models"),
     "inference": {
         "coreset_rate": float(_env("BDI_CORESET_RATE", "BRAKEDISC_CORESET_RATE", "0.10")),
+        # Proyección aleatoria para la selección del coreset (0 = sin proyección, p.ej. 128)
+        "coreset_projection_dim": int(_env("BDI_CORESET_PROJECTION_DIM", None, "0")),
+        # Índice kNN de la memoria: flat (exacto) | ivf_flat | ivf_pq | hnsw (+ parámetros JSON,
+        # p.ej. '{"nlist": 1024, "nprobe": 16}' o '{"M": 32, "efSearch": 64}')
+        "index_type": _env("BDI_INDEX_TYPE", None, "flat"),
+        "index_params": _env("BDI_INDEX_PARAMS", None, ""),
+        # Precisión de la memoria: float32 | float16 | sq8 (8 bits por dimensión en la búsqueda)
+        "memory_precision": _env("BDI_MEMORY_PRECISION", None, "float32"),
+        # Score kNN por token: k vecinos + agregación min | mean | reweight (la calibración de la ROI manda)
+        "knn_k": int(_env("BDI_KNN_K", None, "1")),
+        "knn_aggregation": _env("BDI_KNN_AGGREGATION", None, "min"),
+        # Posproceso del heatmap: full (a resolución del ROI) | grid (blur/percentil/umbral en una
+        # rejilla de lado BDI_POST_GRID px, 0 = grid de tokens; solo se reescalan las regiones)
+        "post_mode": _env("BDI_POST_MODE", None, "full"),
+        "post_grid": int(_env("BDI_POST_GRID", None, "256")),
         "score_percentile": int(_env("BDI_SCORE_PERCENTILE", "BRAKEDISC_SCORE_PERCENTILE", "99")),
         "area_mm2_thr": float(_env("BDI_AREA_MM2_THR", "BRAKEDISC_AREA_MM2_THR", "1.0")),
     },
+    "features": {
+        "batch_size": int(_env("BDI_EXTRACT_BATCH_SIZE", None, "8")),
+        # Capas intermedias del ViT (el forward se detiene en la última): "9,10,11" | "6,7,8" ...
+        "layers": _env("BDI_FEATURE_LAYERS", None, "9,10,11"),
+        # Preprocesado: pil (histórico) | torch (GPU) | cv2 (CPU) | auto
+        "preprocess": _env("BDI_PREPROCESS", None, "pil"),
+        # Backend del forward: eager | compile | torchscript | onnx (+ ruta del artefacto exportado)
+        "backend": _env("BDI_EXTRACTOR_BACKEND", None, "eager"),
+        "backend_path": _env("BDI_EXTRACTOR_BACKEND_PATH", None, ""),
+        "backend_threads": int(_env("BDI_EXTRACTOR_BACKEND_THREADS", None, "0")),
+        # Cuantización del extractor en CPU: none | int8 (dinámica sobre Linear)
+        "quantize": _env("BDI_EXTRACTOR_QUANTIZE", None, "none"),
+        # Caché persistente de embeddings del dataset (hash de imagen + config del extractor)
+        "embedding_cache": _env("BDI_EMBEDDING_CACHE", None, "1"),
+        # Pool de extractores: dispositivos separados por coma (vacío = auto) y slots por dispositivo
+        "devices": _env("BDI_EXTRACTOR_DEVICES", None, ""),
+        "concurrency": int(_env("BDI_EXTRACTOR_CONCURRENCY", None, "1")),
+        # Micro-batching de /infer (0 ms = desactivado)
+        "microbatch_max_wait_ms": float(_env("BDI_MICROBATCH_MAX_WAIT_MS", None, "0")),
+        "microbatch_max_size": int(_env("BDI_MICROBATCH_MAX_SIZE", None, "8")),
+    },
     "training": {
         "min_ok_samples": int(_env("BDI_MIN_OK_SAMPLES", None, "10")),
         "dataset_only": _env("BDI_TRAIN_DATASET_ONLY", None, "1"),
@@ -36,6 +72,8 @@ DEFAULTS: Dict[str, Any] = {
         "gpu_device": int(_env("BDI_FAISS_GPU_DEVICE", None, "0")),
         "require_faiss": _env("BDI_FAISS_REQUIRE", None, "0"),
         "allow_sklearn_fallback": _env("BDI_FAISS_ALLOW_SKLEARN_FALLBACK", None, "1"),
+        # Búsqueda exacta sin FAISS: numpy (matmul por bloques) | sklearn
+        "knn_fallback": _env("BDI_KNN_FALLBACK", None, "numpy"),
     },
 }
 
@@ -0,0 +1,235 @@
+"""
+Backends alternativos (AOT / compilados) para el forward de DinoV2Features.
+
+El grafo exportado es el mismo que DinoV2Features._forward_tokens_stateless para el tamaño
+fijo input_size x input_size: patch_embed -> CLS + pos_embed (ya interpolado) -> bloques hasta
+max(out_indices) -> concat de las capas pedidas sin CLS. Entrada (B,3,S,S) ya preprocesada,
+salida (B,N,C) con N = (S/patch)^2, igual que el camino eager.
+
+Backends:
+  - "eager":       sin backend (DinoV2Features usa su forward normal)
+  - "compile":     torch.compile del grafo (PyTorch >= 2)
+  - "torchscript": torch.jit.trace del grafo (o carga de un .pt ya exportado)
+  - "onnx":        ONNX Runtime con CPUExecutionProvider (carga un .onnx; lo exporta si falta)
+
+Uso como script (p.ej. desde scripts/export_onnx.ps1):
+    python -m backend.extractor_backends --backend onnx --out models/dinov2_448.onnx
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, cast
+
+import torch
+import torch.nn as nn
+
+log = logging.getLogger(__name__)
+
+BACKENDS = ("eager", "compile", "torchscript", "onnx")
+
+# Umbral de paridad por defecto (coseno mínimo por token frente al forward eager)
+PARITY_MIN_COSINE = 0.999
+
+TokenRunner = Callable[[torch.Tensor], torch.Tensor]
+
+
+class TokenGraph(nn.Module):
+    """Forward de tokens intermedios para un grid fijo, sin estado mutable (exportable)."""
+
+    def __init__(self, model: nn.Module, pos_embed: torch.Tensor, out_indices, n_prefix: int = 1) -> None:
+        super().__init__()
+        m = cast(Any, model)
+        take = sorted({int(i) for i in out_indices}) if out_indices else []
+        if not take:
+            raise ValueError("TokenGraph requiere out_indices")
+        self.proj = m.patch_embed.proj
+        self.pe_norm = m.patch_embed.norm
+        self.cls_token = m.cls_token
+        self.norm_pre = m.norm_pre
+        # Solo los bloques necesarios: los posteriores a max(out_indices) no afectan a la salida
+        self.blocks = nn.ModuleList(list(m.blocks)[: take[-1] + 1])
+        self.register_buffer("pos_embed", pos_embed.detach().clone(), persistent=False)
+        self.take = take
+        self.n_prefix = int(n_prefix)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        t = self.proj(x).flatten(2).transpose(1, 2)            # (B,N,C)
+        t = self.pe_norm(t)
+        cls = self.cls_token.expand(t.shape[0], -1, -1)
+        t = torch.cat([cls, t], dim=1) + self.pos_embed       # (B,1+N,C)
+        t = self.norm_pre(t)
+        outputs = []
+        for i, blk in enumerate(self.blocks):
+            t = blk(t)
+            if i in self.take:
+                outputs.append(t[:, self.n_prefix:])
+        return torch.cat(outputs, dim=-1)                      # (B,N,sumC)
+
+
+def build_token_graph(features: Any) -> TokenGraph:
+    """Construye el grafo fijo (input_size x input_size) a partir de un DinoV2Features."""
+    if not getattr(features, "_stateless", False):
+        raise RuntimeError("El modelo no admite el forward sin estado; no se puede exportar")
+    if getattr(features, "dynamic_input", False):
+        raise RuntimeError("Los backends AOT requieren dynamic_input=False (entrada fija)")
+    size = int(features.input_size)
+    grid = size // int(features.patch)
+    base = cast(torch.Tensor, features._pos_embed_base)
+    pos = features._cached_pos_embed(grid, grid, base.device, base.dtype)
+    n_prefix = int(getattr(features.model, "num_prefix_tokens", 1))
+    return TokenGraph(features.model, pos, features.out_indices, n_prefix=n_prefix).eval()
+
+
+def _example_input(features: Any, batch: int = 1) -> torch.Tensor:
+    size = int(features.input_size)
+    gen = torch.Generator().manual_seed(0)
+    return torch.randn(batch, 3, size, size, generator=gen).to(features.device)
+
+
+def export_torchscript(features: Any, path: str | Path) -> Path:
+    graph = build_token_graph(features)
+    with torch.inference_mode():
+        traced = torch.jit.trace(graph, _example_input(features), check_trace=False)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    traced.save(str(path))
+    return path
+
+
+def export_onnx(features: Any, path: str | Path, opset: int = 17) -> Path:
+    graph = build_token_graph(features).cpu()
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with torch.inference_mode():
+        torch.onnx.export(
+            graph,
+            (_example_input(features).cpu(),),
+            str(path),
+            input_names=["x"],
+            output_names=["tokens"],
+            dynamic_axes={"x": {0: "batch"}, "tokens": {0: "batch"}},
+            opset_version=int(opset),
+            dynamo=False,
+        )
+    return path
+
+
+def _onnx_runner(path: Path, threads: int = 0) -> TokenRunner:
+    try:
+        import onnxruntime as ort  # type: ignore
+    except Exception as exc:
+        raise RuntimeError("onnxruntime no está instalado (pip install onnxruntime)") from exc
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads > 0:
+        opts.intra_op_num_threads = int(threads)
+    session = ort.InferenceSession(str(path), sess_options=opts, providers=["CPUExecutionProvider"])
+    input_name = session.get_inputs()[0].name
+
+    def run(x: torch.Tensor) -> torch.Tensor:
+        # InferenceSession.run es thread-safe: varias peticiones pueden compartir la sesión
+        out = session.run(None, {input_name: x.detach().float().cpu().numpy()})[0]
+        return torch.from_numpy(out).to(x.device)
+
+    return run
+
+
+def load_backend(features: Any, backend: str, path: str | Path | None = None, *, threads: int = 0) -> Optional[TokenRunner]:
+    """
+    Devuelve un callable x(B,3,S,S) -> tokens(B,N,C) para el backend pedido (None para "eager").
+    Para "torchscript"/"onnx" carga `path` si existe; si no, exporta ahí (o a memoria si path es None).
+    """
+    backend = (backend or "eager").strip().lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"backend debe ser uno de {BACKENDS}")
+    if backend == "eager":
+        return None
+
+    if backend == "compile":
+        compiled = torch.compile(build_token_graph(features), dynamic=False)
+        lock = threading.Lock()
+        warmed = False
+
+        def run_compiled(x: torch.Tensor) -> torch.Tensor:
+            nonlocal warmed
+            if not warmed:
+                # La primera llamada compila: serializarla evita compilaciones duplicadas
+                with lock:
+                    out = compiled(x)
+                    warmed = True
+                    return out
+            return compiled(x)
+
+        return run_compiled
+
+    if backend == "torchscript":
+        if path is not None and Path(path).exists():
+            module = torch.jit.load(str(path), map_location=features.device)
+        elif path is not None:
+            module = torch.jit.load(str(export_torchscript(features, path)), map_location=features.device)
+        else:
+            with torch.inference_mode():
+                module = torch.jit.trace(build_token_graph(features), _example_input(features), check_trace=False)
+        module.eval()
+        return cast(TokenRunner, module)
+
+    # onnx
+    if features.device.type != "cpu":
+        log.warning("[features] backend onnx usa CPUExecutionProvider; device=%s", features.device)
+    if path is None:
+        raise ValueError("El backend onnx requiere una ruta (BDI_EXTRACTOR_BACKEND_PATH)")
+    onnx_path = Path(path)
+    if not onnx_path.exists():
+        export_onnx(features, onnx_path)
+    return _onnx_runner(onnx_path, threads=threads)
+
+
+@torch.inference_mode()
+def parity_check(features: Any, runner: TokenRunner, x: torch.Tensor | None = None) -> Dict[str, Any]:
+    """
+    Compara el runner con el forward eager (DinoV2Features._forward_tokens_stateless) sobre `x`
+    (por defecto una entrada aleatoria fija). Devuelve diferencias absolutas y coseno por token.
+    """
+    if x is None:
+        x = _example_input(features)
+    ref = features._forward_tokens_stateless(x).float()
+    got = runner(x).float()
+    if tuple(got.shape) != tuple(ref.shape):
+        return {"ok": False, "error": f"shape {tuple(got.shape)} != {tuple(ref.shape)}"}
+    diff = (got - ref).abs()
+    cos = torch.nn.functional.cosine_similarity(got, ref, dim=-1)
+    cosine_min = float(cos.min())
+    return {
+        "ok": cosine_min >= PARITY_MIN_COSINE,
+        "max_abs": float(diff.max()),
+        "mean_abs": float(diff.mean()),
+        "cosine_min": cosine_min,
+        "cosine_mean": float(cos.mean()),
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    from backend.features import DinoV2Features
+
+    ap = argparse.ArgumentParser(description="Exporta el extractor DINOv2 (448) y comprueba la paridad con eager")
+    ap.add_argument("--backend", choices=("torchscript", "onnx"), default="onnx")
+    ap.add_argument("--out", required=True)
+    ap.add_argument("--model", default="vit_small_patch14_dinov2.lvd142m")
+    ap.add_argument("--input-size", type=int, default=448)
+    ap.add_argument("--device", default="cpu")
+    args = ap.parse_args(argv)
+
+    features = DinoV2Features(model_name=args.model, input_size=args.input_size, patch_size=14, device=args.device)
+    out = export_onnx(features, args.out) if args.backend == "onnx" else export_torchscript(features, args.out)
+    runner = load_backend(features, args.backend, out)
+    report = parity_check(features, cast(TokenRunner, runner))
+    print(json.dumps({"path": str(out), "backend": args.backend, "parity": report}, indent=2))
+    return 0 if report.get("ok") else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+
+@dataclass
+class _Replica:
+    extractor: Any
+    device: str
+    slot: int
+    stream: Any | None = None  # torch.cuda.Stream en réplicas CUDA
+    active: bool = False
+    served: int = 0
+    busy_s: float = 0.0
+    last_start: float | None = None
+    errors: int = 0
+
+
+class ExtractorPool:
+    """
+    Pool de réplicas de DinoV2Features con un planificador "least-loaded".
+
+      - Una instancia de DinoV2Features (pesos propios) por dispositivo.
+      - `concurrency` slots por dispositivo: comparten pesos (el forward es re-entrante) y,
+        en CUDA, cada slot usa su propio stream para solapar forwards en la misma GPU.
+      - Cada slot atiende una petición a la vez; si todos están ocupados la petición espera
+        en cola (queue_depth) hasta que se libera uno.
+
+    Expone la misma API que el extractor (extract / extract_batch) y delega el resto de
+    atributos (model_name, input_size, patch, get_metadata, ...) en la primera réplica.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[str], Any],
+        devices: Sequence[str],
+        *,
+        concurrency: int = 1,
+    ) -> None:
+        if not devices:
+            raise ValueError("ExtractorPool requiere al menos un dispositivo")
+        self._replicas: List[_Replica] = []
+        per_device = max(1, int(concurrency))
+        for device in devices:
+            extractor = factory(device)
+            use_streams = str(device).startswith("cuda") and torch.cuda.is_available() and per_device > 1
+            for slot in range(per_device):
+                stream = torch.cuda.Stream(device=torch.device(device)) if use_streams else None
+                self._replicas.append(_Replica(extractor=extractor, device=str(device), slot=slot, stream=stream))
+        self._cond = threading.Condition()
+        self._waiting = 0
+        self._max_waiting = 0
+        self._started = time.perf_counter()
+
+    # ---------------- delegación ----------------
+    def __getattr__(self, name: str) -> Any:
+        # Solo se llama si el atributo no existe en el pool: delegar en la réplica principal
+        replicas = self.__dict__.get("_replicas")
+        if not replicas:
+            raise AttributeError(name)
+        return getattr(replicas[0].extractor, name)
+
+    @property
+    def primary(self) -> Any:
+        return self._replicas[0].extractor
+
+    # ---------------- planificador ----------------
+    def _pick_idle(self) -> Optional[_Replica]:
+        idle = [r for r in self._replicas if not r.active]
+        if not idle:
+            return None
+        # Menos slots activos en el mismo dispositivo primero; a igualdad, el menos usado
+        active_per_device: Dict[str, int] = {}
+        for r in self._replicas:
+            if r.active:
+                active_per_device[r.device] = active_per_device.get(r.device, 0) + 1
+        return min(idle, key=lambda r: (active_per_device.get(r.device, 0), r.busy_s, r.served))
+
+    @contextmanager
+    def acquire(self) -> Iterator[_Replica]:
+        with self._cond:
+            replica = self._pick_idle()
+            if replica is None:
+                self._waiting += 1
+                self._max_waiting = max(self._max_waiting, self._waiting)
+                try:
+                    while replica is None:
+                        self._cond.wait()
+                        replica = self._pick_idle()
+                finally:
+                    self._waiting -= 1
+            replica.active = True
+            replica.last_start = time.perf_counter()
+        try:
+            yield replica
+        except Exception:
+            with self._cond:
+                replica.errors += 1
+            raise
+        finally:
+            with self._cond:
+                start = replica.last_start or time.perf_counter()
+                replica.busy_s += time.perf_counter() - start
+                replica.served += 1
+                replica.last_start = None
+                replica.active = False
+                self._cond.notify()
+
+    def _run(self, fn: Callable[[Any], Any]) -> Any:
+        with self.acquire() as replica:
+            stream_ctx = torch.cuda.stream(replica.stream) if replica.stream is not None else nullcontext()
+            with stream_ctx:
+                out = fn(replica.extractor)
+            if replica.stream is not None:
+                replica.stream.synchronize()
+            return out
+
+    # ---------------- API del extractor ----------------
+    def extract(self, img) -> Tuple[np.ndarray, Tuple[int, int]]:
+        return self._run(lambda ext: ext.extract(img))
+
+    def extract_batch(self, images: Sequence[Any], batch_size: int = 8) -> List[Tuple[np.ndarray, Tuple[int, int]]]:
+        return self._run(lambda ext: ext.extract_batch(images, batch_size=batch_size))
+
+    # ---------------- métricas ----------------
+    def stats(self) -> Dict[str, Any]:
+        now = time.perf_counter()
+        elapsed = max(now - self._started, 1e-9)
+        with self._cond:
+            replicas = []
+            for r in self._replicas:
+                busy = r.busy_s + ((now - r.last_start) if r.last_start is not None else 0.0)
+                replicas.append(
+                    {
+                        "device": r.device,
+                        "slot": r.slot,
+                        "stream": r.stream is not None,
+                        "active": bool(r.active),
+                        "served": int(r.served),
+                        "errors": int(r.errors),
+                        "utilization": round(min(1.0, busy / elapsed), 4),
+                    }
+                )
+            return {
+                "n_replicas": len(self._replicas),
+                "devices": sorted({r.device for r in self._replicas}),
+                "in_flight": sum(1 for r in self._replicas if r.active),
+                "queue_depth": int(self._waiting),
+                "max_queue_depth": int(self._max_waiting),
+                "replicas": replicas,
+            }
+
+
+def parse_devices(raw: str | Sequence[str] | None, default: str) -> List[str]:
+    """'cuda:0,cuda:1' -> ['cuda:0', 'cuda:1']; vacío -> [default]."""
+    if raw is None:
+        return [default]
+    items = raw.split(",") if isinstance(raw, str) else list(raw)
+    devices = [str(d).strip() for d in items if str(d).strip()]
+    return devices or [default]
@@ -1,12 +1,14 @@
-# backend/features.py  (Option 2 robust: resize pos_embed manually + reset each call)
+# backend/features.py  (Option 2 robust: resize pos_embed manually, cached per token grid)
 from __future__ import annotations
 
+import copy
 import io
 import inspect
 import logging
 import threading
+from collections import OrderedDict
 from contextlib import nullcontext
-from typing import Any, Iterable, Optional, Tuple, Union, cast
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple, Union, cast
 
 import numpy as np
 from PIL import Image
@@ -16,11 +18,22 @@ import torch.nn as nn
 import torch.nn.functional as F
 import timm
 
+from .extractor_backends import BACKENDS, load_backend, parity_check
+
 log = logging.getLogger(__name__)
 
 # Pillow compatibility: Image.Resampling exists in newer versions.
 _BICUBIC = getattr(getattr(Image, "Resampling", Image), "BICUBIC")
 
+# Máximo de grids distintos con pos_embed cacheado (solo crece con dynamic_input=True)
+_POS_EMBED_CACHE_MAX = 8
+
+# Modos de preprocesado (letterbox + normalización)
+_PREPROCESS_MODES = ("pil", "torch", "cv2", "auto")
+
+# Cuantización del extractor: "int8" = dinámica sobre nn.Linear (solo CPU)
+_QUANTIZE_MODES = ("none", "int8")
+
 
 class DinoV2Features:
     """
@@ -28,11 +41,20 @@ class DinoV2Features:
       - LETTERBOX (mantener aspecto + padding) a input_size
       - Tamaño de entrada controlado (fijo o dinámico múltiplo de patch)
       - *Opción 2*: redimensionado del positional embedding **manual** (sin timm.resize_pos_embed)
-      - *Reset* del pos_embed original en **cada** `extract()` para evitar acumulación
+      - pos_embed interpolado siempre desde el original (sin acumulación) y cacheado por grid
+      - preprocess="pil" (histórico) | "torch" (letterbox+normalización en el device) |
+        "cv2" (letterbox OpenCV en CPU) | "auto" (torch en CUDA, cv2 en el resto)
+      - backend="eager" | "compile" | "torchscript" | "onnx": grafo AOT para la entrada fija
+        (ver extractor_backends.py); se valida contra eager al cargar y, si no cuadra, se usa eager
+      - quantize="int8": cuantización dinámica int8 de las capas Linear (CPU); se conserva el
+        modelo fp32 como referencia para medir la deriva (extract_reference_batch + utils.embedding_drift)
 
     extract(img) -> (embedding_numpy, (h_tokens, w_tokens))
       - pool="none" -> (HW, C)  (todos los tokens)  [recomendado para PatchCore/coreset]
       - pool="mean" -> (1,  C)  (media de tokens)
+
+    extract_batch(imgs, batch_size) -> [(embedding_numpy, (h_tokens, w_tokens)), ...]
+      - misma salida que extract() por imagen, pero con un forward del ViT por lote
     """
 
     def __init__(
@@ -46,11 +68,16 @@ class DinoV2Features:
         pool: str = "none",                     # "none" | "mean"
         dynamic_input: bool = False,            # False => fuerza tamaño fijo; True => acepta HxW múltiplos de patch
         patch_size: Optional[int] = None,       # si se pasa, fuerza el valor de patch
+        preprocess: str = "pil",                # "pil" | "torch" | "cv2" | "auto"
+        backend: str = "eager",                 # "eager" | "compile" | "torchscript" | "onnx"
+        backend_path: Optional[str] = None,     # .pt / .onnx exportado (se exporta si no existe)
+        backend_threads: int = 0,               # hilos intra-op de ONNX Runtime (0 = por defecto)
+        quantize: str = "none",                 # "none" | "int8" (dinámica, CPU)
         **_,
     ) -> None:
         self.model_name = model_name
         self.input_size = int(input_size)
-        self.out_indices = list(out_indices) if out_indices else []
+        self.out_indices = [int(i) for i in out_indices] if out_indices else []
         self.dynamic_input = bool(dynamic_input)
 
         # --- resolver device (soporta "auto") ---
@@ -86,6 +113,14 @@ class DinoV2Features:
             raise ValueError("pool debe ser 'none' o 'mean'")
         self.pool = pool
 
+        # validar preprocess ("auto" se resuelve con el device ya conocido)
+        preprocess = (preprocess or "pil").strip().lower()
+        if preprocess not in _PREPROCESS_MODES:
+            raise ValueError(f"preprocess debe ser uno de {_PREPROCESS_MODES}")
+        if preprocess == "auto":
+            preprocess = "torch" if self.device.type == "cuda" else "cv2"
+        self.preprocess = preprocess
+
         # --- modelo ---
         self.model: nn.Module = timm.create_model(self.model_name, pretrained=True)
         self.model.eval().to(self.device)
@@ -121,8 +156,79 @@ class DinoV2Features:
             self._pos_embed_base = pe2_tensor.detach().clone()
         else:
             self._pos_embed_base = None
-        # Lock to make extract() thread-safe inside one uvicorn worker
+        # pos_embed ya interpolados por (h_tokens, w_tokens, device, dtype)
+        self._pos_embed_cache: "OrderedDict[tuple, nn.Parameter]" = OrderedDict()
+        self._pos_lock = threading.Lock()
+        # Lock only for the legacy timm path (_prepare_input_size mutates the shared model).
+        # The stateless path (_forward_tokens_stateless) runs without it, so concurrent
+        # requests in one uvicorn worker can run forward passes in parallel.
         self._lock = threading.RLock()
+        self._stateless = self._supports_stateless_forward()
+        self.n_blocks_run = self._truncate_blocks()
+
+        # Cuantización dinámica opcional (antes del backend: el grafo AOT usa el modelo cuantizado)
+        quantize = (quantize or "none").strip().lower()
+        if quantize not in _QUANTIZE_MODES:
+            raise ValueError(f"quantize debe ser uno de {_QUANTIZE_MODES}")
+        self.quantize = "none"
+        self._model_fp32: Optional[nn.Module] = None
+        if quantize == "int8":
+            if self.device.type != "cpu":
+                log.warning("[features] quantize=int8 solo se aplica en CPU (device=%s); se ignora", self.device)
+            else:
+                self._model_fp32 = self.model
+                self.model = torch.ao.quantization.quantize_dynamic(
+                    copy.deepcopy(self.model), {nn.Linear}, dtype=torch.qint8
+                ).eval()
+                self.quantize = "int8"
+
+        # Backend AOT opcional (solo para la entrada fija input_size x input_size)
+        self.backend = "eager"
+        self.backend_parity: Optional[dict] = None
+        self._runner = None
+        backend = (backend or "eager").strip().lower()
+        if backend not in BACKENDS:
+            raise ValueError(f"backend debe ser uno de {BACKENDS}")
+        if backend != "eager":
+            self._init_backend(backend, backend_path, int(backend_threads or 0))
+
+    def _truncate_blocks(self) -> int:
+        """
+        Con out_indices, los bloques posteriores a max(out_indices) (y la norm/head finales) no
+        influyen en la salida: se eliminan del modelo para no calcularlos ni tenerlos en memoria.
+        Devuelve el número de bloques que ejecuta cada forward.
+        """
+        blocks = getattr(self.model, "blocks", None)
+        if not isinstance(blocks, nn.Sequential):
+            return 0
+        n_blocks = len(blocks)
+        if not self.out_indices:
+            return n_blocks
+        bad = [i for i in self.out_indices if not 0 <= int(i) < n_blocks]
+        if bad:
+            raise ValueError(f"out_indices fuera de rango para {n_blocks} bloques: {bad}")
+        last = max(int(i) for i in self.out_indices)
+        if self._stateless and last + 1 < n_blocks:
+            cast(Any, self.model).blocks = nn.Sequential(*list(blocks)[: last + 1])
+            log.info("[features] forward truncado: %s/%s bloques (out_indices=%s)", last + 1, n_blocks, self.out_indices)
+            return last + 1
+        return n_blocks
+
+    def _init_backend(self, backend: str, path: Optional[str], threads: int) -> None:
+        try:
+            runner = load_backend(self, backend, path, threads=threads)
+            report = parity_check(self, runner)
+        except Exception as exc:
+            log.warning("[features] backend %s no disponible (%s); se usa eager", backend, exc)
+            self.backend_parity = {"ok": False, "backend": backend, "error": str(exc)}
+            return
+        self.backend_parity = {"backend": backend, **report}
+        if not report.get("ok"):
+            log.warning("[features] backend %s no supera la paridad con eager (%s); se usa eager", backend, report)
+            return
+        self._runner = runner
+        self.backend = backend
+        log.info("[features] backend %s activo (paridad: %s)", backend, report)
 
 
     # ---------------- imagen / preprocesado ----------------
@@ -144,24 +250,57 @@ class DinoV2Features:
             return Image.fromarray(arr.astype(np.uint8), mode="RGB")
         raise TypeError(f"Tipo de imagen no soportado: {type(img)}")
 
+    @staticmethod
+    def _to_u8_array(img) -> Tuple[np.ndarray, bool]:
+        """
+        Devuelve (HxWx3 uint8, is_bgr). Los ndarray BGR de OpenCV se devuelven tal cual
+        (sin copia); el giro de canales se hace después, ya en el device.
+        """
+        if isinstance(img, np.ndarray) and img.ndim in (2, 3):
+            arr = img if img.dtype == np.uint8 else img.astype(np.uint8)
+            if arr.ndim == 2:
+                return np.stack([arr] * 3, axis=-1), False
+            if arr.shape[-1] == 3:
+                return arr, True
+        return np.asarray(DinoV2Features._to_pil(img)), False
+
+    def _letterbox_geometry(self, h: int, w: int) -> Tuple[int, int, int, int]:
+        """(nh, nw, top, left) del letterbox a input_size x input_size (mismo redondeo que PIL)."""
+        target = int(self.input_size)
+        scale = min(target / w, target / h)
+        nw, nh = int(round(w * scale)), int(round(h * scale))
+        return nh, nw, (target - nh) // 2, (target - nw) // 2
+
+    def _u8_to_unit(self, t: torch.Tensor, is_bgr: bool) -> torch.Tensor:
+        """(H,W,3) uint8 ya en el device -> (1,3,H,W) float32 RGB en [0,1]."""
+        x = t.permute(2, 0, 1).unsqueeze(0)
+        if is_bgr:
+            x = x.flip(1)  # BGR -> RGB
+        # Mantener preprocesado siempre en FP32 (más estable).
+        return x.float().div_(255.0)
+
     def _preprocess(self, img) -> torch.Tensor:
         """
         Preprocesa aplicando LETTERBOX (mantener aspecto + padding) a input_size x input_size
         si dynamic_input=False. Si dynamic_input=True se hace letterbox igualmente aquí para
         garantizar cuadrado; luego _prepare_input_size decidirá si mantener HxW.
         """
+        if self.preprocess == "torch":
+            return self._preprocess_torch(img)
+        if self.preprocess == "cv2":
+            return self._preprocess_cv2(img)
+        return self._preprocess_pil(img)
+
+    def _preprocess_pil(self, img) -> torch.Tensor:
         pil = self._to_pil(img)
 
         # --- LETTERBOX (mantener aspecto + padding a cuadrado) ---
         if self.input_size and self.input_size > 0:
             target = int(self.input_size)
             w, h = pil.size
-            scale = min(target / w, target / h)
-            nw, nh = int(round(w * scale)), int(round(h * scale))
+            nh, nw, top, left = self._letterbox_geometry(h, w)
             pil_resized = pil.resize((nw, nh), _BICUBIC)
             canvas = Image.new("RGB", (target, target), (0, 0, 0))
-            left = (target - nw) // 2
-            top = (target - nh) // 2
             canvas.paste(pil_resized, (left, top))
             pil = canvas  # ahora es exactamente target x target
 
@@ -172,13 +311,44 @@ class DinoV2Features:
         x = (x - self.mean) / self.std
         return x
 
+    def _preprocess_torch(self, img) -> torch.Tensor:
+        """Sube el recorte uint8 una vez; resize bicúbico (antialias), padding y normalización en el device."""
+        arr, is_bgr = self._to_u8_array(img)
+        x = self._u8_to_unit(torch.from_numpy(np.ascontiguousarray(arr)).to(self.device), is_bgr)
+        if self.input_size and self.input_size > 0:
+            target = int(self.input_size)
+            h, w = arr.shape[:2]
+            nh, nw, top, left = self._letterbox_geometry(h, w)
+            if (nh, nw) != (h, w):
+                x = F.interpolate(x, size=(nh, nw), mode="bicubic", align_corners=False, antialias=True)
+                x = x.clamp_(0.0, 1.0)  # como la saturación a uint8 de PIL
+            x = F.pad(x, (left, target - nw - left, top, target - nh - top), value=0.0)
+        return (x - self.mean) / self.std
+
+    def _preprocess_cv2(self, img) -> torch.Tensor:
+        """Letterbox con OpenCV en CPU (sin PIL ni conversiones intermedias); normalización en el device."""
+        import cv2
+
+        arr, is_bgr = self._to_u8_array(img)
+        if self.input_size and self.input_size > 0:
+            target = int(self.input_size)
+            h, w = arr.shape[:2]
+            nh, nw, top, left = self._letterbox_geometry(h, w)
+            if (nh, nw) != (h, w):
+                interp = cv2.INTER_AREA if nh < h else cv2.INTER_CUBIC
+                arr = cv2.resize(arr, (nw, nh), interpolation=interp)
+            arr = cv2.copyMakeBorder(
+                arr, top, target - nh - top, left, target - nw - left, cv2.BORDER_CONSTANT, value=(0, 0, 0)
+            )
+        x = self._u8_to_unit(torch.from_numpy(np.ascontiguousarray(arr)).to(self.device), is_bgr)
+        return (x - self.mean) / self.std
+
     # ---------------- tamaño de entrada ----------------
-    def _prepare_input_size(self, model: nn.Module, x: torch.Tensor):
+    def _resize_input(self, x: torch.Tensor) -> torch.Tensor:
         """
+        Ajusta (B,3,H,W) al tamaño de entrada del ViT sin tocar el modelo:
         - dynamic_input=False -> fuerza siempre (input_size, input_size)
-        - dynamic_input=True  -> acepta HxW actuales si son múltiplos de self.patch;
-                                 si no, redimensiona a input_size.
-        En ambos casos, sincroniza patch_embed/img_size del ViT y adapta pos_embed.
+        - dynamic_input=True  -> acepta HxW actuales si son múltiplos de self.patch
         """
         target_h = int(self.input_size)
         target_w = int(self.input_size)
@@ -187,14 +357,21 @@ class DinoV2Features:
         if self.dynamic_input:
             # Aceptar tamaño actual solo si cuadra con el patch
             if (H % self.patch == 0) and (W % self.patch == 0):
-                pass  # mantener H, W
-            else:
-                x = F.interpolate(x, size=(target_h, target_w), mode="bilinear", align_corners=False)
-                H, W = target_h, target_w
-        else:
-            if (H, W) != (target_h, target_w):
-                x = F.interpolate(x, size=(target_h, target_w), mode="bilinear", align_corners=False)
-                H, W = target_h, target_w
+                return x
+            return F.interpolate(x, size=(target_h, target_w), mode="bilinear", align_corners=False)
+        if (H, W) != (target_h, target_w):
+            return F.interpolate(x, size=(target_h, target_w), mode="bilinear", align_corners=False)
+        return x
+
+    def _prepare_input_size(self, model: nn.Module, x: torch.Tensor):
+        """
+        - dynamic_input=False -> fuerza siempre (input_size, input_size)
+        - dynamic_input=True  -> acepta HxW actuales si son múltiplos de self.patch;
+                                 si no, redimensiona a input_size.
+        En ambos casos, sincroniza patch_embed/img_size del ViT y adapta pos_embed.
+        """
+        x = self._resize_input(x)
+        H, W = x.shape[-2:]
 
         # Sincronizar ViT/timm
         pe = getattr(model, "patch_embed", None)
@@ -220,14 +397,41 @@ class DinoV2Features:
     def _reset_and_resize_pos_embed(self, h_tokens: int, w_tokens: int):
         if self._pos_embed_base is None:
             return
-        with torch.no_grad():
-            # Reset al "de fábrica"
-            base = self._pos_embed_base.to(self.model.pos_embed.device, dtype=self.model.pos_embed.dtype)
-            self.model.pos_embed = nn.Parameter(base.clone(), requires_grad=False)
+        current = getattr(self.model, "pos_embed", None)
+        if not isinstance(current, torch.Tensor):
+            return
+        cached = self._cached_pos_embed(int(h_tokens), int(w_tokens), current.device, current.dtype)
+        if current is not cached:
+            self.model.pos_embed = cached
+
+    def _cached_pos_embed(
+        self, h_tokens: int, w_tokens: int, device: torch.device, dtype: torch.dtype
+    ) -> nn.Parameter:
+        # El pos_embed interpolado se cachea por (grid, device, dtype): producción usa siempre
+        # el mismo grid (p.ej. 32x32 con input_size=448), así que tras la primera llamada solo
+        # se reutiliza el Parameter ya calculado (sin clonar/interpolar/reservar memoria).
+        key = (int(h_tokens), int(w_tokens), str(device), dtype)
+        with self._pos_lock:
+            cached = self._pos_embed_cache.get(key)
+            if cached is None:
+                cached = nn.Parameter(
+                    self._interpolate_pos_embed(int(h_tokens), int(w_tokens), device, dtype),
+                    requires_grad=False,
+                )
+                self._pos_embed_cache[key] = cached
+                while len(self._pos_embed_cache) > _POS_EMBED_CACHE_MAX:
+                    self._pos_embed_cache.popitem(last=False)
+            else:
+                self._pos_embed_cache.move_to_end(key)
+            return cached
 
-            pos = self.model.pos_embed  # (1, 1+HW, C)
-            if not isinstance(pos, torch.Tensor):
-                return
+    def _interpolate_pos_embed(
+        self, h_tokens: int, w_tokens: int, device: torch.device, dtype: torch.dtype
+    ) -> torch.Tensor:
+        """Interpola el pos_embed "de fábrica" al grid (h_tokens, w_tokens). Devuelve (1, 1+HW, C)."""
+        assert self._pos_embed_base is not None
+        with torch.no_grad():
+            pos = self._pos_embed_base.to(device, dtype=dtype)  # (1, 1+HW, C)
             cls, grid = pos[:, :1], pos[:, 1:]                   # (1,1,C) y (1,HW,C)
 
             # grid actual del pos_embed (g_old x g_old)
@@ -245,8 +449,7 @@ class DinoV2Features:
             new_grid = new_2d.permute(0, 2, 3, 1).reshape(B, h_tokens * w_tokens, C).contiguous()
 
             # Concatenar CLS
-            new_pos = torch.cat([cls, new_grid], dim=1)
-            self.model.pos_embed = nn.Parameter(new_pos, requires_grad=False)
+            return torch.cat([cls, new_grid], dim=1)
 
     # ---------------- compat capas intermedias ----------------
     def _call_get_intermediate_layers_compat(
@@ -282,7 +485,123 @@ class DinoV2Features:
             return fn(x, n)
 
     # ---------------- tokens ----------------
-    def _forward_tokens(
+    def _supports_stateless_forward(self) -> bool:
+        """
+        True si el modelo es un ViT timm estándar (CLS + pos_embed con entrada para CLS) y tiene
+        todos los submódulos que usa _forward_tokens_stateless.
+        """
+        m = self.model
+        pe = getattr(m, "patch_embed", None)
+        modules = (
+            getattr(pe, "proj", None),
+            getattr(pe, "norm", None),
+            getattr(m, "pos_drop", None),
+            getattr(m, "patch_drop", None),
+            getattr(m, "norm_pre", None),
+            getattr(m, "norm", None),
+        )
+        return (
+            self._pos_embed_base is not None
+            and pe is not None
+            and all(isinstance(mod, nn.Module) for mod in modules)
+            and bool(getattr(pe, "flatten", True))
+            and isinstance(getattr(m, "blocks", None), nn.Sequential)
+            and getattr(m, "cls_token", None) is not None
+            and getattr(m, "reg_token", None) is None
+            and not bool(getattr(m, "no_embed_class", False))
+            and not bool(getattr(m, "dynamic_img_size", False))
+        )
+
+    @staticmethod
+    def _combine_layers(normed: list[torch.Tensor], combine: str) -> torch.Tensor:
+        if combine == "concat":
+            return torch.cat(normed, dim=-1)       # (B,N, sumC)
+        if combine == "mean":
+            stk = torch.stack(normed, dim=0)       # (L,B,N,C)
+            return stk.mean(dim=0)                 # (B,N,C)
+        if combine == "stack":
+            stk = torch.stack(normed, dim=-1)      # (B,N,C,L)
+            b, n, c, l = stk.shape
+            return stk.reshape(b, n, c * l)        # (B,N,C*L)
+        raise ValueError("combine debe ser 'concat', 'mean' o 'stack'")
+
+    def _forward_tokens(self, x: torch.Tensor, *, combine: str = "concat") -> torch.Tensor:
+        """
+        Devuelve tokens como (B, N, C_out) para x ya preprocesado.
+
+        Usa el camino sin estado (re-entrante, sin lock) si el modelo lo admite;
+        si no, el camino timm original bajo self._lock.
+        """
+        if self._runner is not None and combine == "concat":
+            x = self._resize_input(x)
+            if tuple(x.shape[-2:]) == (self.input_size, self.input_size):
+                amp_ctx = (
+                    torch.autocast(device_type="cuda", dtype=torch.float16)
+                    if self.use_amp and self.device.type == "cuda"
+                    else nullcontext()
+                )
+                with amp_ctx:
+                    return self._runner(x)
+        if self._stateless:
+            return self._forward_tokens_stateless(self._resize_input(x), combine=combine)
+        with self._lock:
+            return self._forward_tokens_timm(x, combine=combine)
+
+    def _forward_tokens_stateless(
+        self,
+        x: torch.Tensor,
+        *,
+        combine: str = "concat",
+        model: Optional[nn.Module] = None,     # None => self.model (p.ej. la referencia fp32)
+    ) -> torch.Tensor:
+        """
+        Forward del ViT sin mutar el modelo compartido: el grid y el pos_embed se pasan como
+        estado de la llamada (equivalente a get_intermediate_layers / forward_features de timm).
+        Varias llamadas pueden ejecutarse a la vez sobre los mismos pesos (o en distintos CUDA streams).
+        """
+        m = cast(Any, model if model is not None else self.model)
+        H, W = x.shape[-2:]
+        htok, wtok = H // self.patch, W // self.patch
+        base = cast(torch.Tensor, self._pos_embed_base)
+        pos = self._cached_pos_embed(htok, wtok, base.device, base.dtype)  # (1, 1+N, C)
+
+        amp_ctx = (
+            torch.autocast(device_type="cuda", dtype=torch.float16)
+            if self.use_amp and self.device.type == "cuda"
+            else nullcontext()
+        )
+        with amp_ctx:
+            pe = m.patch_embed
+            t = pe.proj(x)                                    # (B,C,Ht,Wt)
+            if tuple(t.shape[-2:]) != (htok, wtok):
+                raise RuntimeError(
+                    f"TokenShape mismatch: grid={tuple(t.shape[-2:])} esperado={(htok, wtok)} (patch={self.patch})"
+                )
+            t = t.flatten(2).transpose(1, 2)                  # (B,N,C)
+            t = pe.norm(t)
+            cls = m.cls_token.expand(t.shape[0], -1, -1)
+            t = torch.cat([cls, t], dim=1) + pos              # (B,1+N,C)
+            t = m.pos_drop(t)
+            t = m.patch_drop(t)
+            t = m.norm_pre(t)
+
+            n_prefix = int(getattr(m, "num_prefix_tokens", 1))
+            take = set(self.out_indices)
+            last = max(take) if take else len(m.blocks) - 1
+            outputs: list[torch.Tensor] = []
+            for i, blk in enumerate(m.blocks):
+                t = blk(t)
+                if i in take:
+                    outputs.append(t[:, n_prefix:])
+                if i >= last:
+                    break  # ni bloques posteriores ni norm/head: no afectan a la salida
+
+            if not outputs:
+                # Sin capas intermedias: equivalente a forward_features (bloques + norm final)
+                return m.norm(t)[:, n_prefix:]
+            return self._combine_layers(outputs, combine)
+
+    def _forward_tokens_timm(
         self,
         x: torch.Tensor,
         *,
@@ -292,7 +611,8 @@ class DinoV2Features:
         combine: str = "concat",                # "concat" | "mean" | "stack"
     ) -> torch.Tensor:
         """
-        Devuelve tokens como (N, C_out) con N = Htok*Wtok.
+        Camino timm original (muta patch_embed/pos_embed del modelo: llamar con self._lock).
+        Devuelve tokens como (B, N, C_out) con N = Htok*Wtok.
         """
         def _expected_grid(batched_x: torch.Tensor) -> tuple[int, int, int]:
             H, W = batched_x.shape[-2:]
@@ -352,20 +672,7 @@ class DinoV2Features:
                                 raise RuntimeError(f"Tipo inesperado en capa {li}: {type(layer)}")
                             normed.append(_as_BxNC(layer, expected_N))
 
-                        # Combinar capas
-                        if combine == "concat":
-                            out = torch.cat(normed, dim=-1)       # (B,N, sumC)
-                        elif combine == "mean":
-                            stk = torch.stack(normed, dim=0)      # (L,B,N,C)
-                            out = stk.mean(dim=0)                 # (B,N,C)
-                        elif combine == "stack":
-                            stk = torch.stack(normed, dim=-1)     # (B,N,C,L)
-                            b, n, c, l = stk.shape
-                            out = stk.reshape(b, n, c * l)        # (B,N,C*L)
-                        else:
-                            raise ValueError("combine debe ser 'concat', 'mean' o 'stack'")
-
-                        return out[0]  # (N, C_out)
+                        return self._combine_layers(normed, combine)  # (B, N, C_out)
                 except Exception as ex:
                     # Fallback limpio a forward_features
                     log.debug("[features] fallback intermedias -> forward_features: %s", ex)
@@ -392,11 +699,10 @@ class DinoV2Features:
                 t = cast(torch.Tensor, feats_any)
 
         if t.ndim == 3:          # (B,N,C) posiblemente con CLS
-            t = _as_BxNC(t, expected_N)
-            return t[0]          # (N,C)
+            return _as_BxNC(t, expected_N)
         elif t.ndim == 4:        # (B,C,H,W)
             b, c, h, w = t.shape
-            return t.permute(0, 2, 3, 1).reshape(b, h * w, c)[0]  # (N,C)
+            return t.permute(0, 2, 3, 1).reshape(b, h * w, c)  # (B,N,C)
         else:
             raise RuntimeError(f"Forma inesperada de features: {t.shape}")
 
@@ -413,6 +719,10 @@ class DinoV2Features:
             "dynamic_input": bool(self.dynamic_input),
             "out_indices": list(self.out_indices) if self.out_indices else [],
             "pool": self.pool,
+            "preprocess": self.preprocess,
+            "backend": self.backend,
+            "quantize": self.quantize,
+            "n_blocks_run": int(self.n_blocks_run),
         }
 
     def assert_token_shape(self, expected: Tuple[int, int], got: Tuple[int, int], ctx: str = ""):
@@ -425,42 +735,107 @@ class DinoV2Features:
     # ---------------- API pública ----------------
     @torch.inference_mode()
     def extract(self, img):
-        with self._lock:
-            x = self._preprocess(img)
-            x, how = self._prepare_input_size(self.model, x)
-            model_param = next(self.model.parameters(), None)
-            model_dtype = model_param.dtype if model_param is not None else None
-            log.info(
-                "[features] dtypes: x=%s model=%s use_amp=%s",
-                x.dtype,
-                model_dtype,
-                self.use_amp,
-            )
-            H, W = x.shape[-2:]
-            h_tokens, w_tokens = H // self.patch, W // self.patch
-
-            # Debug útil
-            pe_n = getattr(self.model, "pos_embed", None)
-            pe_count = -1
-            if isinstance(pe_n, torch.Tensor):
-                pe_n_tensor = cast(torch.Tensor, pe_n)
-                pe_count = int(pe_n_tensor.shape[1])
-            log.debug(
-                "[features] after-prep: %sx%s (%s), patch=%s, grid=%sx%s, tokens(N+CLS)=%s, pos_embed_N=%s",
-                H,
-                W,
-                how,
-                self.patch,
-                h_tokens,
-                w_tokens,
-                h_tokens * w_tokens + 1,
-                pe_count,
-            )
+        """Re-entrante: sin lock si el modelo admite el forward sin estado (ViT timm estándar)."""
+        x = self._resize_input(self._preprocess(img))
+        model_param = next(self.model.parameters(), None)
+        model_dtype = model_param.dtype if model_param is not None else None
+        log.info(
+            "[features] dtypes: x=%s model=%s use_amp=%s",
+            x.dtype,
+            model_dtype,
+            self.use_amp,
+        )
+        H, W = x.shape[-2:]
+        h_tokens, w_tokens = H // self.patch, W // self.patch
+
+        # Debug útil
+        log.debug(
+            "[features] after-prep: %sx%s (%s), patch=%s, grid=%sx%s, tokens(N+CLS)=%s, stateless=%s",
+            H,
+            W,
+            "dynamic" if self.dynamic_input else "resize",
+            self.patch,
+            h_tokens,
+            w_tokens,
+            h_tokens * w_tokens + 1,
+            self._stateless,
+        )
+
+        tokens = self._forward_tokens(x)[0]  # (N, C)
+
+        if self.pool == "mean":
+            tokens = tokens.mean(dim=0, keepdim=True)  # (1, C)
+
+        emb_np = tokens.float().detach().cpu().numpy()
+        return emb_np, (int(h_tokens), int(w_tokens))
+
+    @torch.inference_mode()
+    def extract_batch(
+        self,
+        images: Sequence[Any],
+        batch_size: int = 8,
+    ) -> List[Tuple[np.ndarray, Tuple[int, int]]]:
+        """
+        Extrae embeddings de varias imágenes con un forward del ViT por lote.
+
+        Cada imagen se preprocesa (letterbox) igual que en extract(); las que comparten
+        tamaño tras _resize_input se apilan en un único tensor (B,3,H,W).
+        Devuelve una lista alineada con `images` de (embedding_numpy, (h_tokens, w_tokens)).
+        """
+        return self._extract_batch(images, batch_size, self._forward_tokens)
+
+    @torch.inference_mode()
+    def extract_reference_batch(
+        self,
+        images: Sequence[Any],
+        batch_size: int = 8,
+    ) -> List[Tuple[np.ndarray, Tuple[int, int]]]:
+        """
+        Como extract_batch() pero con el modelo fp32 de referencia (eager, sin backend AOT ni
+        cuantización). Sirve para medir la deriva de quantize/backend con utils.embedding_drift().
+        """
+        if not self._stateless:
+            raise RuntimeError("extract_reference_batch requiere el forward sin estado")
+        reference = self._model_fp32 if self._model_fp32 is not None else self.model
+        return self._extract_batch(
+            images,
+            batch_size,
+            lambda xb: self._forward_tokens_stateless(self._resize_input(xb), model=reference),
+        )
 
-            tokens = self._forward_tokens(x)  # (N, C)
+    def _extract_batch(
+        self,
+        images: Sequence[Any],
+        batch_size: int,
+        forward: Callable[[torch.Tensor], torch.Tensor],
+    ) -> List[Tuple[np.ndarray, Tuple[int, int]]]:
+        bs = max(1, int(batch_size))
+        results: List[Optional[Tuple[np.ndarray, Tuple[int, int]]]] = [None] * len(images)
+        for start in range(0, len(images), bs):
+            # Agrupar por tamaño: con dynamic_input=True el grid puede variar entre imágenes
+            groups: dict[Tuple[int, int], List[Tuple[int, torch.Tensor]]] = {}
+            for offset, img in enumerate(images[start:start + bs]):
+                x = self._resize_input(self._preprocess(img))
+                H, W = x.shape[-2:]
+                groups.setdefault((int(H), int(W)), []).append((start + offset, x))
+
+            for (H, W), members in groups.items():
+                h_tokens, w_tokens = H // self.patch, W // self.patch
+                xb = torch.cat([x for _, x in members], dim=0)  # (B,3,H,W)
+                log.debug(
+                    "[features] batch: n=%s size=%sx%s grid=%sx%s",
+                    xb.shape[0],
+                    H,
+                    W,
+                    h_tokens,
+                    w_tokens,
+                )
+                tokens = forward(xb)  # (B, N, C)
+                if self.pool == "mean":
+                    tokens = tokens.mean(dim=1, keepdim=True)  # (B, 1, C)
+                emb_np = tokens.float().detach().cpu().numpy()
+                for j, (idx, _) in enumerate(members):
+                    results[idx] = (emb_np[j], (int(h_tokens), int(w_tokens)))
 
-            if self.pool == "mean":
-                tokens = tokens.mean(dim=0, keepdim=True)  # (1, C)
+        return cast(List[Tuple[np.ndarray, Tuple[int, int]]], results)
 
-            emb_np = tokens.float().detach().cpu().numpy()
-            return emb_np, (int(h_tokens), int(w_tokens))
@@ -5,9 +5,12 @@ import cv2
 from typing import Tuple, Optional, Dict, Any, List
 
 from .features import DinoV2Features
-from .patchcore import PatchCoreMemory
-from .roi_mask import build_mask
-from .utils import percentile, mm2_to_px2, px2_to_mm2
+from .patchcore import KNN_AGGREGATIONS, PatchCoreMemory
+from .roi_mask import cached_mask, cached_mask_grid, cached_token_grid
+from .utils import masked_percentiles, mm2_to_px2, px2_to_mm2
+
+POST_MODES = ("full", "grid")
+OUTPUT_MODES = ("score", "regions", "full", "auto")
 
 
 class InferenceEngine:
@@ -23,14 +26,65 @@ class InferenceEngine:
                  mm_per_px: float,
                  k: int = 1,
                  score_percentile: int = 99,
-                 memory_metadata: Optional[Dict[str, Any]] = None):
+                 memory_metadata: Optional[Dict[str, Any]] = None,
+                 aggregation: str = "min",
+                 post_mode: str = "full",
+                 post_grid: int = 256):
         self.extractor = extractor
         self.memory = memory
         self.token_hw = tuple(token_hw)  # (Ht, Wt) con el que se construyó la memoria
         self.mm_per_px = float(mm_per_px)
-        self.k = int(k)
+        self.k = max(1, int(k))
+        self.aggregation = (aggregation or "min").strip().lower()
+        if self.aggregation not in KNN_AGGREGATIONS:
+            raise ValueError(f"aggregation debe ser uno de {KNN_AGGREGATIONS}")
         self.score_p = int(score_percentile)
         self.memory_metadata = memory_metadata or {}
+        # Posproceso: full (blur/percentil/umbral a resolución del ROI) | grid (sobre una rejilla
+        # reducida de lado máximo post_grid; 0 = grid de tokens) y solo se reescalan las regiones
+        self.post_mode = (post_mode or "full").strip().lower()
+        if self.post_mode not in POST_MODES:
+            raise ValueError(f"post_mode debe ser uno de {POST_MODES}")
+        self.post_grid = max(0, int(post_grid))
+
+    def _post_grid_hw(self, H: int, W: int, Ht: int, Wt: int) -> Tuple[int, int]:
+        """Tamaño (h, w) de la rejilla de posproceso: grid de tokens o ROI reducido a post_grid."""
+        if self.post_grid <= 0:
+            return int(Ht), int(Wt)
+        scale = min(1.0, float(self.post_grid) / float(max(H, W)))
+        return max(1, int(round(H * scale))), max(1, int(round(W * scale)))
+
+    @staticmethod
+    def _upsample_regions(heat_g: np.ndarray,
+                          thr_value: float,
+                          mask_bool: np.ndarray) -> np.ndarray:
+        """
+        Binario a resolución del ROI reescalando solo las zonas de la rejilla que superan el umbral.
+        Cada componente (bbox + 1 celda de margen) se interpola con el mismo muestreo que un
+        cv2.resize INTER_LINEAR global, así el resultado coincide (salvo redondeo) con reescalar
+        el heatmap entero.
+        Las componentes se buscan sin la máscara reducida (una celda mayoritariamente fuera puede
+        contener píxeles válidos); la máscara se aplica a resolución completa tras reescalar.
+        """
+        H, W = mask_bool.shape[:2]
+        gh, gw = heat_g.shape[:2]
+        bin_img = np.zeros((H, W), dtype=np.uint8)
+        bin_g = (heat_g >= thr_value).astype(np.uint8)
+        if not bin_g.any():
+            return bin_img
+        n, _, stats, _ = cv2.connectedComponentsWithStats(bin_g, connectivity=8)
+        sy, sx = gh / float(H), gw / float(W)
+        for x, y, w, h, _area in stats[1:n]:
+            gx0, gy0 = max(0, x - 1), max(0, y - 1)
+            gx1, gy1 = min(gw, x + w + 1), min(gh, y + h + 1)
+            x0, x1 = int(np.floor(gx0 / sx)), min(W, int(np.ceil(gx1 / sx)))
+            y0, y1 = int(np.floor(gy0 / sy)), min(H, int(np.ceil(gy1 / sy)))
+            if x1 <= x0 or y1 <= y0 or not mask_bool[y0:y1, x0:x1].any():
+                continue
+            win = _bilinear_window(heat_g, y0, y1, x0, x1, sy, sx)
+            hit = (win >= thr_value) & mask_bool[y0:y1, x0:x1]
+            bin_img[y0:y1, x0:x1][hit] = 255
+        return bin_img
 
     def run(self,
             img_bgr: np.ndarray,
@@ -40,7 +94,9 @@ class InferenceEngine:
             blur_sigma: float = 1.0,
             area_mm2_thr: float = 1.0,
             threshold: Optional[float] = None,
-            score_percentile: Optional[int] = None) -> Dict[str, Any]:
+            score_percentile: Optional[int] = None,
+            features: Optional[Tuple[np.ndarray, Tuple[int, int]]] = None,
+            output: str = "full") -> Dict[str, Any]:
         """
         Ejecuta una pasada de inferencia.
 
@@ -48,23 +104,33 @@ class InferenceEngine:
             img_bgr: imagen ROI en BGR (uint8).
             token_shape_expected: (Ht,Wt) esperado por la memoria. Si no coincide, se lanza ValueError.
             shape: definición de máscara ROI (rect/circle/annulus...).
-            blur_sigma: sigma del GaussianBlur para suavizado del heatmap reescalado.
+            blur_sigma: sigma del GaussianBlur (en px del ROI) para suavizado del heatmap reescalado.
             area_mm2_thr: área mínima de defectos en mm² para eliminar islas pequeñas.
             threshold: si se pasa, se segmenta el heatmap y se devuelven regiones.
             score_percentile: si se pasa, sobrescribe el percentil usado para el score global.
+            features: (embedding, (Ht,Wt)) ya extraídos (p.ej. con extract_batch); si se pasa,
+                      no se vuelve a ejecutar el extractor.
+            output: qué calcular tras el score: score (solo score) | regions (score + regiones) |
+                    full (score + regiones + heatmap) | auto (heatmap solo si score >= threshold).
 
         Returns:
             dict con:
               - score: float
               - threshold: Optional[float]
-              - heatmap_u8: np.uint8[H,W] (0..255, ya enmascarado)
-              - regions: lista de regiones (si threshold no es None)
+              - heatmap_u8: np.uint8[H,W] (0..255, ya enmascarado) o None si `output` no lo pide
+              - regions: lista de regiones (si threshold no es None y output != score)
               - token_shape: [Ht, Wt]
               - params: metadatos de ejecución
         """
+        output = (output or "full").strip().lower()
+        if output not in OUTPUT_MODES:
+            raise ValueError(f"output debe ser uno de {OUTPUT_MODES}")
         t0 = time.perf_counter()
         # 1) Embeddings del ROI canónico
-        emb, (Ht, Wt) = self.extractor.extract(img_bgr)
+        if features is not None:
+            emb, (Ht, Wt) = features
+        else:
+            emb, (Ht, Wt) = self.extractor.extract(img_bgr)
         t1 = time.perf_counter()
 
         # Validación de grid si se solicita
@@ -74,66 +140,94 @@ class InferenceEngine:
             if got != exp:
                 raise ValueError(f"Token grid mismatch: got {got}, expected {exp}")
 
-        # 2) Distancias kNN por parche (min-dist al coreset)
-        d = self.memory.knn_min_dist(emb)  # (N,)
+        # Máscara del ROI (rect/circle/annulus) si viene descrita, proyectada al grid de tokens:
+        # solo se buscan los tokens que influyen en la zona válida (interpolación + blur)
+        H, W = img_bgr.shape[:2]
+        mask, mask_bool = cached_mask(H, W, shape)  # LRU por (H, W, forma); solo lectura
+        ksize = int(max(3, round(blur_sigma * 3) * 2 + 1)) if blur_sigma and blur_sigma > 0 else 0
+        grid_mode = self.post_mode == "grid"
+        if grid_mode:
+            # El blur se hace en la rejilla reducida: sigma escalado y kernel en celdas de la rejilla
+            gh, gw = self._post_grid_hw(H, W, Ht, Wt)
+            g_scale = gw / float(W)
+            sigma_g = float(blur_sigma) * g_scale if blur_sigma and blur_sigma > 0 else 0.0
+            # Un blur sub-celda no cambia nada en la rejilla: se omite
+            ksize = int(max(3, round(sigma_g * 3) * 2 + 1)) if sigma_g >= 0.3 else 0
+            margin_px = int(np.ceil((ksize // 2 + 1) / g_scale)) if ksize else 0
+        else:
+            margin_px = ksize // 2
+        tok_sel = np.flatnonzero(cached_token_grid(H, W, shape, Ht, Wt, margin_px=margin_px)) if shape else None
+
+        # 2) Distancias kNN por parche (top-k al coreset + agregación; k=1/min = min-dist)
+        if tok_sel is None or tok_sel.size == emb.shape[0]:
+            d = self.memory.knn_scores(emb, k=self.k, aggregation=self.aggregation)  # (N,)
+        else:
+            # Tokens sin influencia en la máscara a 0 (no afectan al score ni a las regiones)
+            d = np.zeros(emb.shape[0], dtype=np.float32)
+            if tok_sel.size:
+                d[tok_sel] = self.memory.knn_scores(emb[tok_sel], k=self.k, aggregation=self.aggregation)
+        n_searched = int(emb.shape[0] if tok_sel is None else tok_sel.size)
         t2 = time.perf_counter()
         heat = d.reshape(Ht, Wt).astype(np.float32)
 
-        # 3) Reescalar a tamaño del ROI (para overlay)
-        H, W = img_bgr.shape[:2]
-        heat_up = cv2.resize(heat, (W, H), interpolation=cv2.INTER_LINEAR).astype(np.float32)
+        # 3) Reescalar a tamaño del ROI (para overlay) o, en modo grid, a la rejilla de posproceso
+        if grid_mode:
+            if (gh, gw) == (int(Ht), int(Wt)):
+                heat_up = heat
+            else:
+                heat_up = cv2.resize(heat, (gw, gh), interpolation=cv2.INTER_LINEAR).astype(np.float32)
+            # Celdas de la rejilla con al menos media celda dentro de la máscara
+            mask_proc = cached_mask_grid(H, W, shape, gh, gw)
+        else:
+            heat_up = cv2.resize(heat, (W, H), interpolation=cv2.INTER_LINEAR).astype(np.float32)
+            mask_proc = mask_bool
 
         # 4) Suavizado opcional
-        if blur_sigma and blur_sigma > 0:
-            ksize = int(max(3, round(blur_sigma * 3) * 2 + 1))
-            heat_proc = cv2.GaussianBlur(heat_up, (ksize, ksize), blur_sigma)
+        if ksize:
+            heat_proc = cv2.GaussianBlur(heat_up, (ksize, ksize), sigma_g if grid_mode else blur_sigma)
         else:
             heat_proc = heat_up
 
-        # 5) Máscara del ROI (rect/circle/annulus) si viene descrita
-        mask = build_mask(H, W, shape)
-        mask_bool = mask > 0
-
-        # 6) Score global sobre el heatmap suavizado y enmascarado
+        # 5) Score global sobre el heatmap suavizado y enmascarado
         p_use = int(score_percentile) if score_percentile is not None else self.score_p
-        valid = heat_proc[mask_bool]
-        sc = percentile(valid, p_use) if valid.size else 0.0
-
-        # 7) Generar heatmap 0..255 para visualización
-        heat_vis = np.zeros_like(heat_proc, dtype=np.float32)
-        if valid.size:
-            mn, mx = np.percentile(valid, [1, 99])
-            if mx > mn:
-                heat_vis[mask_bool] = np.clip((heat_proc[mask_bool] - mn) / (mx - mn), 0.0, 1.0)
-            else:
-                heat_vis[mask_bool] = 0.0
-        heat_u8 = (heat_vis * 255.0 + 0.5).astype(np.uint8)
-        heat_u8_masked = cv2.bitwise_and(heat_u8, heat_u8, mask=mask)
+        # Score y rango de visualización [p1, p99] en una sola extracción + np.partition
+        qs = [p_use, 1, 99] if output in ("full", "auto") else [p_use]
+        has_valid = bool(np.count_nonzero(mask_proc))
+        stats = masked_percentiles(heat_proc, qs, mask=mask_proc) if has_valid else None
+        sc = float(stats[0]) if stats is not None else 0.0
 
-        # 8) Umbral + eliminación de islas pequeñas + contornos
-        regions: List[Dict[str, Any]] = []
         thr_value = float(threshold) if threshold is not None else None
-        if thr_value is not None:
-            bin_img = np.zeros((H, W), dtype=np.uint8)
-            bin_img[mask_bool & (heat_proc >= thr_value)] = 255
+
+        # 6) Generar heatmap 0..255 para visualización (solo si la salida lo pide)
+        if output == "auto":
+            want_heatmap = thr_value is not None and float(sc) >= thr_value
+        else:
+            want_heatmap = output == "full"
+        heat_u8_masked: Optional[np.ndarray] = None
+        if want_heatmap:
+            heat_vis = np.zeros_like(heat_proc, dtype=np.float32)
+            if stats is not None:
+                mn, mx = float(stats[1]), float(stats[2])
+                if mx > mn:
+                    heat_vis[mask_proc] = np.clip((heat_proc[mask_proc] - mn) / (mx - mn), 0.0, 1.0)
+                else:
+                    heat_vis[mask_proc] = 0.0
+            heat_u8 = (heat_vis * 255.0 + 0.5).astype(np.uint8)
+            if grid_mode:
+                heat_u8 = cv2.resize(heat_u8, (W, H), interpolation=cv2.INTER_LINEAR)
+            heat_u8_masked = cv2.bitwise_and(heat_u8, heat_u8, mask=mask)
+
+        # 7) Umbral + eliminación de islas pequeñas + contornos
+        regions: List[Dict[str, Any]] = []
+        if thr_value is not None and output != "score":
+            if grid_mode:
+                bin_img = self._upsample_regions(heat_proc, thr_value, mask_bool)
+            else:
+                bin_img = np.zeros((H, W), dtype=np.uint8)
+                bin_img[mask_bool & (heat_proc >= thr_value)] = 255
             # Elimina regiones con área < área mínima (en mm² → px²)
             px_thr = mm2_to_px2(area_mm2_thr, self.mm_per_px)
-            cnts, _ = cv2.findContours(bin_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            for c in cnts:
-                area_px = cv2.contourArea(c)
-                if area_px < px_thr:
-                    cv2.drawContours(bin_img, [c], -1, 0, thickness=-1)
-            cnts, _ = cv2.findContours(bin_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            for c in cnts:
-                x, y, w, h = cv2.boundingRect(c)
-                area_px = cv2.contourArea(c)
-                regions.append({
-                    "bbox": [int(x), int(y), int(w), int(h)],
-                    "area_px": float(area_px),
-                    "area_mm2": float(px2_to_mm2(area_px, self.mm_per_px)),
-                    "contour": contour_to_list(c),
-                })
-            regions.sort(key=lambda r: r["area_px"], reverse=True)
+            regions = regions_from_binary(bin_img, px_thr, self.mm_per_px)
 
         return {
             "score": float(sc),
@@ -154,13 +248,59 @@ class InferenceEngine:
                 "coreset_rate": float(self.memory.coreset_rate) if self.memory.coreset_rate is not None else None,
                 "coreset_rate_applied": self.memory_metadata.get("applied_rate"),
                 "k": int(self.k),
+                "aggregation": self.aggregation,
+                "tokens_searched": n_searched,
                 "score_percentile": int(p_use),
                 "blur_sigma": float(blur_sigma),
+                "post_mode": self.post_mode,
+                "output": output,
                 "mm_per_px": float(self.mm_per_px),
             },
         }
 
 
+def _bilinear_window(g: np.ndarray, y0: int, y1: int, x0: int, x1: int, sy: float, sx: float) -> np.ndarray:
+    """
+    Ventana [y0:y1, x0:x1] del reescalado bilineal de `g` (muestreo de cv2.resize INTER_LINEAR:
+    centros de píxel alineados y borde replicado), separable y en float32.
+    """
+    def _axis(start: int, stop: int, scale: float, n: int):
+        f = (np.arange(start, stop, dtype=np.float64) + 0.5) * scale - 0.5
+        f = np.clip(f, 0.0, n - 1)
+        i0 = np.floor(f).astype(np.intp)
+        i1 = np.minimum(i0 + 1, n - 1)
+        return i0, i1, (f - i0).astype(np.float32)
+
+    gh, gw = g.shape[:2]
+    r0, r1, ay = _axis(y0, y1, sy, gh)
+    c0, c1, ax = _axis(x0, x1, sx, gw)
+    rows = g[r0] * (1.0 - ay)[:, None] + g[r1] * ay[:, None]
+    return rows[:, c0] * (1.0 - ax) + rows[:, c1] * ax
+
+
+def regions_from_binary(bin_img: np.ndarray, px_thr: float, mm_per_px: float) -> List[Dict[str, Any]]:
+    """
+    Regiones externas del binario en una sola pasada: findContours RETR_EXTERNAL sobre toda la
+    imagen (las islas dentro de un hueco quedan dentro de su región) y se descartan los contornos
+    cuyo contourArea no llega a `px_thr`, sin borrarlos del binario ni volver a trazarlo.
+    """
+    cnts, _ = cv2.findContours(bin_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    regions: List[Dict[str, Any]] = []
+    for c in cnts:
+        area_px = float(cv2.contourArea(c))
+        if area_px < px_thr:
+            continue
+        bx, by, bw, bh = cv2.boundingRect(c)
+        regions.append({
+            "bbox": [int(bx), int(by), int(bw), int(bh)],
+            "area_px": area_px,
+            "area_mm2": float(px2_to_mm2(area_px, mm_per_px)),
+            "contour": contour_to_list(c),
+        })
+    regions.sort(key=lambda r: r["area_px"], reverse=True)
+    return regions
+
+
 def contour_to_list(contour: np.ndarray) -> List[List[int]]:
     pts = contour.reshape(-1, 2)
     return [[int(x), int(y)] for x, y in pts]
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class MicroBatcher:
+    """
+    Micro-batching dinámico delante del extractor (opt-in).
+
+    Las peticiones concurrentes llaman a extract(img); un hilo despachador agrupa hasta
+    `max_batch` imágenes o espera como mucho `max_wait_ms` desde la primera petición del
+    lote, ejecuta un único extract_batch() y devuelve a cada llamante su (embedding, grid).
+    El kNN y el posproceso siguen ejecutándose por petición en el hilo del llamante.
+    """
+
+    def __init__(
+        self,
+        extractor: Any,
+        *,
+        max_batch: int = 8,
+        max_wait_ms: float = 5.0,
+        workers: int = 1,
+    ) -> None:
+        self.extractor = extractor
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait_s = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue: "queue.Queue[Tuple[Any, Future]]" = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._n_batches = 0
+        self._n_items = 0
+        self._max_batch_seen = 0
+        self._closed = False
+        self._threads: List[threading.Thread] = []
+        for i in range(max(1, int(workers))):
+            t = threading.Thread(target=self._loop, name=f"microbatch-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def extract(self, img, timeout: Optional[float] = None) -> Tuple[np.ndarray, Tuple[int, int]]:
+        if self._closed:
+            raise RuntimeError("MicroBatcher cerrado")
+        fut: Future = Future()
+        self._queue.put((img, fut))
+        return fut.result(timeout=timeout)
+
+    def close(self) -> None:
+        self._closed = True
+        for _ in self._threads:
+            self._queue.put((None, None))  # type: ignore[arg-type]
+
+    def _collect(self) -> List[Tuple[Any, Future]]:
+        img, fut = self._queue.get()
+        if fut is None:
+            return []
+        batch = [(img, fut)]
+        deadline = time.perf_counter() + self.max_wait_s
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item[1] is None:
+                # Reenviar la señal de cierre para que la procese el siguiente ciclo
+                self._queue.put(item)
+                break
+            batch.append(item)
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._collect()
+            if not batch:
+                return
+            live = [(img, fut) for img, fut in batch if fut.set_running_or_notify_cancel()]
+            if not live:
+                continue
+            try:
+                results = self.extractor.extract_batch([img for img, _ in live], batch_size=len(live))
+            except Exception:
+                # Un elemento defectuoso no debe hacer fallar al resto del lote: se reintenta
+                # cada imagen por separado y cada petición recibe su resultado o su excepción
+                self._run_individually(live)
+                continue
+            for (_, fut), res in zip(live, results):
+                fut.set_result(res)
+            with self._stats_lock:
+                self._n_batches += 1
+                self._n_items += len(live)
+                self._max_batch_seen = max(self._max_batch_seen, len(live))
+
+    def _run_individually(self, live: List[Tuple[Any, Future]]) -> None:
+        for img, fut in live:
+            try:
+                res = self.extractor.extract_batch([img], batch_size=1)[0]
+            except Exception as exc:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(res)
+        with self._stats_lock:
+            self._n_batches += len(live)
+            self._n_items += len(live)
+            self._max_batch_seen = max(self._max_batch_seen, 1)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "max_batch": int(self.max_batch),
+                "max_wait_ms": float(self.max_wait_s * 1000.0),
+                "pending": int(self._queue.qsize()),
+                "n_batches": int(self._n_batches),
+                "n_items": int(self._n_items),
+                "mean_batch": (float(self._n_items) / self._n_batches) if self._n_batches else 0.0,
+                "max_batch_seen": int(self._max_batch_seen),
+            }
@@ -1,8 +1,11 @@
 from __future__ import annotations
-from typing import Any
+import logging
+from typing import Any, Callable
 
 import numpy as np
 
+log = logging.getLogger(__name__)
+
 try:
     import faiss  # type: ignore
     _HAS_FAISS = True
@@ -34,68 +37,645 @@ def l2_normalize(x: np.ndarray, eps: float = 1e-8) -> np.ndarray:
     return x / n
 
 
-def kcenter_greedy(E: np.ndarray, m: int, seed: int = 0) -> np.ndarray:
-    """Coreset k-center greedy sobre embeddings ya normalizados."""
+# Filas por bloque en la actualización de distancias (float32: ~bloque x D x 4 bytes en caché)
+KCENTER_CHUNK_ROWS = 16384
+
+
+def _sq_norms(X: np.ndarray) -> np.ndarray:
+    return np.einsum("ij,ij->i", X, X)
+
+
+def _min_sq_dist_to(
+    E: np.ndarray,
+    C: np.ndarray,
+    e2: np.ndarray | None = None,
+    chunk: int = 4096,
+    c2: np.ndarray | None = None,
+    decode: Callable[[np.ndarray], np.ndarray] | None = None,
+) -> np.ndarray:
+    """
+    Distancia L2 al cuadrado de cada fila de E a su centro más cercano en C (por bloques de C).
+    c2: normas al cuadrado de C precalculadas (p.ej. de la memoria, para no recalcularlas por consulta).
+    decode: convierte cada bloque de C a float32 (memorias float16 / sq8); solo un bloque a la vez.
+    """
+    if e2 is None:
+        e2 = _sq_norms(E)
+    d2 = np.full(E.shape[0], np.inf, dtype=np.float32)
+    for start in range(0, C.shape[0], chunk):
+        Cb = C[start:start + chunk] if decode is None else decode(C[start:start + chunk])
+        block = E @ Cb.T
+        block *= -2.0
+        block += e2[:, None]
+        block += (_sq_norms(Cb) if c2 is None else c2[start:start + chunk])[None, :]
+        np.minimum(d2, block.min(axis=1), out=d2)
+    np.maximum(d2, 0.0, out=d2)
+    return d2
+
+
+def _min_dist_to(E: np.ndarray, C: np.ndarray, chunk: int = 4096) -> np.ndarray:
+    """Distancia L2 de cada fila de E a su centro más cercano en C (por bloques de C)."""
+    return np.sqrt(_min_sq_dist_to(E, C, chunk=chunk))
+
+
+def _topk_sq_dist_to(
+    E: np.ndarray,
+    C: np.ndarray,
+    k: int,
+    e2: np.ndarray | None = None,
+    chunk: int = 4096,
+    c2: np.ndarray | None = None,
+    decode: Callable[[np.ndarray], np.ndarray] | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Las k distancias L2 al cuadrado más pequeñas de cada fila de E a C (ascendentes) y sus índices
+    en C. Por bloques de C: se mezcla el top-k acumulado con el del bloque con argpartition.
+    """
+    if e2 is None:
+        e2 = _sq_norms(E)
+    n = E.shape[0]
+    k = max(1, min(int(k), C.shape[0]))
+    best_d2 = np.full((n, k), np.inf, dtype=np.float32)
+    best_i = np.full((n, k), -1, dtype=np.int64)
+    rows = np.arange(n)[:, None]
+    for start in range(0, C.shape[0], chunk):
+        Cb = C[start:start + chunk] if decode is None else decode(C[start:start + chunk])
+        block = E @ Cb.T
+        block *= -2.0
+        block += e2[:, None]
+        block += (_sq_norms(Cb) if c2 is None else c2[start:start + chunk])[None, :]
+        kb = min(k, block.shape[1])
+        if kb < block.shape[1]:
+            part = np.argpartition(block, kb - 1, axis=1)[:, :kb]
+        else:
+            part = np.broadcast_to(np.arange(kb), (n, kb))
+        cand_d2 = np.concatenate([best_d2, block[rows, part]], axis=1)
+        cand_i = np.concatenate([best_i, part + start], axis=1)
+        keep = np.argpartition(cand_d2, k - 1, axis=1)[:, :k]
+        best_d2 = cand_d2[rows, keep]
+        best_i = cand_i[rows, keep]
+    order = np.argsort(best_d2, axis=1)
+    best_d2 = np.maximum(best_d2[rows, order], 0.0)
+    return best_d2, best_i[rows, order]
+
+
+def _projection_matrix(dim_in: int, dim: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    R = rng.standard_normal((int(dim_in), int(dim)), dtype=np.float32)
+    R /= np.sqrt(float(dim))
+    return R
+
+
+def random_projection(X: np.ndarray, dim: int, seed: int = 0) -> np.ndarray:
+    """Proyección gaussiana a `dim` dimensiones (Johnson-Lindenstrauss), como en el paper de PatchCore."""
+    return X @ _projection_matrix(X.shape[1], dim, seed=seed)
+
+
+def kcenter_greedy(
+    E: np.ndarray,
+    m: int,
+    seed: int = 0,
+    init_centers: np.ndarray | None = None,
+    projection_dim: int = 0,
+    chunk_rows: int = KCENTER_CHUNK_ROWS,
+) -> np.ndarray:
+    """
+    Coreset k-center greedy sobre embeddings ya normalizados.
+
+    Distancias con ||a||^2 - 2ab + ||b||^2 en float32, actualizando el mínimo in-place por
+    bloques de filas (sin temporales N x D). Selecciona los mismos centros que la versión con
+    np.linalg.norm salvo empates numéricos (diferencias de distancia < ~1e-6 en datos
+    normalizados, p.ej. tokens duplicados); el radio de cobertura coincide.
+
+    Con init_centers (p.ej. el coreset ya existente) la selección continúa desde esos centros:
+    se eligen m filas nuevas de E, siempre la más alejada de todos los centros actuales.
+
+    projection_dim > 0: la selección se hace sobre una proyección aleatoria de esa dimensión
+    (más rápida; los centros elegidos son aproximados). Los índices devueltos son de E.
+    """
     rng = np.random.default_rng(seed)
     n = E.shape[0]
     if m >= n:
         return np.arange(n, dtype=np.int64)
-    c0 = int(rng.integers(0, n))
-    centers = [c0]
-    d = np.linalg.norm(E - E[c0], axis=1)
-    for _ in range(1, m):
-        i = int(np.argmax(d))
+    X = np.ascontiguousarray(E, dtype=np.float32)
+    C0 = None
+    if init_centers is not None and init_centers.shape[0] > 0:
+        C0 = np.asarray(init_centers, dtype=np.float32)
+    if projection_dim and 0 < int(projection_dim) < X.shape[1]:
+        X = random_projection(X, int(projection_dim), seed=seed)
+        if C0 is not None:
+            C0 = random_projection(C0, int(projection_dim), seed=seed)
+    x2 = _sq_norms(X)
+
+    continued = C0 is not None
+    if continued:
+        centers: list[int] = []
+        d2 = _min_sq_dist_to(X, C0, e2=x2)
+    else:
+        c0 = int(rng.integers(0, n))
+        centers = [c0]
+        d2 = np.full(n, np.inf, dtype=np.float32)
+    step = max(1, int(chunk_rows))
+    tmp = np.empty(min(step, n), dtype=np.float32)
+
+    def _update(i: int) -> None:
+        c = X[i]
+        c2 = x2[i]
+        for start in range(0, n, step):
+            stop = min(start + step, n)
+            t = tmp[: stop - start]
+            np.dot(X[start:stop], c, out=t)
+            t *= -2.0
+            t += x2[start:stop]
+            t += c2
+            np.minimum(d2[start:stop], t, out=d2[start:stop])
+
+    if not continued:
+        _update(centers[0])
+    while len(centers) < m:
+        i = int(np.argmax(d2))
+        if continued and d2[i] <= 1e-6:
+            break  # lo nuevo ya está cubierto por los centros existentes (duplicados)
         centers.append(i)
-        di = np.linalg.norm(E - E[i], axis=1)
-        d = np.minimum(d, di)
+        _update(i)
     return np.array(centers, dtype=np.int64)
 
 
+def kcenter_greedy_torch(
+    E: np.ndarray,
+    m: int,
+    seed: int = 0,
+    init_centers: np.ndarray | None = None,
+    projection_dim: int = 0,
+    device: Any = "cuda",
+) -> np.ndarray:
+    """
+    Misma selección que kcenter_greedy, con la matriz de embeddings en `device` (torch).
+
+    Las actualizaciones de distancia y el argmax se hacen en el dispositivo sin sincronizar
+    por iteración; solo se copian al final los índices elegidos.
+    """
+    import torch
+
+    rng = np.random.default_rng(seed)
+    n = E.shape[0]
+    if m >= n:
+        return np.arange(n, dtype=np.int64)
+    dev = torch.device(device)
+    X = torch.from_numpy(np.ascontiguousarray(E, dtype=np.float32)).to(dev)
+    C0 = None
+    if init_centers is not None and init_centers.shape[0] > 0:
+        C0 = torch.from_numpy(np.ascontiguousarray(init_centers, dtype=np.float32)).to(dev)
+    if projection_dim and 0 < int(projection_dim) < X.shape[1]:
+        R = torch.from_numpy(_projection_matrix(X.shape[1], int(projection_dim), seed=seed)).to(dev)
+        X = X @ R
+        if C0 is not None:
+            C0 = C0 @ R
+    x2 = (X * X).sum(dim=1)
+
+    with torch.inference_mode():
+        centers = torch.empty(m, dtype=torch.long, device=dev)
+        picked_d2 = torch.full((m,), float("inf"), dtype=torch.float32, device=dev)
+        d2 = torch.full((n,), float("inf"), dtype=torch.float32, device=dev)
+        first = 0
+        if C0 is not None:
+            for start in range(0, C0.shape[0], 4096):
+                Cb = C0[start:start + 4096]
+                block = torch.addmm((Cb * Cb).sum(dim=1)[None, :], X, Cb.T, alpha=-2.0)
+                block += x2[:, None]
+                torch.minimum(d2, block.min(dim=1).values, out=d2)
+            d2.clamp_(min=0.0)
+        else:
+            c0 = int(rng.integers(0, n))
+            centers[0] = c0
+            torch.minimum(d2, (x2 - 2.0 * (X @ X[c0]) + x2[c0]), out=d2)
+            first = 1
+        for k in range(first, m):
+            i = torch.argmax(d2)
+            centers[k] = i
+            picked_d2[k] = d2[i]
+            torch.minimum(d2, torch.addmv(x2 + x2[i], X, X[i], alpha=-2.0), out=d2)
+        out = centers.cpu().numpy().astype(np.int64)
+        if C0 is not None:
+            # Igual que la versión NumPy: se corta en el primer centro ya cubierto (duplicados)
+            covered = np.flatnonzero(picked_d2.cpu().numpy() <= 1e-6)
+            if covered.size:
+                out = out[: int(covered[0])]
+    return out
+
+
+def _use_torch_device(device: Any) -> bool:
+    if device is None:
+        return False
+    try:
+        import torch
+
+        return torch.device(device).type == "cuda" and torch.cuda.is_available()
+    except Exception:
+        return False
+
+
+def select_coreset(
+    E: np.ndarray,
+    m: int,
+    seed: int = 0,
+    init_centers: np.ndarray | None = None,
+    projection_dim: int = 0,
+    device: Any = None,
+) -> np.ndarray:
+    """k-center greedy en el dispositivo del extractor si es CUDA; si no (o si falla), en CPU."""
+    if _use_torch_device(device):
+        try:
+            return kcenter_greedy_torch(
+                E, m, seed=seed, init_centers=init_centers, projection_dim=projection_dim, device=device
+            )
+        except Exception as exc:  # p.ej. OOM en GPU: el camino NumPy siempre es válido
+            log.warning("[patchcore] coreset en %s falló (%s); usando CPU", device, exc)
+    return kcenter_greedy(E, m, seed=seed, init_centers=init_centers, projection_dim=projection_dim)
+
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+# Precisión de la memoria: float32 | float16 (se guarda y busca en 16 bits) | sq8 (búsqueda con
+# cuantización escalar de 8 bits por dimensión; se guarda en float16 para poder reentrenar)
+MEMORY_PRECISIONS = ("float32", "float16", "sq8")
+
+
+def storage_dtype(precision: str) -> str:
+    """dtype con el que se persiste el coreset para una precisión de memoria."""
+    return "float32" if (precision or "float32") == "float32" else "float16"
+
+
+def quantize_sq8(X: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Cuantización escalar uniforme de 8 bits por dimensión: X ~ vmin + scale * codes."""
+    X = np.asarray(X, dtype=np.float32)
+    vmin = X.min(axis=0)
+    scale = (X.max(axis=0) - vmin) / 255.0
+    scale[scale <= 0] = 1.0
+    codes = np.clip(np.rint((X - vmin) / scale), 0, 255).astype(np.uint8)
+    return codes, vmin.astype(np.float32), scale.astype(np.float32)
+
+
+# Búsqueda sin FAISS: numpy (matmul por bloques, BLAS multihilo) | sklearn (NearestNeighbors)
+KNN_FALLBACK_BACKENDS = ("numpy", "sklearn")
+
+# Agregación de las k distancias de cada token: min (1-NN) | mean (media de las k) |
+# reweight (1-NN ponderada por 1 - softmax de sus k distancias, como el reweighting de PatchCore)
+KNN_AGGREGATIONS = ("min", "mean", "reweight")
+
+
+def aggregate_knn(D: np.ndarray, aggregation: str = "min", I: np.ndarray | None = None) -> np.ndarray:
+    """
+    Score por token a partir de sus k distancias (N, k) ordenadas ascendentemente.
+
+    reweight: s = (1 - exp(d_1) / sum_j exp(d_j)) * d_1. El paper pondera con los vecinos en la
+    memoria del centro más cercano; aquí ese vecindario se aproxima con los k vecinos del propio
+    token (la misma búsqueda, sin kNN memoria-memoria). Con k=1 equivale a min.
+    I: índices de knn_search; los vecinos con I < 0 (relleno de FAISS cuando un índice aproximado
+    devuelve menos de k) no se agregan. El más cercano cuenta siempre.
+    """
+    aggregation = (aggregation or "min").strip().lower()
+    if aggregation not in KNN_AGGREGATIONS:
+        raise ValueError(f"aggregation debe ser uno de {KNN_AGGREGATIONS}")
+    D = np.asarray(D, dtype=np.float32)
+    valid = np.ones(D.shape, dtype=bool) if I is None else np.asarray(I) >= 0
+    valid[:, 0] = True
+    if aggregation == "mean":
+        return np.where(valid, D, 0.0).sum(axis=1) / valid.sum(axis=1)
+    if aggregation == "reweight" and D.shape[1] > 1:
+        # softmax estable: exp(d_1 - d_max) / sum exp(d_j - d_max), con peso 0 para el relleno
+        Dv = np.where(valid, D, -np.inf)
+        e = np.exp(Dv - Dv.max(axis=1, keepdims=True))
+        w = 1.0 - e[:, 0] / e.sum(axis=1)
+        # Un solo vecino válido: como k=1, el score es d_1
+        return np.where(valid.sum(axis=1) > 1, w * D[:, 0], D[:, 0])
+    return D[:, 0]
+
+
+# Filas de memoria por bloque en la búsqueda NumPy (temporal de consultas x bloque en float32:
+# 1024 tokens x 8192 filas ~ 32 MB)
+KNN_CHUNK_ROWS = 8192
+
+
+def _ivf_nlist(n: int) -> int:
+    # ~4*sqrt(n) listas, con >= 39 puntos de entrenamiento por lista (recomendación de FAISS)
+    return max(1, min(int(4 * np.sqrt(n)), n // 39))
+
+
+def _pq_subquantizers(d: int) -> int:
+    # Mayor divisor de d que no supere 64 (p.ej. 1152 -> 64, 384 -> 64, 768 -> 64)
+    return max(m for m in range(1, min(64, d) + 1) if d % m == 0)
+
+
+def resolve_index_params(index_type: str, n: int, d: int, params: dict | None = None) -> tuple[str, dict]:
+    """
+    Tipo y parámetros efectivos del índice para n vectores de dimensión d.
+    Memorias demasiado pequeñas para entrenar IVF/PQ usan "flat".
+    """
+    index_type = (index_type or "flat").strip().lower()
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"index_type debe ser uno de {INDEX_TYPES}")
+    p = dict(params or {})
+    if index_type in ("ivf_flat", "ivf_pq"):
+        nlist = int(p.get("nlist") or _ivf_nlist(n))
+        out = {"nlist": nlist, "nprobe": min(nlist, int(p.get("nprobe") or 16))}
+        if index_type == "ivf_pq":
+            out["m"] = int(p.get("m") or _pq_subquantizers(d))
+            out["nbits"] = int(p.get("nbits") or 8)
+            if d % out["m"] != 0:
+                raise ValueError(f"ivf_pq: m={out['m']} debe dividir la dimensión {d}")
+            if n < max(39 * nlist, 2 ** out["nbits"]):
+                return "flat", {}
+        elif n < 39 * nlist:
+            return "flat", {}
+        return index_type, out
+    if index_type == "hnsw":
+        return "hnsw", {
+            "M": int(p.get("M") or 32),
+            "efConstruction": int(p.get("efConstruction") or 80),
+            "efSearch": int(p.get("efSearch") or 64),
+        }
+    return "flat", {}
+
+
+def apply_search_params(index: Any, index_type: str, params: dict | None) -> None:
+    """Aplica los parámetros de búsqueda (nprobe / efSearch) a un índice FAISS (CPU)."""
+    import faiss  # type: ignore
+
+    params = params or {}
+    if index_type in ("ivf_flat", "ivf_pq") and params.get("nprobe"):
+        faiss.extract_index_ivf(index).nprobe = int(params["nprobe"])
+    elif index_type == "hnsw" and params.get("efSearch"):
+        faiss.downcast_index(index).hnsw.efSearch = int(params["efSearch"])
+
+
+def build_faiss_index(
+    C: np.ndarray, index_type: str = "flat", params: dict | None = None, precision: str = "float32"
+) -> tuple[Any, str, dict]:
+    """
+    Construye (y entrena si hace falta) el índice FAISS L2. Devuelve (índice, tipo, params).
+    precision float16/sq8: vectores del índice en IndexScalarQuantizer (QT_fp16 / QT_8bit) para
+    flat, ivf_flat y hnsw; ivf_pq ya está comprimido y la ignora.
+    """
+    import faiss  # type: ignore
+
+    C = np.ascontiguousarray(C, dtype=np.float32)
+    n, d = C.shape
+    index_type, p = resolve_index_params(index_type, n, d, params)
+    qtype = {
+        "float16": faiss.ScalarQuantizer.QT_fp16,
+        "sq8": faiss.ScalarQuantizer.QT_8bit,
+    }.get(precision or "float32")
+    if index_type == "ivf_flat":
+        if qtype is None:
+            index = faiss.IndexIVFFlat(faiss.IndexFlatL2(d), d, p["nlist"], faiss.METRIC_L2)
+        else:
+            index = faiss.IndexIVFScalarQuantizer(faiss.IndexFlatL2(d), d, p["nlist"], qtype, faiss.METRIC_L2)
+    elif index_type == "ivf_pq":
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(d), d, p["nlist"], p["m"], p["nbits"])
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, p["M"]) if qtype is None else faiss.IndexHNSWSQ(d, qtype, p["M"])
+        index.hnsw.efConstruction = p["efConstruction"]
+    elif qtype is not None:
+        index = faiss.IndexScalarQuantizer(d, qtype, faiss.METRIC_L2)
+    else:
+        index = faiss.IndexFlatL2(d)
+    if not index.is_trained:
+        index.train(C)
+    index.add(C)
+    apply_search_params(index, index_type, p)
+    return index, index_type, p
+
+
+def held_out_sample(embeddings: np.ndarray, selected: np.ndarray, n: int = 256, seed: int = 0) -> np.ndarray:
+    """
+    Muestra (L2-normalizada) de hasta `n` filas de `embeddings` que no entraron en el coreset:
+    consultas retenidas, como las de inferencia, para medir el recall del índice.
+    """
+    keep = np.ones(embeddings.shape[0], dtype=bool)
+    keep[np.asarray(selected, dtype=np.intp)] = False
+    cand = np.flatnonzero(keep)
+    if cand.size == 0:
+        return np.empty((0, embeddings.shape[1]), dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    pick = np.sort(rng.choice(cand, size=min(int(n), cand.size), replace=False))
+    return l2_normalize(np.asarray(embeddings[pick], dtype=np.float32))
+
+
+def index_recall(index: Any, emb: np.ndarray, queries: np.ndarray) -> float | None:
+    """
+    Recall@1 del índice frente a búsqueda exacta (_min_sq_dist_to sobre la memoria almacenada)
+    para consultas retenidas (p.ej. held_out_sample). None si no hay consultas.
+    Un vecino cuenta como acierto si su distancia exacta empata con la mínima.
+    """
+    Q = np.ascontiguousarray(queries, dtype=np.float32)
+    if Q.shape[0] == 0 or emb.shape[0] == 0:
+        return None
+    decode = None if emb.dtype == np.float32 else (lambda b: b.astype(np.float32))
+    exact_d2 = _min_sq_dist_to(Q, emb, decode=decode)
+    _, I = index.search(Q, 1)
+    ids = np.asarray(I[:, 0], dtype=np.int64)
+    valid = ids >= 0
+    cand = np.asarray(emb[np.where(valid, ids, 0)], dtype=np.float32)
+    cand_d2 = np.maximum(_sq_norms(Q - cand), 0.0)
+    hits = valid & (cand_d2 <= exact_d2 + 1e-5 * np.maximum(exact_d2, 1.0))
+    return float(hits.mean())
+
+
 class PatchCoreMemory:
-    def __init__(self, embeddings: np.ndarray, index=None, coreset_rate: float | None = None):
-        self.emb = embeddings.astype(np.float32, copy=False)
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        index=None,
+        coreset_rate: float | None = None,
+        index_type: str = "flat",
+        index_params: dict | None = None,
+        knn_backend: str = "numpy",
+        precision: str = "float32",
+    ):
+        self.precision = (precision or "float32").strip().lower()
+        if self.precision not in MEMORY_PRECISIONS:
+            raise ValueError(f"precision debe ser uno de {MEMORY_PRECISIONS}")
+        # El coreset se conserva en su dtype de almacenamiento (float16 para float16/sq8)
+        self.emb = embeddings.astype(storage_dtype(self.precision), copy=False)
+        # Coreset float32 sin redondear (solo tras build/extend con precisión reducida): se persiste
+        # como referencia para medir la desviación frente a float32 en la calibración
+        self.reference: np.ndarray | None = None
+        # Filas de los embeddings de entrada elegidas para el coreset (solo tras build/extend)
+        self.coreset_indices: np.ndarray | None = None
         self.index = index
         self.nn = None
+        self.knn_backend = "faiss" if index is not None else (knn_backend or "numpy").strip().lower()
+        self._emb_sq_norms: np.ndarray | None = None
+        self._search_data: np.ndarray = self.emb
+        self._decode: Callable[[np.ndarray], np.ndarray] | None = None
         self.coreset_rate = coreset_rate
+        self.index_type = index_type or "flat"
+        self.index_params = dict(index_params or {})
         self._faiss_gpu_res: Any | None = None
         if index is None:
             if _HAS_FAISS:
-                import faiss  # type: ignore
-
-                index = faiss.IndexFlatL2(self.emb.shape[1])
-                index.add(self.emb)
-                self.index = index
+                self.index, self.index_type, self.index_params = build_faiss_index(
+                    self.emb, self.index_type, self.index_params, precision=self.precision
+                )
+                self.knn_backend = "faiss"
             else:
-                nn_cls = _get_sklearn_neighbors()
-                if nn_cls is not None:
+                # Sin FAISS la búsqueda es exacta
+                self.index_type, self.index_params = "flat", {}
+                if self.knn_backend not in KNN_FALLBACK_BACKENDS:
+                    raise ValueError(f"knn_backend debe ser uno de {KNN_FALLBACK_BACKENDS}")
+                if self.knn_backend == "sklearn":
+                    nn_cls = _get_sklearn_neighbors()
+                    if nn_cls is None:
+                        raise RuntimeError("PatchCoreMemory not fitted: missing kNN index (FAISS/sklearn).")
                     self.nn = nn_cls(n_neighbors=1, algorithm="auto", metric="euclidean")
-                    self.nn.fit(self.emb)
+                    self.nn.fit(self.emb.astype(np.float32, copy=False))
                 else:
-                    raise RuntimeError("PatchCoreMemory not fitted: missing kNN index (FAISS/sklearn).")
+                    self._init_numpy_search()
+
+    def _init_numpy_search(self) -> None:
+        """Datos de la búsqueda NumPy: float32 tal cual; float16 / sq8 se decodifican por bloques."""
+        if self.precision == "sq8":
+            codes, vmin, scale = quantize_sq8(self.emb)
+            self._search_data = codes
+            self._decode = lambda b: b.astype(np.float32) * scale + vmin
+        elif self.emb.dtype != np.float32:
+            self._search_data = self.emb
+            self._decode = lambda b: b.astype(np.float32)
+        norms = np.empty(self._search_data.shape[0], dtype=np.float32)
+        for start in range(0, norms.shape[0], KNN_CHUNK_ROWS):
+            block = self._search_data[start:start + KNN_CHUNK_ROWS]
+            norms[start:start + KNN_CHUNK_ROWS] = _sq_norms(block if self._decode is None else self._decode(block))
+        self._emb_sq_norms = norms
 
     @staticmethod
-    def build(embeddings: np.ndarray, coreset_rate: float = 0.02, seed: int = 0) -> "PatchCoreMemory":
+    def build(
+        embeddings: np.ndarray,
+        coreset_rate: float = 0.02,
+        seed: int = 0,
+        projection_dim: int = 0,
+        device: Any = None,
+        index_type: str = "flat",
+        index_params: dict | None = None,
+        precision: str = "float32",
+    ) -> "PatchCoreMemory":
+        """Coreset k-center greedy (en `device` si es CUDA) + índice kNN del tipo pedido."""
         E = l2_normalize(embeddings.astype(np.float32, copy=False))
         n = E.shape[0]
         m = max(1, int(np.ceil(n * coreset_rate)))
-        idx = kcenter_greedy(E, m, seed=seed)
+        idx = select_coreset(E, m, seed=seed, projection_dim=projection_dim, device=device)
         C = E[idx]
-        if _HAS_FAISS:
-            import faiss  # type: ignore
-            index = faiss.IndexFlatL2(C.shape[1])
-            index.add(C)
-            return PatchCoreMemory(C, index=index, coreset_rate=coreset_rate)
+        return PatchCoreMemory._with_reference(
+            C,
+            idx,
+            coreset_rate=coreset_rate,
+            index_type=index_type,
+            index_params=index_params,
+            precision=precision,
+        )
+
+    @staticmethod
+    def _with_reference(C: np.ndarray, selected: np.ndarray, **kwargs: Any) -> "PatchCoreMemory":
+        mem = PatchCoreMemory(C, index=None, **kwargs)
+        mem.coreset_indices = np.asarray(selected, dtype=np.intp)
+        if mem.precision != "float32":
+            mem.reference = C
+        return mem
+
+    @staticmethod
+    def extend(
+        existing: np.ndarray,
+        new_embeddings: np.ndarray,
+        coreset_rate: float = 0.02,
+        seed: int = 0,
+        projection_dim: int = 0,
+        device: Any = None,
+        index_type: str = "flat",
+        index_params: dict | None = None,
+        precision: str = "float32",
+    ) -> "PatchCoreMemory":
+        """
+        Amplía un coreset existente (ya normalizado) con embeddings nuevos: k-center greedy
+        continuado desde los centros actuales, con la misma tasa aplicada solo a lo nuevo.
+        Con precisión reducida conviene pasar como `existing` la referencia float32 del coreset.
+        """
+        E = l2_normalize(new_embeddings.astype(np.float32, copy=False))
+        C_prev = existing.astype(np.float32, copy=False)
+        m = max(1, int(np.ceil(E.shape[0] * coreset_rate)))
+        idx = select_coreset(E, m, seed=seed, init_centers=C_prev, projection_dim=projection_dim, device=device)
+        C = np.concatenate([C_prev, E[idx]], axis=0) if idx.size else C_prev
+        # Índice nuevo (no se muta el de la memoria en uso por otras peticiones)
+        return PatchCoreMemory._with_reference(
+            C,
+            idx,
+            coreset_rate=coreset_rate,
+            index_type=index_type,
+            index_params=index_params,
+            precision=precision,
+        )
+
+    def index_info(self) -> dict:
+        """Tipo, parámetros y precisión del índice, para los metadatos de la memoria."""
+        return {"type": self.index_type, "params": dict(self.index_params), "precision": self.precision}
+
+    def knn_search(self, query: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Los k vecinos más cercanos de todos los tokens en una llamada: (D, I) de forma (N, k),
+        distancias L2 ascendentes e índices en la memoria. k se limita al tamaño de la memoria.
+        """
+        Q = l2_normalize(query.astype(np.float32, copy=False))
+        k = max(1, min(int(k), self.emb.shape[0]))
+        if self.index is None and self.nn is None and self._emb_sq_norms is None:
+            raise RuntimeError("PatchCoreMemory not fitted: missing kNN index (FAISS/sklearn).")
+        if self.index is not None:
+            D2, I = self.index.search(Q, k)
+            D, I = np.sqrt(np.maximum(D2, 0.0)), I.astype(np.int64)
+            # Relleno de FAISS (I=-1, D≈3.4e38) si la búsqueda aproximada encuentra menos de k vecinos
+            D[I < 0] = np.inf
+            miss = np.flatnonzero(I[:, 0] < 0)
+            if miss.size:
+                d2, i = self._exact_nearest_sq(Q[miss])
+                D[miss, 0], I[miss, 0] = np.sqrt(d2), i
+            return D, I
+        elif self._emb_sq_norms is not None:
+            D2, I = _topk_sq_dist_to(
+                Q, self._search_data, k, chunk=KNN_CHUNK_ROWS, c2=self._emb_sq_norms, decode=self._decode
+            )
+            return np.sqrt(D2), I
         else:
-            return PatchCoreMemory(C, index=None, coreset_rate=coreset_rate)
+            assert self.nn is not None
+            d, i = self.nn.kneighbors(Q, n_neighbors=k, return_distance=True)
+            return d.astype(np.float32), i.astype(np.int64)
+
+    def _exact_nearest_sq(self, Q: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """1-NN exacto (distancia al cuadrado, índice) para las consultas sin vecino en el índice FAISS."""
+        decode = None if self.emb.dtype == np.float32 else (lambda b: b.astype(np.float32))
+        D2, I = _topk_sq_dist_to(Q, self.emb, 1, chunk=KNN_CHUNK_ROWS, decode=decode)
+        return D2[:, 0], I[:, 0]
+
+    def knn_scores(self, query: np.ndarray, k: int = 1, aggregation: str = "min") -> np.ndarray:
+        """Score kNN por token (N,) con la agregación pedida; k=1 o min usan la búsqueda 1-NN directa."""
+        if int(k) <= 1 or self.emb.shape[0] <= 1 or aggregation == "min":
+            return self.knn_min_dist(query)
+        D, I = self.knn_search(query, k)
+        return aggregate_knn(D, aggregation, I)
 
     def knn_min_dist(self, query: np.ndarray) -> np.ndarray:
         Q = l2_normalize(query.astype(np.float32, copy=False))
-        if self.index is None and self.nn is None:
+        if self.index is None and self.nn is None and self._emb_sq_norms is None:
             raise RuntimeError("PatchCoreMemory not fitted: missing kNN index (FAISS/sklearn).")
         if self.index is not None:
             import faiss  # type: ignore
             D, I = self.index.search(Q, 1)
-            return np.sqrt(np.maximum(D[:, 0], 0.0))
+            d2 = np.maximum(D[:, 0], 0.0)
+            miss = np.flatnonzero(I[:, 0] < 0)
+            if miss.size:
+                d2[miss] = self._exact_nearest_sq(Q[miss])[0]
+            return np.sqrt(d2)
+        elif self._emb_sq_norms is not None:
+            # ||q||^2 + ||m||^2 - 2 q·m (= 2 - 2 q·m con ambos normalizados), por bloques de memoria
+            return np.sqrt(
+                _min_sq_dist_to(Q, self._search_data, chunk=KNN_CHUNK_ROWS, c2=self._emb_sq_norms, decode=self._decode)
+            )
         else:
             assert self.nn is not None
             d, i = self.nn.kneighbors(Q, n_neighbors=1, return_distance=True)
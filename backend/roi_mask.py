@@ -1,3 +1,8 @@
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
 import numpy as np
 import cv2
 
@@ -34,3 +39,145 @@ def build_mask(h: int, w: int, shape: dict | None):
         return mask_annulus(h, w, float(shape.get("cx", w/2)), float(shape.get("cy", h/2)),
                             float(shape.get("r", min(h, w)/2)), float(shape.get("r_inner", 0)))
     return np.full((h, w), 255, np.uint8)
+
+def mask_to_token_grid(mask: np.ndarray, ht: int, wt: int, margin_px: float = 0.0) -> np.ndarray:
+    """
+    Tokens (ht, wt) que influyen en algún píxel válido de `mask` al reescalar el grid de tokens
+    al tamaño del ROI (cv2.resize bilineal) y suavizar con un kernel de radio `margin_px`.
+    Superconjunto conservador: celda con algún píxel válido, dilatada 1 token (interpolación)
+    más el radio del suavizado en tokens.
+    """
+    h, w = mask.shape[:2]
+    # Promedio en float: en uint8 una celda con pocos píxeles válidos redondearía a 0
+    cells = cv2.resize(mask.astype(np.float32), (int(wt), int(ht)), interpolation=cv2.INTER_AREA) > 0
+    r = 1 + int(np.ceil(max(0.0, float(margin_px)) * max(ht / h, wt / w)))
+    k = np.ones((2 * r + 1, 2 * r + 1), np.uint8)
+    return cv2.dilate(cells.astype(np.uint8), k) > 0
+
+
+# ---------------------------------------------------------------------------
+# Caché LRU de máscaras por (H, W, forma canónica), compartida por todos los endpoints del worker.
+# Guarda la máscara uint8, su versión bool y las proyecciones a grids reducidos (tokens / posproceso);
+# los arrays se devuelven de solo lectura. La expulsión se hace por bytes ocupados.
+# ---------------------------------------------------------------------------
+
+class _MaskEntry:
+    __slots__ = ("key", "u8", "bool", "derived", "nbytes")
+
+    def __init__(self, key: Tuple[int, int, str], u8: np.ndarray):
+        self.key = key
+        self.u8 = u8
+        self.bool = u8 > 0
+        self.u8.setflags(write=False)
+        self.bool.setflags(write=False)
+        self.derived: Dict[Hashable, np.ndarray] = {}
+        self.nbytes = int(self.u8.nbytes + self.bool.nbytes)
+
+
+_MASK_CACHE_LOCK = threading.RLock()
+_MASK_CACHE: "OrderedDict[Tuple[int, int, str], _MaskEntry]" = OrderedDict()
+_MASK_CACHE_BYTES = 0
+_MASK_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+def set_mask_cache_limit(max_bytes: int) -> None:
+    """Límite de memoria de la caché de máscaras (0 = desactivada)."""
+    global _MASK_CACHE_MAX_BYTES
+    with _MASK_CACHE_LOCK:
+        _MASK_CACHE_MAX_BYTES = max(0, int(max_bytes))
+        _evict_masks()
+
+
+def clear_mask_cache() -> None:
+    global _MASK_CACHE_BYTES
+    with _MASK_CACHE_LOCK:
+        _MASK_CACHE.clear()
+        _MASK_CACHE_BYTES = 0
+
+
+def mask_cache_info() -> Dict[str, int]:
+    with _MASK_CACHE_LOCK:
+        return {"entries": len(_MASK_CACHE), "bytes": int(_MASK_CACHE_BYTES), "max_bytes": int(_MASK_CACHE_MAX_BYTES)}
+
+
+def _shape_key(shape: Optional[dict]) -> str:
+    """JSON canónico de la forma (claves ordenadas, tipo en minúsculas); "" = sin máscara."""
+    if not shape:
+        return ""
+    canon = dict(shape)
+    canon["kind"] = str(canon.get("kind", "rect")).lower()
+    return json.dumps(canon, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def _evict_masks() -> None:
+    global _MASK_CACHE_BYTES
+    while _MASK_CACHE and _MASK_CACHE_BYTES > _MASK_CACHE_MAX_BYTES:
+        _, old = _MASK_CACHE.popitem(last=False)
+        _MASK_CACHE_BYTES -= old.nbytes
+
+
+def _mask_entry(h: int, w: int, shape: Optional[dict]) -> _MaskEntry:
+    global _MASK_CACHE_BYTES
+    key = (int(h), int(w), _shape_key(shape))
+    with _MASK_CACHE_LOCK:
+        entry = _MASK_CACHE.get(key)
+        if entry is not None:
+            _MASK_CACHE.move_to_end(key)
+            return entry
+    # La rasterización se hace fuera del lock; si dos hilos coinciden, gana el primero en guardar
+    entry = _MaskEntry(key, build_mask(int(h), int(w), shape))
+    if entry.nbytes > _MASK_CACHE_MAX_BYTES:
+        return entry
+    with _MASK_CACHE_LOCK:
+        current = _MASK_CACHE.get(key)
+        if current is not None:
+            _MASK_CACHE.move_to_end(key)
+            return current
+        _MASK_CACHE[key] = entry
+        _MASK_CACHE_BYTES += entry.nbytes
+        _evict_masks()
+    return entry
+
+
+def _derived(entry: _MaskEntry, key: Hashable, compute) -> np.ndarray:
+    global _MASK_CACHE_BYTES
+    with _MASK_CACHE_LOCK:
+        arr = entry.derived.get(key)
+    if arr is not None:
+        return arr
+    arr = compute()
+    arr.setflags(write=False)
+    with _MASK_CACHE_LOCK:
+        current = entry.derived.get(key)
+        if current is not None:
+            return current
+        entry.derived[key] = arr
+        entry.nbytes += int(arr.nbytes)
+        if _MASK_CACHE.get(entry.key) is entry:
+            _MASK_CACHE_BYTES += int(arr.nbytes)
+            _evict_masks()
+    return arr
+
+
+def cached_mask(h: int, w: int, shape: Optional[dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """(máscara uint8 0/255, máscara bool) de solo lectura para (h, w, shape), desde la caché LRU."""
+    entry = _mask_entry(h, w, shape)
+    return entry.u8, entry.bool
+
+
+def cached_token_grid(h: int, w: int, shape: Optional[dict], ht: int, wt: int,
+                      margin_px: float = 0.0) -> np.ndarray:
+    """mask_to_token_grid de la máscara (h, w, shape), cacheado junto a la máscara."""
+    entry = _mask_entry(h, w, shape)
+    key = ("tokens", int(ht), int(wt), float(margin_px))
+    return _derived(entry, key, lambda: mask_to_token_grid(entry.u8, ht, wt, margin_px=margin_px))
+
+
+def cached_mask_grid(h: int, w: int, shape: Optional[dict], gh: int, gw: int) -> np.ndarray:
+    """Máscara bool reducida a (gh, gw): celdas con al menos la mitad de su área dentro de la máscara."""
+    entry = _mask_entry(h, w, shape)
+    key = ("grid", int(gh), int(gw))
+    return _derived(
+        entry, key,
+        lambda: cv2.resize(entry.u8, (int(gw), int(gh)), interpolation=cv2.INTER_AREA) >= 128,
+    )
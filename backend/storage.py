@@ -1,8 +1,14 @@
 from __future__ import annotations
 
 import base64
+import hashlib
+import io
 import json
+import os
 import re
+import shutil
+import time
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 from datetime import datetime
@@ -12,10 +18,33 @@ import numpy as np
 from .utils import ensure_dir, load_json, save_json
 from .diagnostics import diag_event
 
+try:  # bloqueo entre procesos (varios workers de uvicorn) al escribir una memoria
+    import fcntl  # type: ignore
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None  # type: ignore
+try:
+    import msvcrt  # type: ignore
+except ImportError:
+    msvcrt = None  # type: ignore
+
 IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".bmp", ".webp"}
 
+# Caché de embeddings por contenido: <dataset_base>/.emb_cache/<extractor_key>/<sha256>.npz
+EMB_CACHE_DIRNAME = ".emb_cache"
+
 MemoryPayload = Tuple[np.ndarray, Tuple[int, int], Dict[str, Any]]
 
+# Memoria sin comprimir: cabecera JSON <base>.mem.json + embeddings crudos (little-endian, C-order)
+# en <base>.<stamp>.mem, cargados con np.memmap (varios workers comparten las páginas de la page cache).
+# El .npz comprimido de versiones anteriores se sigue leyendo y se convierte al cargarlo.
+MEMORY_HEADER_SUFFIX = ".mem.json"
+MEMORY_DATA_SUFFIX = ".mem"
+MEMORY_FORMAT = "bdi-memory-v1"
+MEMORY_DTYPES = ("float32", "float16")
+# Copia float32 del coreset de una memoria float16/sq8 (<base>_ref.mem.json): solo la leen la
+# calibración (desviación frente a float32) y el fit incremental; la inferencia no la carga
+MEMORY_REFERENCE_SUFFIX = "_ref"
+
 
 def _is_image_file(p: Path) -> bool:
     return p.is_file() and p.suffix.lower() in IMAGE_EXTS
@@ -173,7 +202,29 @@ class ModelStore:
         *,
         create: bool = True,
     ) -> Path:
-        return self.resolve_models_dir(recipe_id, model_key, create=create) / f"{self._base_name(role_id, roi_id)}.npz"
+        return self.resolve_models_dir(recipe_id, model_key, create=create) / f"{self._base_name(role_id, roi_id)}{MEMORY_HEADER_SUFFIX}"
+
+    @staticmethod
+    def memory_file_variants(path: Path) -> Tuple[Path, Path]:
+        """(cabecera .mem.json, .npz legacy) del mismo artefacto de memoria, a partir de cualquiera de los dos."""
+        name = path.name
+        stem = name[: -len(MEMORY_HEADER_SUFFIX)] if name.endswith(MEMORY_HEADER_SUFFIX) else path.stem
+        return path.with_name(stem + MEMORY_HEADER_SUFFIX), path.with_name(stem + ".npz")
+
+    @classmethod
+    def reference_memory_path(cls, path: Path) -> Path:
+        """Cabecera de la copia float32 de referencia asociada a la memoria `path` (.mem.json o .npz)."""
+        header = cls.memory_file_variants(path)[0]
+        stem = header.name[: -len(MEMORY_HEADER_SUFFIX)]
+        return header.with_name(stem + MEMORY_REFERENCE_SUFFIX + MEMORY_HEADER_SUFFIX)
+
+    @classmethod
+    def existing_memory_file(cls, path: Path) -> Optional[Path]:
+        """El fichero de memoria existente para `path`: la cabecera nueva si existe, si no el .npz."""
+        for candidate in cls.memory_file_variants(path):
+            if candidate.exists():
+                return candidate
+        return None
 
     def _index_path(
         self,
@@ -246,9 +297,10 @@ class ModelStore:
         recipe_safe = self._sanitize_recipe_id(recipe_id)
         probed: list[dict[str, Any]] = []
         new_path = self._memory_path(role_id, roi_id, recipe_id, model_key_effective, create=False)
-        probed.append({"path": str(new_path), "exists": new_path.exists()})
-        if new_path.exists():
-            return new_path
+        found = self.existing_memory_file(new_path)
+        probed.append({"path": str(new_path), "exists": found is not None})
+        if found is not None:
+            return found
 
         # Backwards-compat: if recipe folder exists with different casing, try it before fallback.
         if recipe_id:
@@ -256,27 +308,31 @@ class ModelStore:
                 alt_recipe_dir = self._find_recipe_dir_case_insensitive(recipe_safe)
                 if alt_recipe_dir and alt_recipe_dir != recipe_safe:
                     alt_base = self.root / "recipes" / alt_recipe_dir / self._sanitize_model_key(model_key_effective)
-                    alt_path = alt_base / f"{self._base_name(role_id, roi_id)}.npz"
-                    probed.append({"path": str(alt_path), "exists": alt_path.exists()})
-                    if alt_path.exists():
-                        return alt_path
+                    alt_path = alt_base / f"{self._base_name(role_id, roi_id)}{MEMORY_HEADER_SUFFIX}"
+                    found = self.existing_memory_file(alt_path)
+                    probed.append({"path": str(alt_path), "exists": found is not None})
+                    if found is not None:
+                        return found
 
         # fallback: default recipe path
         if recipe_id and recipe_safe != "default":
             default_path = self._memory_path(role_id, roi_id, "default", model_key_effective, create=False)
-            probed.append({"path": str(default_path), "exists": default_path.exists()})
-            if default_path.exists():
-                return default_path
+            found = self.existing_memory_file(default_path)
+            probed.append({"path": str(default_path), "exists": found is not None})
+            if found is not None:
+                return found
 
         flat_legacy_path = self.root / f"{self._legacy_flat_base_name(role_id, roi_id)}.npz"
-        probed.append({"path": str(flat_legacy_path), "exists": flat_legacy_path.exists()})
-        if flat_legacy_path.exists():
-            return flat_legacy_path
+        found = self.existing_memory_file(flat_legacy_path)
+        probed.append({"path": str(flat_legacy_path), "exists": found is not None})
+        if found is not None:
+            return found
 
         legacy_path = self._legacy_dir(role_id, roi_id) / "memory.npz"
-        probed.append({"path": str(legacy_path), "exists": legacy_path.exists()})
-        if legacy_path.exists():
-            return legacy_path
+        found = self.existing_memory_file(legacy_path)
+        probed.append({"path": str(legacy_path), "exists": found is not None})
+        if found is not None:
+            return found
 
         diag_event(
             "storage.resolve_memory.not_found",
@@ -394,7 +450,14 @@ class ModelStore:
 
 
 
-    def _load_memory_from_path(self, path: Path) -> MemoryPayload:
+    def _load_memory_from_path(self, path: Path, *, convert: bool = True) -> MemoryPayload:
+        """
+        Carga (embeddings, (Ht, Wt), metadata). Formato nuevo: np.memmap de solo lectura (sin
+        copia ni descompresión). Un .npz legacy se lee entero y, si convert=True, se reescribe
+        en el formato nuevo junto a él (la próxima carga ya es un memmap).
+        """
+        if path.name.endswith(MEMORY_HEADER_SUFFIX):
+            return self._load_memory_header(path)
         with np.load(path, allow_pickle=False) as z:
             emb = z["emb"].astype(np.float32)
             H = int(z["token_h"])
@@ -410,8 +473,109 @@ class ModelStore:
                     metadata = json.loads(meta_str)
                 except Exception:
                     metadata = {}
+        if convert:
+            try:
+                self._write_memory(self.memory_file_variants(path)[0], emb, (H, W), metadata)
+            except OSError as exc:  # p.ej. directorio de solo lectura: se sigue usando el .npz
+                diag_event("storage.memory.convert_failed", path=str(path), error=str(exc))
         return emb, (H, W), metadata
 
+    @staticmethod
+    def _load_memory_header(path: Path) -> MemoryPayload:
+        header = load_json(path, default=None)
+        if not isinstance(header, dict) or header.get("format") != MEMORY_FORMAT:
+            raise ValueError(f"Cabecera de memoria no reconocida: {path}")
+        dtype = np.dtype(str(header["dtype"])).newbyteorder("<")
+        shape = tuple(int(v) for v in header["shape"])
+        emb = np.memmap(path.parent / str(header["data"]), dtype=dtype, mode="r", shape=shape)
+        token_hw = (int(header["token_h"]), int(header["token_w"]))
+        return emb, token_hw, dict(header.get("metadata") or {})
+
+    @staticmethod
+    @contextmanager
+    def _memory_write_lock(header_path: Path):
+        """Serializa las escrituras de una misma memoria entre hilos y procesos (lock de fichero)."""
+        lock_path = header_path.with_name(f".{header_path.name}.lock")
+        with open(lock_path, "a+b") as fh:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            elif msvcrt is not None:  # pragma: no cover - Windows
+                while True:
+                    try:
+                        fh.seek(0)
+                        msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        time.sleep(0.05)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+                elif msvcrt is not None:  # pragma: no cover - Windows
+                    fh.seek(0)
+                    msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+    @classmethod
+    def _write_memory(
+        cls,
+        header_path: Path,
+        embeddings: np.ndarray,
+        token_hw: Tuple[int, int],
+        metadata: Optional[Dict[str, Any]],
+        dtype: str = "float32",
+    ) -> Path:
+        """
+        Escribe los embeddings crudos en un fichero nuevo y luego, de forma atómica, la cabecera que
+        lo referencia: un lector concurrente ve siempre una pareja cabecera/datos consistente.
+        Los escritores de una misma memoria se serializan con un lock de fichero y la limpieza solo
+        borra datos que la cabecera vigente no referencia.
+        """
+        if dtype not in MEMORY_DTYPES:
+            raise ValueError(f"dtype de memoria debe ser uno de {MEMORY_DTYPES}")
+        arr = np.ascontiguousarray(embeddings, dtype=np.dtype(dtype).newbyteorder("<"))
+        with cls._memory_write_lock(header_path):
+            cls._write_memory_locked(header_path, arr, token_hw, metadata, dtype)
+        return header_path
+
+    @staticmethod
+    def _write_memory_locked(
+        header_path: Path,
+        arr: np.ndarray,
+        token_hw: Tuple[int, int],
+        metadata: Optional[Dict[str, Any]],
+        dtype: str,
+    ) -> None:
+        stem = header_path.name[: -len(MEMORY_HEADER_SUFFIX)]
+        data_path = header_path.with_name(f"{stem}.{datetime.now().strftime('%Y%m%d%H%M%S%f')}{MEMORY_DATA_SUFFIX}")
+        tmp = data_path.with_name(f".{data_path.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(arr.tobytes(order="C"))
+        os.replace(tmp, data_path)
+        header = {
+            "format": MEMORY_FORMAT,
+            "data": data_path.name,
+            "dtype": dtype,
+            "shape": [int(v) for v in arr.shape],
+            "token_h": int(token_hw[0]),
+            "token_w": int(token_hw[1]),
+            "metadata": metadata or {},
+        }
+        tmp = header_path.with_name(f".{header_path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(header), encoding="utf-8")
+        os.replace(tmp, header_path)
+        # Datos anteriores: se relee la cabecera en disco y solo se borra lo que no referencia.
+        # Los memmaps abiertos conservan el inodo (POSIX); en Windows el borrado puede fallar
+        # mientras estén mapeados y se reintenta en la siguiente escritura
+        current = load_json(header_path, default=None)
+        keep = {str(current.get("data"))} if isinstance(current, dict) else {data_path.name}
+        for stale in header_path.parent.glob(f"{stem}.*{MEMORY_DATA_SUFFIX}"):
+            if stale.name not in keep:
+                try:
+                    stale.unlink()
+                except OSError:
+                    pass
+
     def save_memory(
         self,
         role_id: str,
@@ -422,22 +586,59 @@ class ModelStore:
         *,
         recipe_id: Optional[str] = None,
         model_key: Optional[str] = None,
+        dtype: str = "float32",
+        reference: Optional[np.ndarray] = None,
     ):
         """
-        Guarda la memoria (embeddings coreset L2-normalizados) y la forma del grid de tokens.
+        Guarda la memoria (embeddings coreset L2-normalizados) y la forma del grid de tokens
+        en el formato sin comprimir (cabecera JSON + datos crudos para np.memmap).
+        `reference`: coreset float32 de una memoria float16/sq8; si no se pasa, se borra la anterior.
         """
         ensure_dir(self.root)
-        payload = {
-            "emb": embeddings.astype(np.float32),
-            "token_h": int(token_hw[0]),
-            "token_w": int(token_hw[1]),
-        }
-        if metadata:
-            payload["metadata"] = json.dumps(metadata)
         path = self._memory_path(role_id, roi_id, recipe_id, model_key or roi_id)
-        np.savez_compressed(path, **payload)
+        self._write_memory(path, embeddings, token_hw, metadata, dtype=dtype)
+        ref_path = self.reference_memory_path(path)
+        if reference is not None:
+            self._write_memory(ref_path, reference, token_hw, {}, dtype="float32")
+        elif ref_path.exists():
+            self._remove_memory(ref_path)
+        # Un .npz anterior en la misma carpeta quedaría obsoleto (la cabecera tiene prioridad)
+        legacy_npz = self.memory_file_variants(path)[1]
+        if legacy_npz.exists():
+            try:
+                legacy_npz.unlink()
+            except OSError as exc:
+                diag_event("storage.memory.legacy_cleanup_failed", path=str(legacy_npz), error=str(exc))
         return path
 
+    @classmethod
+    def _remove_memory(cls, header_path: Path) -> None:
+        """Borra una memoria en formato nuevo (cabecera + ficheros de datos)."""
+        stem = header_path.name[: -len(MEMORY_HEADER_SUFFIX)]
+        with cls._memory_write_lock(header_path):
+            for f in [header_path, *header_path.parent.glob(f"{stem}.*{MEMORY_DATA_SUFFIX}")]:
+                try:
+                    f.unlink()
+                except OSError:
+                    pass
+
+    def load_memory_reference(self, path: Path, expected_shape: Optional[Tuple[int, ...]] = None) -> Optional[np.ndarray]:
+        """
+        Coreset float32 de referencia guardado junto a la memoria `path`, o None si no existe
+        (memoria float32 o guardada antes de existir la referencia) o no coincide con `expected_shape`.
+        """
+        ref_path = self.reference_memory_path(path)
+        if not ref_path.exists():
+            return None
+        try:
+            emb, _, _ = self._load_memory_header(ref_path)
+        except (OSError, ValueError, KeyError) as exc:
+            diag_event("storage.memory.reference_unreadable", path=str(ref_path), error=str(exc))
+            return None
+        if expected_shape is not None and tuple(emb.shape) != tuple(expected_shape):
+            return None
+        return emb
+
     def load_memory(
         self,
         role_id: str,
@@ -460,6 +661,13 @@ class ModelStore:
             return None
         return self._load_memory_from_path(path)
 
+    def load_memory_file(self, path: Path) -> MemoryPayload:
+        """
+        Carga (embeddings, (Ht, Wt), metadata) de un fichero de memoria concreto (p.ej. el de
+        existing_memory_file), sin la resolución con fallback de load_memory.
+        """
+        return self._load_memory_from_path(Path(path))
+
     def save_index_blob(self, role_id: str, roi_id: str, blob: bytes, *, recipe_id: Optional[str] = None, model_key: Optional[str] = None) -> Path:
         ensure_dir(self.root)
         path = self._index_path(role_id, roi_id, recipe_id, model_key or roi_id)
@@ -653,8 +861,10 @@ class ModelStore:
         p = base / lbl / fn
         deleted = False
         if p.exists() and p.is_file():
+            data = p.read_bytes()
             p.unlink()
             deleted = True
+            self._drop_cached_embedding(base, data)
         mp = p.with_suffix(".json")
         if mp.exists() and mp.is_file():
             mp.unlink()
@@ -673,8 +883,121 @@ class ModelStore:
             if f.is_file():
                 f.unlink()
                 count += 1
+        # Dataset vacío: la caché de embeddings ya no referencia ninguna imagen
+        if not any(_is_image_file(f) for cls in ("ok", "ng") if (base / cls).exists() for f in (base / cls).iterdir()):
+            shutil.rmtree(base / EMB_CACHE_DIRNAME, ignore_errors=True)
         return count
 
+    # --- Embedding cache (content-addressed) ---------------------------------
+
+    @staticmethod
+    def image_digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def embedding_cache_key(extractor_meta: Dict[str, Any]) -> str:
+        """Hash estable de la configuración del extractor (sin el device concreto: cuda:0 == cuda:1)."""
+        cfg = {k: v for k, v in extractor_meta.items() if k != "device"}
+        return hashlib.sha256(json.dumps(cfg, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+    def _drop_cached_embedding(self, base: Path, data: bytes) -> None:
+        """Borra la entrada de caché (todas las configuraciones) de una imagen eliminada del dataset."""
+        cache = base / EMB_CACHE_DIRNAME
+        if not cache.exists():
+            return
+        # Contenido duplicado en otro fichero del dataset: la entrada sigue en uso
+        for cls in ("ok", "ng"):
+            d = base / cls
+            if not d.exists():
+                continue
+            for f in d.iterdir():
+                if _is_image_file(f) and f.stat().st_size == len(data) and f.read_bytes() == data:
+                    return
+        name = f"{self.image_digest(data)}.npz"
+        for key_dir in cache.iterdir():
+            if key_dir.is_dir():
+                (key_dir / name).unlink(missing_ok=True)
+
+    def _emb_cache_dir(self, role_id: str, roi_id: str, extractor_key: str, *, recipe_id: Optional[str]) -> Optional[Path]:
+        base = self.resolve_dataset_base_existing(role_id, roi_id, recipe_id=recipe_id)
+        if base is None:
+            return None
+        return base / EMB_CACHE_DIRNAME / extractor_key
+
+    def load_cached_embedding(
+        self,
+        role_id: str,
+        roi_id: str,
+        digest: str,
+        extractor_key: str,
+        *,
+        recipe_id: Optional[str] = None,
+    ) -> Optional[Tuple[np.ndarray, Tuple[int, int]]]:
+        d = self._emb_cache_dir(role_id, roi_id, extractor_key, recipe_id=recipe_id)
+        if d is None:
+            return None
+        path = d / f"{digest}.npz"
+        if not path.exists():
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as z:
+                return z["emb"].astype(np.float32, copy=False), (int(z["token_h"]), int(z["token_w"]))
+        except Exception:
+            # Entrada corrupta (p.ej. escritura interrumpida en versiones previas): se recalcula
+            return None
+
+    def save_cached_embedding(
+        self,
+        role_id: str,
+        roi_id: str,
+        digest: str,
+        extractor_key: str,
+        emb: np.ndarray,
+        token_hw: Tuple[int, int],
+        *,
+        recipe_id: Optional[str] = None,
+    ) -> Optional[Path]:
+        d = self._emb_cache_dir(role_id, roi_id, extractor_key, recipe_id=recipe_id)
+        if d is None:
+            return None
+        ensure_dir(d)
+        buf = io.BytesIO()
+        # float16 comprimido: ~2x menos disco que float32 (el llamador usa los mismos valores redondeados)
+        np.savez_compressed(
+            buf, emb=np.asarray(emb, dtype=np.float16), token_h=int(token_hw[0]), token_w=int(token_hw[1])
+        )
+        path = d / f"{digest}.npz"
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(buf.getvalue())
+        os.replace(tmp, path)  # atómico: un lector concurrente nunca ve un fichero a medias
+        return path
+
+    def clear_embedding_cache(
+        self,
+        role_id: str,
+        roi_id: str,
+        *,
+        recipe_id: Optional[str] = None,
+        keep_key: Optional[str] = None,
+    ) -> int:
+        """
+        Borra la caché de embeddings del dataset; con keep_key solo las de otras configuraciones del
+        extractor. Es una limpieza explícita: otro worker puede seguir usando una configuración anterior.
+        Devuelve el nº de configuraciones borradas.
+        """
+        base = self.resolve_dataset_base_existing(role_id, roi_id, recipe_id=recipe_id)
+        cache = base / EMB_CACHE_DIRNAME if base is not None else None
+        if cache is None or not cache.exists():
+            return 0
+        removed = 0
+        for key_dir in cache.iterdir():
+            if key_dir.is_dir() and key_dir.name != keep_key:
+                shutil.rmtree(key_dir, ignore_errors=True)
+                removed += 1
+        if keep_key is None:
+            shutil.rmtree(cache, ignore_errors=True)
+        return removed
+
     def manifest(
         self,
         role_id: str,
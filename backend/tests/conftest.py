@@ -0,0 +1,6 @@
+# test_app_fastapi instala un stub mínimo de cv2 si no está importado; se importa antes el cv2 real
+# (si está instalado) para que los tests de máscaras/regiones se ejecuten también en la suite completa.
+try:
+    import cv2  # noqa: F401
+except Exception:  # pragma: no cover - cv2 no instalado (CI mínima)
+    pass
@@ -46,6 +46,9 @@ if "backend.features" not in sys.modules:  # pragma: no cover
             emb = np.ones((3, 4), dtype=np.float32)
             return emb, (2, 2)
 
+        def extract_batch(self, images, batch_size=8):  # type: ignore[no-untyped-def]
+            return [self.extract(image) for image in images]
+
         def get_metadata(self):
             return {"model_name": "stub"}
 
@@ -82,10 +85,20 @@ def test_fit_ok_persists_memory(tmp_path, monkeypatch):
             emb = np.ones((3, 4), dtype=np.float32)
             return emb, (2, 2)
 
+        def extract_batch(self, images, batch_size=8):
+            return [self.extract(image) for image in images]
+
     monkeypatch.setattr(app_mod, "_extractor", DummyExtractor())
 
-    def fake_build(embeddings, coreset_rate=0.02, seed=0):
-        return SimpleNamespace(emb=np.ones((2, embeddings.shape[1]), dtype=np.float32), index=None)
+    def fake_build(embeddings, coreset_rate=0.02, seed=0, **_):
+        return SimpleNamespace(
+            emb=np.ones((2, embeddings.shape[1]), dtype=np.float32),
+            index=None,
+            index_type="flat",
+            precision="float32",
+            reference=None,
+            index_info=lambda: {"type": "flat", "params": {}, "precision": "float32"},
+        )
 
     monkeypatch.setattr(app_mod.PatchCoreMemory, "build", staticmethod(fake_build))
 
@@ -121,6 +134,9 @@ def test_fit_ok_requires_min_ok_samples(tmp_path, monkeypatch):
             emb = np.ones((3, 4), dtype=np.float32)
             return emb, (2, 2)
 
+        def extract_batch(self, images, batch_size=8):
+            return [self.extract(image) for image in images]
+
     monkeypatch.setattr(app_mod, "_extractor", DummyExtractor())
 
     _reset_backend_state(tmp_path, monkeypatch)
@@ -230,3 +246,257 @@ def test_reject_last_recipe_payload_calibrate_ng():
         assert "reserved" in body["detail"]["error"].lower()
     else:
         assert "reserved" in body["error"].lower()
+
+
+def test_infer_multi_batches_rois_against_own_memory(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    _reset_backend_state(tmp_path, monkeypatch)
+
+    class CountingExtractor:
+        def __init__(self):
+            self.batch_calls = []
+
+        def extract(self, image):
+            raise AssertionError("infer_multi must use extract_batch")
+
+        def extract_batch(self, images, batch_size=8):
+            self.batch_calls.append(len(images))
+            return [(np.ones((4, 4), dtype=np.float32), (2, 2)) for _ in images]
+
+    extractor = CountingExtractor()
+    monkeypatch.setattr(app_mod, "_extractor", extractor)
+
+    memories = {
+        "A": app_mod.PatchCoreMemory(np.full((2, 4), 0.5, dtype=np.float32)),  # == l2-normalized query
+        "B": app_mod.PatchCoreMemory(np.zeros((2, 4), dtype=np.float32)),
+    }
+
+    def fake_mem(role_id, roi_id, recipe_id=None, model_key=None):
+        mem = memories.get(roi_id)
+        return (mem, (2, 2), {}) if mem is not None else None
+
+    monkeypatch.setattr(app_mod, "_get_patchcore_memory_cached", fake_mem)
+    monkeypatch.setattr(app_mod, "_get_calib_cached", lambda *a, **k: {"threshold": 0.5, "area_mm2_thr": 0.0})
+
+    class FakeEngine:
+        # The cv2 stub has no resize/blur: score straight from the kNN on the given features
+        def __init__(self, extractor, mem, token_hw, **_):
+            self.mem = mem
+
+        def run(self, img, *, features=None, **_):
+            emb, token_hw = features
+            score = float(self.mem.knn_min_dist(emb).max())
+            heat = np.full((24, 32), 255 if score > 0 else 0, dtype=np.uint8)
+            return {"score": score, "heatmap_u8": heat, "regions": [], "token_shape": list(token_hw),
+                    "timings_ms": {"knn": 0}}
+
+    monkeypatch.setattr(app_mod, "InferenceEngine", FakeEngine)
+
+    rois = [
+        {"role_id": "Inspection", "roi_id": "A"},
+        {"role_id": "Inspection", "roi_id": "B", "shape": {"kind": "rect", "x": 0, "y": 0, "w": 32, "h": 24}},
+        {"role_id": "Inspection", "roi_id": "C"},
+    ]
+    files = [("images", (f"roi{i}.png", _png_bytes(), "image/png")) for i in range(len(rois))]
+    resp = client.post("/infer_multi", data={"mm_per_px": "0.25", "rois": json.dumps(rois)}, files=files)
+    assert resp.status_code == 200, resp.text
+    payload = resp.json()
+
+    assert extractor.batch_calls == [2]  # one forward for the two fitted ROIs
+    assert payload["decision"] == "ng"
+    assert payload["n_rois"] == 3 and payload["n_errors"] == 1
+    by_roi = {r["roi_id"]: r for r in payload["results"]}
+    assert by_roi["A"]["decision"] == "ok" and by_roi["A"]["score"] < 1e-6
+    assert by_roi["B"]["decision"] == "ng" and by_roi["B"]["heatmap_png_base64"]
+    assert "encode" in by_roi["B"]["timings_ms"]
+    assert by_roi["C"]["decision"] is None and "fit_ok" in by_roi["C"]["error"]
+
+
+def test_infer_multi_reports_extractor_failure_per_roi(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    _reset_backend_state(tmp_path, monkeypatch)
+
+    class FailingExtractor:
+        def __init__(self):
+            self.batch_sizes = []
+
+        def extract_batch(self, images, batch_size=8):
+            self.batch_sizes.append(batch_size)
+            raise RuntimeError("CUDA out of memory")
+
+    extractor = FailingExtractor()
+    monkeypatch.setattr(app_mod, "_extractor", extractor)
+    monkeypatch.setattr(app_mod, "_extract_batch_size", lambda: 3)
+    mem = app_mod.PatchCoreMemory(np.zeros((2, 4), dtype=np.float32))
+    monkeypatch.setattr(app_mod, "_get_patchcore_memory_cached", lambda *a, **k: (mem, (2, 2), {}))
+    monkeypatch.setattr(app_mod, "_get_calib_cached", lambda *a, **k: {"threshold": 0.5})
+
+    rois = [{"role_id": "Inspection", "roi_id": f"R{i}"} for i in range(5)]
+    files = [("images", (f"roi{i}.png", _png_bytes(), "image/png")) for i in range(len(rois))]
+    resp = client.post("/infer_multi", data={"mm_per_px": "0.25", "rois": json.dumps(rois)}, files=files)
+    assert resp.status_code == 200, resp.text
+    payload = resp.json()
+
+    assert extractor.batch_sizes == [3]  # BDI_EXTRACT_BATCH_SIZE, no un único lote con todas las ROIs
+    assert payload["n_errors"] == 5
+    assert all("out of memory" in r["error"] for r in payload["results"])
+
+
+def test_infer_multi_rejects_misaligned_rois(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    _reset_backend_state(tmp_path, monkeypatch)
+    files = [("images", ("roi.png", _png_bytes(), "image/png"))]
+    rois = [{"role_id": "Inspection", "roi_id": "A"}, {"role_id": "Inspection", "roi_id": "B"}]
+    resp = client.post("/infer_multi", data={"mm_per_px": "0.25", "rois": json.dumps(rois)}, files=files)
+    assert resp.status_code == 400
+    assert "misma longitud" in resp.json()["error"]
+
+
+def test_extractor_drift_reports_embedding_stats(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    _reset_backend_state(tmp_path, monkeypatch)
+
+    class QuantizedExtractor:
+        quantize = "int8"
+        backend = "eager"
+
+        def extract_batch(self, images, batch_size=8):
+            return [(np.full((4, 3), 1.0, dtype=np.float32), (2, 2)) for _ in images]
+
+        def extract_reference_batch(self, images, batch_size=8):
+            return [(np.full((4, 3), 1.1, dtype=np.float32), (2, 2)) for _ in images]
+
+    monkeypatch.setattr(app_mod, "_extractor", QuantizedExtractor())
+    for _ in range(3):
+        app_mod.store.save_dataset_image("Master", "Pattern", "ok", _png_bytes(), ".png", recipe_id="default")
+
+    resp = client.post("/extractor/drift", json={"role_id": "Master", "roi_id": "Pattern"})
+    assert resp.status_code == 200, resp.text
+    payload = resp.json()
+    assert payload["quantize"] == "int8" and payload["n_images"] == 3
+    assert payload["embedding"]["n_tokens"] == 12
+    assert abs(payload["embedding"]["cosine_min"] - 1.0) < 1e-6
+    assert abs(payload["embedding"]["rel_l2_max"] - 0.1 / 1.1) < 1e-5
+    assert payload["scores"] is None  # no memory fitted for the ROI yet
+
+
+def test_extractor_mismatch_detects_layer_change(monkeypatch):
+    class LayersExtractor:
+        def get_metadata(self):
+            return {"model_name": "stub", "input_size": 448, "out_indices": [6, 7, 8], "preprocess": "pil", "quantize": "none"}
+
+    monkeypatch.setattr(app_mod, "_extractor", LayersExtractor())
+    assert app_mod._extractor_mismatch({}) is None  # legacy memory without extractor metadata
+    assert app_mod._extractor_mismatch({"extractor": {"input_size": 448, "out_indices": [6, 7, 8]}}) is None
+    msg = app_mod._extractor_mismatch({"extractor": {"out_indices": [9, 10, 11]}})
+    assert msg is not None and "out_indices" in msg
+
+    # El preprocesado y la cuantización también cambian los embeddings
+    fitted = {"out_indices": [6, 7, 8], "preprocess": "pil", "quantize": "none"}
+    assert app_mod._extractor_mismatch({"extractor": fitted}) is None
+    msg = app_mod._extractor_mismatch({"extractor": {**fitted, "preprocess": "cv2", "quantize": "int8"}})
+    assert msg is not None and "preprocess" in msg and "quantize" in msg
+
+
+def test_fit_ok_reuses_cached_dataset_embeddings(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    _reset_backend_state(tmp_path, monkeypatch)
+
+    class CountingExtractor:
+        def __init__(self):
+            self.n_extracted = 0
+
+        def extract_batch(self, images, batch_size=8):
+            self.n_extracted += len(images)
+            return [(np.ones((3, 4), dtype=np.float32), (2, 2)) for _ in images]
+
+        def get_metadata(self):
+            return {"model_name": "stub", "input_size": 448, "device": "cpu"}
+
+    extractor = CountingExtractor()
+    monkeypatch.setattr(app_mod, "_extractor", extractor)
+
+    def fake_build(embeddings, coreset_rate=0.02, seed=0, **_):
+        return SimpleNamespace(
+            emb=np.ones((2, embeddings.shape[1]), dtype=np.float32),
+            index=None,
+            index_type="flat",
+            precision="float32",
+            reference=None,
+            index_info=lambda: {"type": "flat", "params": {}, "precision": "float32"},
+        )
+
+    monkeypatch.setattr(app_mod.PatchCoreMemory, "build", staticmethod(fake_build))
+
+    for i in range(10):
+        app_mod.store.save_dataset_image("Master", "Pattern", "ok", _png_bytes((i, 80, 200)), ".png", recipe_id="default")
+
+    data = {"role_id": "Master", "roi_id": "Pattern", "mm_per_px": "0.25", "use_dataset": "true"}
+    resp = client.post("/fit_ok", data=data)
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["embedding_cache_hits"] == 0
+    assert extractor.n_extracted == 10
+
+    for i in range(2):
+        app_mod.store.save_dataset_image("Master", "Pattern", "ok", _png_bytes((i, 90, 10)), ".png", recipe_id="default")
+    resp = client.post("/fit_ok", data=data)
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["embedding_cache_hits"] == 10
+    assert resp.json()["n_embeddings"] == 36
+    assert extractor.n_extracted == 12  # only the two new samples were encoded
+
+
+def test_fit_ok_incremental_extends_existing_coreset(tmp_path, monkeypatch):
+    client = TestClient(app_mod.app)
+    _reset_backend_state(tmp_path, monkeypatch)
+    # Sin caché de embeddings: el ahorro debe venir solo del modo incremental
+    monkeypatch.setitem(app_mod.SETTINGS, "features", {**app_mod.SETTINGS.get("features", {}), "embedding_cache": "0"})
+
+    class CountingExtractor:
+        def __init__(self):
+            self.n_extracted = 0
+
+        def extract_batch(self, images, batch_size=8):
+            self.n_extracted += len(images)
+            out = []
+            for image in images:
+                rng = np.random.default_rng(int(image[0, 0].sum()))
+                out.append((rng.normal(size=(4, 8)).astype(np.float32), (2, 2)))
+            return out
+
+        def get_metadata(self):
+            return {"model_name": "stub", "input_size": 448, "device": "cpu"}
+
+    extractor = CountingExtractor()
+    monkeypatch.setattr(app_mod, "_extractor", extractor)
+
+    for i in range(10):
+        app_mod.store.save_dataset_image("Master", "Pattern", "ok", _png_bytes((i, 80, 200)), ".png", recipe_id="default")
+
+    data = {"role_id": "Master", "roi_id": "Pattern", "mm_per_px": "0.25", "use_dataset": "true", "incremental": "true"}
+    resp = client.post("/fit_ok", data=data)
+    assert resp.status_code == 200, resp.text
+    first = resp.json()
+    assert first["incremental"] is False
+    assert first["incremental_fallback"] == "no_previous_memory"
+    assert extractor.n_extracted == 10
+
+    for i in range(2):
+        app_mod.store.save_dataset_image("Master", "Pattern", "ok", _png_bytes((200 + i, 90, 10)), ".png", recipe_id="default")
+    resp = client.post("/fit_ok", data=data)
+    assert resp.status_code == 200, resp.text
+    second = resp.json()
+    assert second["incremental"] is True
+    assert second["n_new_images"] == 2
+    assert second["n_embeddings"] == 48
+    assert second["coreset_size"] > first["coreset_size"]
+    assert extractor.n_extracted == 12  # only the two new samples were encoded
+
+    emb, _, meta = app_mod.store.load_memory("Master", "Pattern", recipe_id="default", model_key="Pattern")
+    assert emb.shape[0] == second["coreset_size"]
+    assert len(meta["fitted_digests"]) == 12
+
+    resp = client.post("/fit_ok", data=data)
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["n_new_images"] == 0
+    assert extractor.n_extracted == 12
@@ -0,0 +1,52 @@
+import threading
+import time
+
+import numpy as np
+
+from backend.extractor_pool import ExtractorPool, parse_devices
+
+
+class _SlowExtractor:
+    def __init__(self, device):
+        self.device = device
+        self.model_name = f"stub-{device}"
+
+    def extract(self, image):
+        time.sleep(0.05)
+        return np.full((4, 2), float(image), dtype=np.float32), (2, 2)
+
+    def extract_batch(self, images, batch_size=8):
+        return [self.extract(image) for image in images]
+
+
+def test_pool_spreads_concurrent_requests_across_replicas():
+    pool = ExtractorPool(_SlowExtractor, ["cpu:a", "cpu:b"], concurrency=1)
+    assert pool.model_name == "stub-cpu:a"  # attribute delegation to the primary replica
+
+    results = {}
+
+    def _worker(i):
+        results[i] = pool.extract(i)
+
+    threads = [threading.Thread(target=_worker, args=(i,)) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(results) == list(range(6))
+    assert all(float(results[i][0][0, 0]) == float(i) for i in results)
+
+    stats = pool.stats()
+    assert stats["n_replicas"] == 2
+    assert stats["in_flight"] == 0 and stats["queue_depth"] == 0
+    assert stats["max_queue_depth"] >= 1
+    served = {r["device"]: r["served"] for r in stats["replicas"]}
+    assert sum(served.values()) == 6
+    assert served["cpu:a"] > 0 and served["cpu:b"] > 0
+
+
+def test_parse_devices_defaults_when_empty():
+    assert parse_devices("", "cpu") == ["cpu"]
+    assert parse_devices(None, "cuda") == ["cuda"]
+    assert parse_devices("cuda:0, cuda:1", "cpu") == ["cuda:0", "cuda:1"]
@@ -0,0 +1,133 @@
+import importlib.util
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("timm")
+pytest.importorskip("PIL")
+
+
+def _real_features_module():
+    """backend.features real (test_app_fastapi lo sustituye por un stub en sys.modules)."""
+    mod = sys.modules.get("backend.features")
+    if mod is not None and hasattr(mod, "timm"):
+        return mod
+    path = Path(__file__).resolve().parents[1] / "features.py"
+    spec = importlib.util.spec_from_file_location("backend._features_under_test", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+features_mod = _real_features_module()
+
+
+def _tiny_vit(*_args, **_kwargs):
+    from timm.models.vision_transformer import VisionTransformer
+
+    torch.manual_seed(0)
+    return VisionTransformer(img_size=56, patch_size=14, embed_dim=32, depth=4, num_heads=2)
+
+
+@pytest.fixture
+def extractor(monkeypatch):
+    # ViT pequeño con pesos aleatorios (sin descarga de pesos preentrenados)
+    monkeypatch.setattr(features_mod.timm, "create_model", _tiny_vit)
+    return features_mod.DinoV2Features(
+        model_name="tiny", input_size=98, out_indices=(1, 2), device="cpu", dynamic_input=True
+    )
+
+
+@pytest.mark.parametrize("hw", [(56, 56), (70, 98)])
+def test_stateless_forward_is_bit_identical_to_timm(extractor, hw):
+    assert extractor._stateless
+    x = torch.randn(2, 3, *hw, generator=torch.Generator().manual_seed(1))
+    with torch.no_grad():
+        stateless = extractor._forward_tokens_stateless(x)
+        reference = extractor._forward_tokens_timm(x)
+    htok, wtok = hw[0] // 14, hw[1] // 14
+    assert stateless.shape == (2, htok * wtok, 2 * 32)
+    assert torch.equal(stateless, reference)
+
+
+def _smooth_bgr(h=150, w=200):
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    channels = [128 + 100 * np.sin(xx / (15 + 4 * c) + c) * np.cos(yy / (21 + 3 * c)) for c in range(3)]
+    return np.clip(np.stack(channels, axis=-1), 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("path", ["torch", "cv2"])
+def test_preprocess_paths_match_pil_letterbox(extractor, path):
+    if path == "cv2":
+        pytest.importorskip("cv2")
+    img = _smooth_bgr()
+    ref = extractor._preprocess_pil(img)
+    got = getattr(extractor, f"_preprocess_{path}")(img)
+    assert got.shape == ref.shape == (1, 3, 98, 98)
+    # Diferencias en [0,1] (sin normalizar): solo el filtro de remuestreo cambia
+    diff = ((got - ref) * extractor.std).abs()
+    assert float(diff.mean()) < 0.01
+    assert float(diff.max()) < 0.08
+
+
+@pytest.mark.parametrize("attr", ["patch_drop", "norm_pre", "pos_drop"])
+def test_stateless_probe_requires_every_submodule(extractor, attr):
+    assert extractor._supports_stateless_forward()
+    delattr(extractor.model, attr)
+    assert not extractor._supports_stateless_forward()
+
+
+def _fixed_extractor(**kwargs):
+    return features_mod.DinoV2Features(
+        model_name="tiny", input_size=56, out_indices=(1, 2), device="cpu", dynamic_input=False, **kwargs
+    )
+
+
+def test_torchscript_backend_matches_stateless_forward(monkeypatch):
+    monkeypatch.setattr(features_mod.timm, "create_model", _tiny_vit)
+    extractor = _fixed_extractor(backend="torchscript")
+    assert extractor.backend == "torchscript"
+    assert extractor.backend_parity["ok"]
+    x = torch.randn(3, 3, 56, 56, generator=torch.Generator().manual_seed(2))
+    with torch.inference_mode():
+        got = extractor._runner(x)
+        ref = extractor._forward_tokens_stateless(x)
+    assert got.shape == (3, 16, 2 * 32)
+    assert torch.allclose(got, ref, atol=1e-5, rtol=1e-4)
+
+
+def test_backend_failing_parity_falls_back_to_eager(monkeypatch):
+    monkeypatch.setattr(features_mod.timm, "create_model", _tiny_vit)
+
+    def bad_runner(x):
+        # Forma correcta, valores sin relación con el forward eager
+        return torch.randn(x.shape[0], 16, 2 * 32, generator=torch.Generator().manual_seed(3))
+
+    monkeypatch.setattr(features_mod, "load_backend", lambda *_args, **_kwargs: bad_runner)
+    extractor = _fixed_extractor(backend="torchscript")
+    assert extractor.backend == "eager"
+    assert extractor._runner is None
+    assert extractor.backend_parity["backend"] == "torchscript"
+    assert not extractor.backend_parity["ok"]
+
+
+def test_pos_embed_cache_reuses_grids_and_evicts_lru(extractor, monkeypatch):
+    monkeypatch.setattr(features_mod, "_POS_EMBED_CACHE_MAX", 3)
+    extractor._pos_embed_cache.clear()
+    dev, dt = torch.device("cpu"), torch.float32
+    first = extractor._cached_pos_embed(4, 4, dev, dt)
+    assert extractor._cached_pos_embed(4, 4, dev, dt) is first
+    assert first.shape == (1, 1 + 16, 32)
+
+    for grid in [(5, 7), (7, 7)]:
+        extractor._cached_pos_embed(*grid, dev, dt)
+    extractor._cached_pos_embed(4, 4, dev, dt)  # (4,4) pasa a ser el más reciente
+    extractor._cached_pos_embed(6, 6, dev, dt)  # supera el máximo: se expulsa (5,7)
+    keys = [k[:2] for k in extractor._pos_embed_cache]
+    assert keys == [(7, 7), (4, 4), (6, 6)]
+    assert extractor._cached_pos_embed(4, 4, dev, dt) is first
+    assert extractor._cached_pos_embed(5, 7, dev, dt).shape == (1, 1 + 35, 32)
+    assert len(extractor._pos_embed_cache) == 3
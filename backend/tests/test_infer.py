@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+if not hasattr(cv2, "connectedComponentsWithStats"):  # stub mínimo de test_app_fastapi
+    pytest.skip("cv2 real no disponible", allow_module_level=True)
+pytest.importorskip("torch")
+pytest.importorskip("timm")
+
+from backend.infer import InferenceEngine, regions_from_binary  # noqa: E402
+
+
+def _external_regions(bin_img, px_thr):
+    """Referencia: findContours externo + contourArea (comportamiento original)."""
+    out = []
+    for c in cv2.findContours(bin_img.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]:
+        area = cv2.contourArea(c)
+        if area >= px_thr:
+            out.append((list(cv2.boundingRect(c)), float(area)))
+    return sorted(out, key=lambda r: r[1], reverse=True)
+
+
+def test_region_with_hole_keeps_external_contour_semantics():
+    bin_img = np.zeros((80, 100), np.uint8)
+    bin_img[10:60, 10:70] = 255
+    bin_img[20:50, 20:60] = 0        # hueco
+    bin_img[30:35, 35:40] = 255      # isla dentro del hueco: no es una región aparte
+    bin_img[70:72, 90:92] = 255      # isla pequeña: por debajo del área mínima
+
+    regions = regions_from_binary(bin_img, px_thr=10.0, mm_per_px=0.5)
+
+    assert len(regions) == 1
+    assert [(r["bbox"], r["area_px"]) for r in regions] == _external_regions(bin_img, 10.0)
+    # El área incluye el hueco (área del polígono exterior, como cv2.contourArea)
+    assert regions[0]["area_px"] == pytest.approx(49 * 59)
+    assert regions[0]["area_mm2"] == pytest.approx(49 * 59 * 0.25)
+
+
+def test_regions_match_external_contours_on_noise():
+    rng = np.random.default_rng(0)
+    bin_img = ((rng.random((120, 160)) > 0.8) * 255).astype(np.uint8)
+    bin_img = cv2.dilate(bin_img, np.ones((2, 2), np.uint8))
+    got = [(r["bbox"], r["area_px"]) for r in regions_from_binary(bin_img, px_thr=4.0, mm_per_px=1.0)]
+    ref = _external_regions(bin_img, 4.0)
+    assert sorted(got) == sorted(ref)
+
+
+def test_grid_upsampling_matches_full_resize_near_mask_edge():
+    rng = np.random.default_rng(1)
+    heat_g = rng.random((16, 16)).astype(np.float32)
+    H, W = 160, 160
+    # Máscara con solo 2 columnas de píxeles en cada celda del borde derecho (celdas "mayoritariamente fuera")
+    mask_bool = np.zeros((H, W), dtype=bool)
+    mask_bool[:, 150:152] = True
+    mask_bool[40:80, 20:60] = True
+
+    got = InferenceEngine._upsample_regions(heat_g, 0.7, mask_bool)
+    full = cv2.resize(heat_g, (W, H), interpolation=cv2.INTER_LINEAR)
+    ref = ((full >= 0.7) & mask_bool).astype(np.uint8) * 255
+    # Solo pueden diferir píxeles a distancia de redondeo del umbral
+    diff = got != ref
+    assert np.all(np.abs(full[diff] - 0.7) < 1e-5)
+    assert got[:, 150:152].any()
@@ -0,0 +1,75 @@
+import threading
+
+import numpy as np
+
+from backend.microbatch import MicroBatcher
+
+
+class _RecordingExtractor:
+    def __init__(self):
+        self.batch_sizes = []
+
+    def extract_batch(self, images, batch_size=8):
+        self.batch_sizes.append(len(images))
+        return [(np.full((4, 2), float(img), dtype=np.float32), (2, 2)) for img in images]
+
+
+def test_microbatcher_groups_concurrent_requests_and_fans_out_results():
+    ext = _RecordingExtractor()
+    batcher = MicroBatcher(ext, max_batch=4, max_wait_ms=200.0)
+    try:
+        results = {}
+        start = threading.Barrier(4)
+
+        def _worker(i):
+            start.wait()
+            results[i] = batcher.extract(i, timeout=5.0)
+
+        threads = [threading.Thread(target=_worker, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert sorted(results) == [0, 1, 2, 3]
+        assert all(float(results[i][0][0, 0]) == float(i) for i in results)
+        assert sum(ext.batch_sizes) == 4
+        assert len(ext.batch_sizes) < 4
+        assert batcher.stats()["n_items"] == 4
+    finally:
+        batcher.close()
+
+
+class _FailingItemExtractor(_RecordingExtractor):
+    def extract_batch(self, images, batch_size=8):
+        if any(img < 0 for img in images):
+            self.batch_sizes.append(len(images))
+            raise ValueError("imagen no decodificable")
+        return super().extract_batch(images, batch_size=batch_size)
+
+
+def test_microbatcher_isolates_a_failing_item_from_its_batch():
+    ext = _FailingItemExtractor()
+    batcher = MicroBatcher(ext, max_batch=4, max_wait_ms=200.0)
+    try:
+        results, errors = {}, {}
+        start = threading.Barrier(4)
+
+        def _worker(i):
+            start.wait()
+            try:
+                results[i] = batcher.extract(i, timeout=5.0)
+            except ValueError as exc:
+                errors[i] = exc
+
+        threads = [threading.Thread(target=_worker, args=(i,)) for i in (-1, 1, 2, 3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert list(errors) == [-1]
+        assert sorted(results) == [1, 2, 3]
+        assert all(float(results[i][0][0, 0]) == float(i) for i in results)
+    finally:
+        batcher.close()
@@ -0,0 +1,191 @@
+import numpy as np
+import pytest
+
+from backend.patchcore import PatchCoreMemory, _min_dist_to, _min_sq_dist_to, kcenter_greedy, l2_normalize
+
+
+def _reference_kcenter(E, m, seed=0):
+    # Implementación original (np.linalg.norm por iteración)
+    rng = np.random.default_rng(seed)
+    n = E.shape[0]
+    c0 = int(rng.integers(0, n))
+    centers = [c0]
+    d = np.linalg.norm(E - E[c0], axis=1)
+    for _ in range(1, m):
+        i = int(np.argmax(d))
+        centers.append(i)
+        d = np.minimum(d, np.linalg.norm(E - E[i], axis=1))
+    return np.array(centers, dtype=np.int64)
+
+
+def _embeddings(n=3000, dim=96, seed=1):
+    rng = np.random.default_rng(seed)
+    return l2_normalize(rng.normal(size=(n, dim)).astype(np.float32))
+
+
+def test_kcenter_matches_reference_selection():
+    E = _embeddings()
+    expected = _reference_kcenter(E, 60)
+    got = kcenter_greedy(E, 60, chunk_rows=512)  # varios bloques de filas
+    np.testing.assert_array_equal(got, expected)
+
+
+def test_kcenter_projection_keeps_coverage_radius():
+    E = _embeddings(dim=384)
+    exact = _min_dist_to(E, E[kcenter_greedy(E, 60)]).max()
+    projected_idx = kcenter_greedy(E, 60, projection_dim=64)
+    assert len(set(projected_idx.tolist())) == 60
+    assert _min_dist_to(E, E[projected_idx]).max() <= exact * 1.05
+
+
+def test_extend_continues_from_existing_centers():
+    E = _embeddings()
+    base = PatchCoreMemory.build(E[:2000], coreset_rate=0.02, seed=0)
+    extended = PatchCoreMemory.extend(base.emb, E[2000:], coreset_rate=0.02, seed=0)
+    assert extended.emb.shape[0] == base.emb.shape[0] + 20
+    np.testing.assert_array_equal(extended.emb[: base.emb.shape[0]], base.emb)
+
+    # Embeddings ya cubiertos (duplicados del coreset) no añaden centros
+    same = PatchCoreMemory.extend(base.emb, base.emb.copy(), coreset_rate=0.5, seed=0)
+    assert same.emb.shape[0] == base.emb.shape[0]
+
+
+def test_kcenter_torch_matches_numpy():
+    pytest.importorskip("torch")
+    from backend.patchcore import kcenter_greedy_torch
+
+    E = _embeddings()
+    np.testing.assert_array_equal(kcenter_greedy_torch(E, 60, device="cpu"), kcenter_greedy(E, 60))
+
+    base = E[:40]
+    np.testing.assert_array_equal(
+        kcenter_greedy_torch(E[40:], 30, init_centers=base, device="cpu"),
+        kcenter_greedy(E[40:], 30, init_centers=base),
+    )
+
+
+def test_resolve_index_params_defaults_and_small_memory_fallback():
+    from backend.patchcore import resolve_index_params
+
+    itype, params = resolve_index_params("ivf_pq", 200_000, 1152)
+    assert itype == "ivf_pq"
+    assert params["nlist"] == int(4 * np.sqrt(200_000))
+    assert 1152 % params["m"] == 0 and params["m"] <= 64
+    assert params["nprobe"] == 16
+
+    # Muy pocos vectores para entrenar IVF: búsqueda exacta
+    assert resolve_index_params("ivf_flat", 30, 384) == ("flat", {})
+    assert resolve_index_params("HNSW", 10, 384, {"efSearch": 128})[1]["efSearch"] == 128
+    with pytest.raises(ValueError):
+        resolve_index_params("lsh", 1000, 384)
+
+
+def test_approximate_index_recall_against_exact_search():
+    pytest.importorskip("faiss")
+    from backend.patchcore import held_out_sample, index_recall
+
+    E = _embeddings(n=4000, dim=64)
+    mem = PatchCoreMemory.build(E, coreset_rate=0.5, index_type="hnsw")
+    assert mem.index_info()["type"] == "hnsw"
+    Q = held_out_sample(E, mem.coreset_indices)
+    # Consultas retenidas: ninguna está en la memoria
+    assert Q.shape[0] == 256
+    assert _min_sq_dist_to(Q, mem.emb).min() > 1e-4
+    assert index_recall(mem.index, mem.emb, Q) >= 0.9
+    flat = PatchCoreMemory.build(E, coreset_rate=0.5)
+    assert index_recall(flat.index, flat.emb, held_out_sample(E, flat.coreset_indices)) == 1.0
+    # Sin filas retenidas (coreset_rate=1) no hay recall que medir
+    full = PatchCoreMemory.build(E[:100], coreset_rate=1.0)
+    assert held_out_sample(E[:100], full.coreset_indices).shape[0] == 0
+    assert index_recall(full.index, full.emb, held_out_sample(E[:100], full.coreset_indices)) is None
+
+
+def test_numpy_knn_fallback_matches_brute_force(monkeypatch):
+    import backend.patchcore as pc
+
+    monkeypatch.setattr(pc, "_HAS_FAISS", False)
+    monkeypatch.setattr(pc, "KNN_CHUNK_ROWS", 300)  # varios bloques de memoria
+    M = _embeddings(n=1000, dim=64)
+    Q = _embeddings(n=200, dim=64, seed=2)
+    mem = PatchCoreMemory(M)
+    assert mem.knn_backend == "numpy" and mem.nn is None
+    expected = np.linalg.norm(Q[:, None, :] - M[None, :, :], axis=2).min(axis=1)
+    np.testing.assert_allclose(mem.knn_min_dist(Q), expected, atol=1e-4)
+
+
+def test_numpy_topk_search_and_aggregation(monkeypatch):
+    import backend.patchcore as pc
+
+    monkeypatch.setattr(pc, "_HAS_FAISS", False)
+    monkeypatch.setattr(pc, "KNN_CHUNK_ROWS", 300)
+    M = _embeddings(n=1000, dim=64)
+    Q = _embeddings(n=50, dim=64, seed=3)
+    mem = PatchCoreMemory(M)
+    D, I = mem.knn_search(Q, k=5)
+    full = np.linalg.norm(Q[:, None, :] - M[None, :, :], axis=2)
+    np.testing.assert_array_equal(I, np.argsort(full, axis=1)[:, :5])
+    np.testing.assert_allclose(D, np.sort(full, axis=1)[:, :5], atol=1e-4)
+
+    np.testing.assert_allclose(mem.knn_scores(Q, k=5, aggregation="mean"), D.mean(axis=1), atol=1e-6)
+    rw = pc.aggregate_knn(D, "reweight")
+    assert np.all(rw <= D[:, 0] + 1e-6) and np.all(rw > 0)
+    np.testing.assert_allclose(pc.aggregate_knn(D[:, :1], "reweight"), D[:, 0])
+    with pytest.raises(ValueError):
+        pc.aggregate_knn(D, "max")
+
+
+def test_knn_aggregation_ignores_faiss_padding(monkeypatch):
+    import backend.patchcore as pc
+
+    monkeypatch.setattr(pc, "_HAS_FAISS", False)
+    M = _embeddings(n=200, dim=16)
+    Q = _embeddings(n=3, dim=16, seed=5)
+    mem = PatchCoreMemory(M)
+    exact_D, exact_I = mem.knn_search(Q, k=3)
+    pad = np.float32(3.4e38)
+
+    class PaddedIndex:
+        # Como IVF con pocas listas sondeadas: menos de k resultados, relleno con I=-1
+        def search(self, q, k):
+            D2 = (exact_D.astype(np.float32) ** 2).copy()
+            I = exact_I.copy()
+            D2[0, 2:], I[0, 2:] = pad, -1   # 2 vecinos válidos
+            D2[1, 1:], I[1, 1:] = pad, -1   # solo el más cercano
+            D2[2, :], I[2, :] = pad, -1     # ninguno: 1-NN exacto
+            return D2, I
+
+    mem.index = PaddedIndex()
+    D, I = mem.knn_search(Q, k=3)
+    assert I[2, 0] == exact_I[2, 0] and D[2, 0] == pytest.approx(exact_D[2, 0], abs=1e-5)
+    mean = mem.knn_scores(Q, k=3, aggregation="mean")
+    np.testing.assert_allclose(mean, [exact_D[0, :2].mean(), exact_D[1, 0], exact_D[2, 0]], atol=1e-5)
+    rw = mem.knn_scores(Q, k=3, aggregation="reweight")
+    assert np.all(np.isfinite(rw))
+    np.testing.assert_allclose(rw[1:], exact_D[1:, 0], atol=1e-5)
+    np.testing.assert_allclose(rw[0], pc.aggregate_knn(exact_D[:1, :2], "reweight")[0], atol=1e-5)
+    np.testing.assert_allclose(mem.knn_min_dist(Q), exact_D[:, 0], atol=1e-5)
+
+
+@pytest.mark.parametrize("precision,atol", [("float16", 2e-3), ("sq8", 2e-2)])
+def test_reduced_precision_numpy_search_close_to_float32(monkeypatch, precision, atol):
+    import backend.patchcore as pc
+
+    monkeypatch.setattr(pc, "_HAS_FAISS", False)
+    M = _embeddings(n=1000, dim=64)
+    Q = _embeddings(n=200, dim=64, seed=4)
+    ref = PatchCoreMemory(M).knn_min_dist(Q)
+    mem = PatchCoreMemory(M, precision=precision)
+    assert mem.emb.dtype == np.float16
+    np.testing.assert_allclose(mem.knn_min_dist(Q), ref, atol=atol)
+    assert mem.index_info()["precision"] == precision
+
+
+def test_reduced_precision_build_keeps_float32_reference(monkeypatch):
+    import backend.patchcore as pc
+
+    monkeypatch.setattr(pc, "_HAS_FAISS", False)
+    E = _embeddings(n=300, dim=32)
+    mem = PatchCoreMemory.build(E, coreset_rate=0.1, precision="float16")
+    assert mem.reference is not None and mem.reference.dtype == np.float32
+    np.testing.assert_array_equal(mem.reference.astype(np.float16), mem.emb)
+    assert PatchCoreMemory.build(E, coreset_rate=0.1).reference is None
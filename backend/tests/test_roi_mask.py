@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+if not hasattr(cv2, "resize"):  # stub mínimo de test_app_fastapi
+    pytest.skip("cv2 real no disponible", allow_module_level=True)
+
+from backend import roi_mask  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def _fresh_cache():
+    roi_mask.clear_mask_cache()
+    roi_mask.set_mask_cache_limit(64 * 1024 * 1024)
+    yield
+    roi_mask.clear_mask_cache()
+    roi_mask.set_mask_cache_limit(64 * 1024 * 1024)
+
+
+def test_cached_mask_reuses_arrays_for_equivalent_shapes():
+    shape = {"kind": "annulus", "cx": 50, "cy": 40, "r": 30, "r_inner": 10}
+    u8, mask_bool = roi_mask.cached_mask(80, 100, shape)
+    np.testing.assert_array_equal(u8, roi_mask.build_mask(80, 100, shape))
+    np.testing.assert_array_equal(mask_bool, u8 > 0)
+    assert not u8.flags.writeable
+
+    # Mismo JSON canónico (orden de claves / mayúsculas en kind) -> misma entrada
+    same = {"r_inner": 10, "r": 30, "cy": 40, "cx": 50, "kind": "Annulus"}
+    assert roi_mask.cached_mask(80, 100, same)[0] is u8
+    assert roi_mask.mask_cache_info()["entries"] == 1
+
+    grid = roi_mask.cached_token_grid(80, 100, shape, 8, 10, margin_px=3)
+    np.testing.assert_array_equal(grid, roi_mask.mask_to_token_grid(u8, 8, 10, margin_px=3))
+    assert roi_mask.cached_token_grid(80, 100, same, 8, 10, margin_px=3) is grid
+
+
+def test_mask_cache_evicts_by_bytes():
+    roi_mask.set_mask_cache_limit(2 * 100 * 100 * 2)  # dos máscaras 100x100 (uint8 + bool)
+    for x in range(3):
+        roi_mask.cached_mask(100, 100, {"kind": "rect", "x": x, "y": 0, "w": 10, "h": 10})
+    info = roi_mask.mask_cache_info()
+    assert info["entries"] == 2 and info["bytes"] <= info["max_bytes"]
+
+    roi_mask.set_mask_cache_limit(0)
+    u8, _ = roi_mask.cached_mask(100, 100, None)
+    assert u8.shape == (100, 100) and roi_mask.mask_cache_info()["entries"] == 0
+
+
+def test_token_grid_keeps_cells_with_a_single_valid_pixel():
+    # 1 píxel válido en una celda de 62x62: el promedio uint8 (255/3844) redondearía a 0
+    mask = np.zeros((992, 992), np.uint8)
+    mask[500, 700] = 255
+    grid = roi_mask.mask_to_token_grid(mask, 16, 16)
+    assert grid[500 // 62, 700 // 62]
+    assert grid.any() and not grid.all()
@@ -0,0 +1,111 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from backend.storage import ModelStore
+
+
+def test_memory_roundtrip_is_memory_mapped(tmp_path):
+    store = ModelStore(tmp_path)
+    emb = np.random.default_rng(0).normal(size=(50, 16)).astype(np.float32)
+    path = store.save_memory("Master", "Pattern", emb, (5, 10), {"coreset_rate": 0.1}, recipe_id="default")
+    assert path.name.endswith(".mem.json")
+
+    loaded, hw, meta = store.load_memory("Master", "Pattern", recipe_id="default")
+    assert isinstance(loaded, np.memmap)
+    np.testing.assert_array_equal(loaded, emb)
+    assert hw == (5, 10) and meta["coreset_rate"] == 0.1
+    by_path, hw_path, _ = store.load_memory_file(path)
+    np.testing.assert_array_equal(by_path, emb)
+    assert hw_path == (5, 10)
+
+    # Reescritura: la cabecera apunta a los datos nuevos y los anteriores se eliminan
+    store.save_memory("Master", "Pattern", emb[:20], (5, 10), {}, recipe_id="default")
+    assert len(list(path.parent.glob("*.mem"))) == 1
+    assert store.load_memory("Master", "Pattern", recipe_id="default")[0].shape == (20, 16)
+
+
+def test_legacy_npz_memory_is_converted_on_load(tmp_path):
+    store = ModelStore(tmp_path)
+    emb = np.random.default_rng(1).normal(size=(30, 8)).astype(np.float32)
+    header_path = store.expected_memory_path("Master", "Pattern", recipe_id="default", create=True)
+    npz_path = store.memory_file_variants(header_path)[1]
+    np.savez_compressed(npz_path, emb=emb, token_h=3, token_w=10, metadata=json.dumps({"applied_rate": 0.5}))
+
+    assert store.resolve_memory_path_existing("Master", "Pattern", recipe_id="default") == npz_path
+    loaded, hw, meta = store.load_memory("Master", "Pattern", recipe_id="default")
+    np.testing.assert_array_equal(loaded, emb)
+    assert hw == (3, 10) and meta == {"applied_rate": 0.5}
+
+    assert store.resolve_memory_path_existing("Master", "Pattern", recipe_id="default") == header_path
+    assert isinstance(store.load_memory("Master", "Pattern", recipe_id="default")[0], np.memmap)
+
+
+def test_concurrent_memory_writes_keep_the_current_data_file(tmp_path):
+    store = ModelStore(tmp_path)
+    rng = np.random.default_rng(2)
+    payloads = [rng.normal(size=(20 + i, 8)).astype(np.float32) for i in range(6)]
+
+    def _save(emb):
+        store.save_memory("Master", "Pattern", emb, (2, 10), {}, recipe_id="default")
+
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        list(pool.map(_save, payloads))
+
+    # La cabecera vigente apunta a un fichero de datos existente (no lo ha borrado otro escritor)
+    loaded, _, _ = store.load_memory("Master", "Pattern", recipe_id="default")
+    assert any(loaded.shape == emb.shape and np.array_equal(loaded, emb) for emb in payloads)
+    path = store.resolve_memory_path_existing("Master", "Pattern", recipe_id="default")
+    assert len(list(path.parent.glob("*.mem"))) == 1
+
+
+def test_float32_reference_is_saved_and_removed_with_the_memory(tmp_path):
+    store = ModelStore(tmp_path)
+    ref = np.random.default_rng(3).normal(size=(12, 8)).astype(np.float32)
+    path = store.save_memory(
+        "Master", "Pattern", ref.astype(np.float16), (3, 4), {}, recipe_id="default", dtype="float16", reference=ref
+    )
+    np.testing.assert_array_equal(store.load_memory_reference(path, expected_shape=(12, 8)), ref)
+    assert store.load_memory_reference(path, expected_shape=(13, 8)) is None
+    # La memoria principal no borra los datos de la referencia (y viceversa)
+    assert store.load_memory("Master", "Pattern", recipe_id="default")[0].dtype == np.float16
+
+    store.save_memory("Master", "Pattern", ref, (3, 4), {}, recipe_id="default")
+    assert store.load_memory_reference(path) is None
+    assert len(list(path.parent.glob("*.mem"))) == 1
+
+
+def test_embedding_cache_entries_follow_dataset_files(tmp_path):
+    store = ModelStore(tmp_path)
+    a = store.save_dataset_image("Master", "Pattern", "ok", b"image-a", ".png", recipe_id="default")
+    b = store.save_dataset_image("Master", "Pattern", "ok", b"image-b", ".png", recipe_id="default")
+    dup = store.save_dataset_image("Master", "Pattern", "ng", b"image-b", ".png", recipe_id="default")
+    emb = np.random.default_rng(0).normal(size=(4, 8)).astype(np.float32)
+    for data in (b"image-a", b"image-b"):
+        for key in ("old", "new"):
+            store.save_cached_embedding(
+                "Master", "Pattern", store.image_digest(data), key, emb, (2, 2), recipe_id="default"
+            )
+    # Escribir con otra configuración del extractor no borra la anterior
+    cached = store.load_cached_embedding("Master", "Pattern", store.image_digest(b"image-a"), "old", recipe_id="default")
+    assert cached is not None and cached[1] == (2, 2)
+    np.testing.assert_allclose(cached[0], emb.astype(np.float16).astype(np.float32))
+
+    def entries(data):
+        return [
+            store.load_cached_embedding("Master", "Pattern", store.image_digest(data), key, recipe_id="default")
+            for key in ("old", "new")
+        ]
+
+    assert store.delete_dataset_file("Master", "Pattern", "ok", a.name, recipe_id="default")
+    assert entries(b"image-a") == [None, None]
+    # Otro fichero del dataset tiene el mismo contenido: la entrada se conserva
+    assert store.delete_dataset_file("Master", "Pattern", "ok", b.name, recipe_id="default")
+    assert all(e is not None for e in entries(b"image-b"))
+    assert store.delete_dataset_file("Master", "Pattern", "ng", dup.name, recipe_id="default")
+    assert entries(b"image-b") == [None, None]
+
+    assert store.clear_embedding_cache("Master", "Pattern", recipe_id="default", keep_key="new") == 1
+    base = store.resolve_dataset_base_existing("Master", "Pattern", recipe_id="default")
+    assert [p.name for p in (base / ".emb_cache").iterdir()] == ["new"]
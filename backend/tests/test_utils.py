@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from backend.calib import choose_threshold
+from backend.utils import masked_percentiles
+
+
+def test_masked_percentiles_match_numpy():
+    rng = np.random.default_rng(0)
+    heat = rng.normal(size=(37, 53)).astype(np.float32)
+    mask = rng.random(heat.shape) > 0.3
+    ps = [99, 1, 50, 0, 100, 97.5]
+    before = heat.copy()
+
+    got = masked_percentiles(heat, ps, mask=mask)
+    np.testing.assert_allclose(got, np.percentile(heat[mask], ps), rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(masked_percentiles(heat, [90]), np.percentile(heat, [90]), rtol=1e-6)
+    # La entrada no se reordena
+    np.testing.assert_array_equal(heat, before)
+
+    with pytest.raises(ValueError):
+        masked_percentiles(heat, [50], mask=np.zeros_like(mask))
+
+
+def test_choose_threshold_uses_ok_and_ng_percentiles():
+    ok = np.linspace(0.0, 1.0, 101)
+    assert choose_threshold(ok, None, percentile=99) == pytest.approx(0.99)
+    assert choose_threshold(ok, [np.nan, 2.0, 2.0], percentile=99) == pytest.approx((0.99 + 2.0) * 0.5)
@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import numpy as np
 import time
 import json
@@ -26,7 +28,26 @@ def px2_to_mm2(area_px: float, mm_per_px: float) -> float:
     return float(area_px * (mm_per_px ** 2))
 
 def percentile(arr: np.ndarray, p: float) -> float:
-    return float(np.percentile(arr, p))
+    return float(masked_percentiles(arr, [p])[0])
+
+def masked_percentiles(arr: np.ndarray, ps, mask: np.ndarray | None = None) -> np.ndarray:
+    """
+    Percentiles `ps` de arr[mask] (o de todo arr) con interpolación lineal, como np.percentile,
+    extrayendo los valores una sola vez y con un único np.partition para todos los cuantiles.
+    """
+    vals = np.asarray(arr)[mask] if mask is not None else np.array(arr, copy=True).reshape(-1)
+    if vals.size == 0:
+        raise ValueError("masked_percentiles: no hay valores")
+    q = np.asarray(ps, dtype=np.float64).reshape(-1) / 100.0
+    if np.any((q < 0.0) | (q > 1.0)):
+        raise ValueError("Los percentiles deben estar en [0, 100]")
+    pos = q * (vals.size - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, vals.size - 1)
+    vals.partition(np.unique(np.concatenate([lo, hi])))
+    v_lo = vals[lo].astype(np.float64)
+    v_hi = vals[hi].astype(np.float64)
+    return v_lo + (v_hi - v_lo) * (pos - lo)
 
 def as_b64_png(img_bgr: np.ndarray) -> str:
     import cv2
@@ -38,3 +59,28 @@ def as_b64_png(img_bgr: np.ndarray) -> str:
 def base64_from_bytes(data: bytes) -> str:
     return base64.b64encode(data).decode("ascii")
 
+def embedding_drift(reference, candidate) -> dict:
+    """Deriva por token entre extracciones alineadas [(emb, (Ht,Wt)), ...] (p.ej. fp32 vs int8)."""
+    cos_all, rel_all = [], []
+    for (ref, ref_hw), (cand, cand_hw) in zip(reference, candidate):
+        if tuple(ref_hw) != tuple(cand_hw) or ref.shape != cand.shape:
+            raise ValueError(f"Extracciones no comparables: {ref.shape}@{ref_hw} vs {cand.shape}@{cand_hw}")
+        r = np.asarray(ref, dtype=np.float32)
+        c = np.asarray(cand, dtype=np.float32)
+        r_norm = np.linalg.norm(r, axis=1)
+        c_norm = np.linalg.norm(c, axis=1)
+        cos_all.append((r * c).sum(axis=1) / np.maximum(r_norm * c_norm, 1e-12))
+        rel_all.append(np.linalg.norm(r - c, axis=1) / np.maximum(r_norm, 1e-12))
+    if not cos_all:
+        return {"n_images": 0, "n_tokens": 0}
+    cos = np.concatenate(cos_all)
+    rel = np.concatenate(rel_all)
+    return {
+        "n_images": len(cos_all),
+        "n_tokens": int(cos.size),
+        "cosine_mean": float(cos.mean()),
+        "cosine_min": float(cos.min()),
+        "cosine_p01": float(np.percentile(cos, 1)),
+        "rel_l2_mean": float(rel.mean()),
+        "rel_l2_max": float(rel.max()),
+    }
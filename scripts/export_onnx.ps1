@@ -1,23 +1,19 @@
-
 # export_onnx.ps1
-Write-Host "🔄 Exporting TensorFlow model to ONNX..."
+# Exporta el grafo DINOv2 (entrada fija 448) a ONNX y comprueba la paridad con el modelo eager.
+# Después: BDI_EXTRACTOR_BACKEND=onnx y BDI_EXTRACTOR_BACKEND_PATH=<ruta del .onnx>
+Write-Host "🔄 Exporting DINOv2 extractor to ONNX..."
 
-Set-Location $PSScriptRoot\..\backend
+Set-Location $PSScriptRoot\..
 
-.venv\Scripts\Activate.ps1
+backend\.venv\Scripts\Activate.ps1
 
-$model = "model/current_model.h5"
-$output = "model/current_model.onnx"
+$output = "backend/models/dinov2_vits14_448.onnx"
 
-if (-Not (Test-Path $model)) {
-    Write-Host "❌ Model not found: $model"
-    exit 1
-}
+python -m backend.extractor_backends --backend onnx --out $output
 
-python -m tf2onnx.convert --keras $model --output $output --opset 13
-
-if (Test-Path $output) {
-    Write-Host "✅ Model exported to $output"
+if ($LASTEXITCODE -eq 0 -and (Test-Path $output)) {
+    Write-Host "✅ Model exported to $output (parity OK)"
 } else {
-    Write-Host "❌ Export failed."
+    Write-Host "❌ Export failed or parity check failed."
+    exit 1
 }